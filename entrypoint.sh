@@ -26,4 +26,12 @@ fi
 echo 'Coverage Report....'
 coverage report
 
-python $WORK_DIR/manage.py runserver 0.0.0.0:8000
\ No newline at end of file
+case "${PSC_SERVER_MODE:-dev}" in
+  wsgi|asgi)
+    echo "Serving $PSC_SERVER_MODE with gunicorn..."
+    cd $WORK_DIR && exec gunicorn -c $WORK_DIR/gunicorn.conf.py
+    ;;
+  *)
+    python $WORK_DIR/manage.py runserver 0.0.0.0:8000
+    ;;
+esac
\ No newline at end of file
@@ -0,0 +1,47 @@
+""" Gunicorn configuration of the production serving mode, run from the project directory with
+`gunicorn -c gunicorn.conf.py`, PSC_SERVER_MODE selects wsgi (threaded workers) or asgi (event loop workers) """
+import multiprocessing
+import os
+
+SERVER_MODE = os.getenv('PSC_SERVER_MODE', 'wsgi')
+
+if SERVER_MODE == 'asgi':
+    # the async [POST] /prescriptions/async view waits external services on the event loop. The other views are
+    # sync DRF views, Django runs them with thread sensitive sync_to_async, one at a time on a single thread of the
+    # worker, so this mode is only meant for workers serving /prescriptions/async, send the rest to wsgi workers
+    wsgi_app = 'psction.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    # requests mostly wait external services, so each process serves several of them from threads
+    wsgi_app = 'psction.wsgi:application'
+    worker_class = 'gthread'
+    threads = int(os.getenv('PSC_THREADS', '8'))
+
+bind = os.getenv('PSC_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('PSC_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+backlog = int(os.getenv('PSC_BACKLOG', '2048'))
+keepalive = int(os.getenv('PSC_KEEPALIVE', '5'))
+
+# a worker silent longer than the biggest request budget is killed, on stop or reload (SIGHUP) workers finish
+# their requests for up to graceful_timeout seconds
+timeout = int(os.getenv('PSC_WORKER_TIMEOUT', '75'))
+graceful_timeout = int(os.getenv('PSC_GRACEFUL_TIMEOUT', '30'))
+
+# workers are restarted after max_requests requests (0 disables it), jitter avoids restarting all at once
+max_requests = int(os.getenv('PSC_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('PSC_MAX_REQUESTS_JITTER', '0'))
+
+# the application is loaded in each worker, so SIGHUP reloads code and settings
+preload_app = False
+
+accesslog = os.getenv('PSC_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.getenv('PSC_LOG_LEVEL', 'info')
+
+
+def post_worker_init(worker):
+    """ Warming a worker once the application is loaded and before it accepts requests """
+    from prescription.warmup import warm_up
+
+    summary = warm_up()
+    worker.log.info('Worker %s warmed up in %ss', worker.pid, summary['seconds'])
@@ -0,0 +1,20 @@
+""" Module to define api pagination """
+from django.conf import settings
+
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class PrescriptionCursorPagination(CursorPagination):
+    """ Class to paginate prescriptions by keyset on id, newest first, so a page costs the same at any depth """
+    ordering = '-id'
+    page_size = settings.PRESCRIPTION_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.PRESCRIPTION_MAX_PAGE_SIZE
+
+    def get_paginated_response(self, data):
+        return Response({
+            'data': data,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+        })
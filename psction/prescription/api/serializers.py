@@ -1,16 +1,44 @@
 """ Module to define api serializer to define api data sctructure and validations """
+import asyncio
+
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future
+from contextvars import copy_context
+
+from asgiref.sync import sync_to_async
+
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
 
 from rest_framework import serializers
+from rest_framework.fields import empty
+from rest_framework.fields import SkipField
+from rest_framework.fields import get_error_detail
 from rest_framework.utils.serializer_helpers import ReturnDict
 
 from prescription.models import Prescription
+from prescription.models import MetricOutbox
 
+from prescription.metrics import metric_dispatcher
+from prescription.writer import prescription_writer
+from prescription.instrumentation import timed
+from prescription.instrumentation import STAGE_SECONDS
+from prescription.tracing import span
+
+from prescription.utils import lookup_executor
 from prescription.utils import ExternalServiceContext
 
 
 class PrescriptionSerializer(serializers.Serializer):
     """ Class defining Prescription api schema """
+    LOOKUP_ENDPOINTS = {
+        'clinic': ('EXTERNAL_CLINIC', '/clinics/{id}/'),
+        'physician': ('EXTERNAL_PHYSICIAN', '/physicians/{id}/'),
+        'patient': ('EXTERNAL_PATIENT', '/patients/{id}/'),
+    }
+
     id = serializers.IntegerField(read_only=True)
     clinic = serializers.DictField(
         allow_empty=False,
@@ -46,16 +74,155 @@ class PrescriptionSerializer(serializers.Serializer):
             raise serializers.ValidationError(ReturnDict(error, serializer=self))
         return is_valid
 
+    def to_internal_value(self, data):
+        """ Override method to skip DRF field machinery for plainly valid data, clinic, physician and patient
+        are still validated by validate_<field> methods, any other data is validated by DRF fields """
+        if settings.EXTERNAL_PARALLEL_LOOKUPS and isinstance(data, Mapping):
+            self.prefetch_lookups(items=[data])
+        values = self.plain_values(data) if settings.PRESCRIPTION_FAST_PATH else None
+        if values is None:
+            return super().to_internal_value(data)
+        errors = OrderedDict()
+        for field_name in self.LOOKUP_ENDPOINTS:
+            try:
+                values[field_name] = getattr(self, f'validate_{field_name}')(values[field_name])
+            except serializers.ValidationError as exc:
+                errors[field_name] = exc.detail
+            except DjangoValidationError as exc:
+                errors[field_name] = get_error_detail(exc)
+        if errors:
+            raise serializers.ValidationError(errors)
+        return values
+
+    def to_representation(self, instance):
+        """ Override method to render saved prescriptions without DRF field machinery """
+        if not settings.PRESCRIPTION_FAST_PATH or not isinstance(instance, Prescription):
+            return super().to_representation(instance)
+        # ids of a just created prescription keep the type external services gave them, like DRF they are int
+        return OrderedDict((
+            ('id', None if instance.id is None else int(instance.id)),
+            ('clinic', {'id': None if instance.clinic_id is None else int(instance.clinic_id)}),
+            ('physician', {'id': None if instance.physician_id is None else int(instance.physician_id)}),
+            ('patient', {'id': None if instance.patient_id is None else int(instance.patient_id)}),
+            ('text', str(instance.description)),
+        ))
+
+    @classmethod
+    def plain_values(cls, data):
+        """ Method to get the field values of data when every field would pass DRF field validation unchanged,
+        None when a field needs DRF to coerce its value or to report its error """
+        if type(data) is not dict:
+            return None
+        values = OrderedDict()
+        for field_name in cls.LOOKUP_ENDPOINTS:
+            value = data.get(field_name)
+            if type(value) is not dict or not value:
+                return None
+            if any(type(key) is not str or type(item) is not int for key, item in value.items()):
+                return None
+            values[field_name] = dict(value)
+        text = data.get('text')
+        if type(text) is not str:
+            return None
+        text = text.strip()
+        if not text or len(text) > cls._declared_fields['text'].max_length or '\x00' in text:
+            return None
+        values['text'] = text
+        return values
+
+    @property
+    def lookups(self) -> dict:
+        """ Lookups already in flight, keyed by (field_name, resource_id), shared through context """
+        return self.context.setdefault('lookups', {})
+
+    def lookup_keys(self, data):
+        """ Method to yield (field_name, resource_id) of the lookups required by data """
+        values = self.plain_values(data) if settings.PRESCRIPTION_FAST_PATH else None
+        if values is not None:
+            for field_name in self.LOOKUP_ENDPOINTS:
+                if 'id' in values[field_name]:
+                    yield field_name, values[field_name]['id']
+            return
+        for field_name in self.LOOKUP_ENDPOINTS:
+            try:
+                value = self.fields[field_name].run_validation(data.get(field_name, empty))
+            except (serializers.ValidationError, SkipField):
+                continue
+            if 'id' in value:
+                yield field_name, value['id']
+
+    def prefetch_lookups(self, items):
+        """ Method to send every distinct lookup of items at the same time over the lookup thread pool,
+        validate_<field> methods will wait the result instead of doing the request again, each lookup
+        runs in a copy of current context to keep the request deadline """
+        executor = lookup_executor()
+        for data in items:
+            for key in self.lookup_keys(data):
+                if key not in self.lookups:
+                    self.lookups[key] = executor.submit(copy_context().run, self.fetch, *key)
+
+    async def aprefetch_lookups(self, items):
+        """ Coroutine to resolve every distinct lookup of items at the same time on the event loop,
+        results are kept as done futures so validate_<field> methods get them without blocking """
+        keys = list(dict.fromkeys(
+            key for data in items for key in self.lookup_keys(data) if key not in self.lookups
+        ))
+        results = await asyncio.gather(*[self.afetch(*key) for key in keys], return_exceptions=True)
+        for key, result in zip(keys, results):
+            future = self.lookups[key] = Future()
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def lookup(self, field_name, resource_id):
+        """ Method to get external resource using the prefetched lookup when exists """
+        with timed(STAGE_SECONDS, stage=f'validate_{field_name}'), span(f'validate_{field_name}', id=resource_id):
+            future = self.lookups.get((field_name, resource_id))
+            if future is not None:
+                return future.result()
+            return self.fetch(field_name, resource_id)
+
+    @classmethod
+    def fetch(cls, field_name, resource_id):
+        service, endpoint = cls.LOOKUP_ENDPOINTS[field_name]
+        return cls.external_request(
+            service=getattr(settings, service),
+            endpoint=endpoint.format(id=resource_id),
+            resource_id=resource_id,
+        )
+
+    @classmethod
+    async def afetch(cls, field_name, resource_id):
+        service, endpoint = cls.LOOKUP_ENDPOINTS[field_name]
+        return await cls.aexternal_request(
+            service=getattr(settings, service),
+            endpoint=endpoint.format(id=resource_id),
+            resource_id=resource_id,
+        )
+
     @staticmethod
-    def external_request(service, endpoint, method='GET', data=None):
+    def external_request(service, endpoint, method='GET', data=None, resource_id=None):
         manager = ExternalServiceContext(
             service=service,
             method=method,
             endpoint=endpoint,
             data=data,
+            resource_id=resource_id,
         )
         return manager.do_request()
 
+    @staticmethod
+    async def aexternal_request(service, endpoint, method='GET', data=None, resource_id=None):
+        manager = ExternalServiceContext(
+            service=service,
+            method=method,
+            endpoint=endpoint,
+            data=data,
+            resource_id=resource_id,
+        )
+        return await manager.ado_request()
+
     @staticmethod
     def get_metric_data(validated_data):
         try:
@@ -83,39 +250,168 @@ class PrescriptionSerializer(serializers.Serializer):
     def validate_clinic(self, value):
         if 'id' not in value:
             return None
-        return self.external_request(
-            service=settings.EXTERNAL_CLINIC,
-            endpoint=f'/clinics/{value["id"]}/',
-        )
+        return self.lookup('clinic', value['id'])
 
     def validate_physician(self, value):
         if 'id' not in value:
             raise serializers.ValidationError('')
-        return self.external_request(
-            service=settings.EXTERNAL_PHYSICIAN,
-            endpoint=f'/physicians/{value["id"]}/',
-        )
+        return self.lookup('physician', value['id'])
 
     def validate_patient(self, value):
         if 'id' not in value:
             raise serializers.ValidationError('')
-        return self.external_request(
-            service=settings.EXTERNAL_PATIENT,
-            endpoint=f'/patients/{value["id"]}/',
-        )
+        return self.lookup('patient', value['id'])
 
-    def create(self, validated_data):
-        _metric = self.external_request(
-            service=settings.EXTERNAL_METRIC,
-            endpoint=f'/metrics/',
-            method='POST',
-            data=self.get_metric_data(validated_data),
-        )
+    def record_metric(self, metric_data):
+        """ Method to deliver metric, on 'async' delivery it is queued and metric service errors don't fail request,
+        'outbox' delivery is saved by create in prescription transaction """
+        with timed(STAGE_SECONDS, stage='metric'), span('metric', delivery=settings.METRIC_DELIVERY):
+            if settings.METRIC_DELIVERY == 'async':
+                metric_dispatcher().submit(metric_data)
+                return
+            self.external_request(
+                service=settings.EXTERNAL_METRIC,
+                endpoint=f'/metrics/',
+                method='POST',
+                data=metric_data,
+            )
+
+    @classmethod
+    def record_metrics(cls, metrics: list) -> list:
+        """ Method to deliver the metrics of many prescriptions together, on 'async' delivery they are queued,
+        otherwise they are sent in one request when metric service has a batch_endpoint, or at the same time over
+        the lookup thread pool. It returns the ValidationError of each metric, None when it was delivered """
+        with timed(STAGE_SECONDS, stage='metric'), \
+                span('metric', delivery=settings.METRIC_DELIVERY, metrics=len(metrics)):
+            if settings.METRIC_DELIVERY == 'async':
+                for metric_data in metrics:
+                    metric_dispatcher().submit(metric_data)
+                return [None] * len(metrics)
+            batch_endpoint = settings.EXTERNAL_SERVICES[settings.EXTERNAL_METRIC].get('batch_endpoint')
+            if batch_endpoint:
+                try:
+                    cls.external_request(
+                        service=settings.EXTERNAL_METRIC,
+                        endpoint=batch_endpoint,
+                        method='POST',
+                        data=metrics,
+                    )
+                except serializers.ValidationError as exc:
+                    return [exc] * len(metrics)
+                return [None] * len(metrics)
+            futures = [
+                lookup_executor().submit(
+                    copy_context().run,
+                    cls.external_request,
+                    service=settings.EXTERNAL_METRIC,
+                    endpoint='/metrics/',
+                    method='POST',
+                    data=metric_data,
+                )
+                for metric_data in metrics
+            ]
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except serializers.ValidationError as exc:
+                    errors.append(exc)
+                    continue
+                errors.append(None)
+            return errors
 
-        request_data = {
-            'clinic_id': validated_data['clinic']['id'],
+    @staticmethod
+    def get_model_data(validated_data):
+        return {
+            'clinic_id': validated_data['clinic']['id'] if validated_data.get('clinic') else None,
             'physician_id': validated_data['physician']['id'],
             'patient_id': validated_data['patient']['id'],
             'description': validated_data['text'],
         }
-        return Prescription.objects.create(**request_data)
+
+    @staticmethod
+    def insert(request_data, metric_data=None):
+        """ Method to save prescription, with its metric outbox row in the same transaction when given """
+        with timed(STAGE_SECONDS, stage='insert'), span('insert', group_commit=settings.GROUP_COMMIT['enabled']):
+            if settings.GROUP_COMMIT['enabled']:
+                return prescription_writer().insert(Prescription(**request_data), outbox_payload=metric_data)
+            if metric_data is None:
+                return Prescription.objects.create(**request_data)
+            with transaction.atomic():
+                MetricOutbox.objects.create(payload=metric_data)
+                return Prescription.objects.create(**request_data)
+
+    def create(self, validated_data):
+        metric_data = self.get_metric_data(validated_data)
+
+        request_data = self.get_model_data(validated_data)
+        if settings.METRIC_DELIVERY == 'outbox':
+            return self.insert(request_data, metric_data=metric_data)
+
+        self.record_metric(metric_data)
+        return self.insert(request_data)
+
+    async def asave(self):
+        """ Coroutine counterpart of save, metric service is called without blocking and database access
+        runs in a thread """
+        validated_data = self.validated_data
+        if settings.METRIC_DELIVERY == 'sync':
+            metric_data = self.get_metric_data(validated_data)
+            with timed(STAGE_SECONDS, stage='metric'), span('metric', delivery=settings.METRIC_DELIVERY):
+                await self.aexternal_request(
+                    service=settings.EXTERNAL_METRIC,
+                    endpoint=f'/metrics/',
+                    method='POST',
+                    data=metric_data,
+                )
+            self.instance = await sync_to_async(self.insert)(self.get_model_data(validated_data))
+        else:
+            self.instance = await sync_to_async(self.create)(validated_data)
+        return self.instance
+
+    @classmethod
+    def bulk_create(cls, items: list, context: dict = None) -> list:
+        """ Method to validate and create many prescriptions looking up each distinct clinic, physician and patient
+        once, every item gets a result with its data or the error it would get on its own request """
+        context = dict(context or {}, lookups={})
+        cls(context=context).prefetch_lookups(items=[item for item in items if isinstance(item, Mapping)])
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            serializer = cls(data=item, context=context)
+            try:
+                if not isinstance(item, Mapping):
+                    raise serializers.ValidationError(
+                        detail={
+                            'error': {
+                                'message': 'malformed request',
+                                'code': '01',
+                            }
+                        },
+                    )
+                serializer.is_valid(raise_exception=True)
+                metric_data = serializer.get_metric_data(serializer.validated_data)
+            except serializers.ValidationError as exc:
+                results[index] = exc.detail
+                continue
+            valid.append((index, serializer, metric_data))
+
+        if settings.METRIC_DELIVERY != 'outbox' and valid:
+            errors = cls.record_metrics([metric_data for _, _, metric_data in valid])
+            for (index, _, _), error in zip(valid, errors):
+                if error is not None:
+                    results[index] = error.detail
+            valid = [entry for entry, error in zip(valid, errors) if error is None]
+
+        with transaction.atomic():
+            instances = Prescription.objects.bulk_insert(
+                [Prescription(**cls.get_model_data(serializer.validated_data)) for _, serializer, _ in valid],
+            )
+            if settings.METRIC_DELIVERY == 'outbox':
+                MetricOutbox.objects.bulk_create(
+                    [MetricOutbox(payload=metric_data) for _, _, metric_data in valid],
+                )
+        for (index, serializer, _), instance in zip(valid, instances):
+            serializer.instance = instance
+            results[index] = {'data': serializer.data}
+        return results
@@ -1,11 +1,31 @@
 """ Module to define API Test Cases """
+import csv
+import json
+import os
+import tempfile
+import threading
+import time
+
+from unittest.mock import Mock
 from unittest.mock import patch
+from django.conf import settings
 from django.test import TestCase
+from django.test import override_settings
 
 from rest_framework import status
+from rest_framework import serializers
 
 from prescription.exceptions import ExternalApiError, ExternalResourceNotFound
 from prescription.models import Prescription
+from prescription.models import MetricOutbox
+from prescription.api.serializers import PrescriptionSerializer
+from prescription.breaker import reset_breakers
+from prescription.cache import clear_caches
+from prescription.limiter import reset_limiters
+from prescription.limiter import service_limiter
+from prescription.tracing import JsonlExporter
+from prescription.writer import GroupCommitWriter
+from prescription.writer import WriterUnavailable
 
 from prescription.utils import MetricExternalService
 from prescription.utils import ClientExternalService
@@ -13,6 +33,7 @@ from prescription.utils import PatientExternalService
 from prescription.utils import PhysicianExternalService
 
 
+@override_settings(METRIC_DELIVERY='sync')
 class TestApiPrescriptionEndpoint(TestCase):
     """ Test for tests /prescriptions endpoint cases """
     ENDPOINT = '/prescriptions'
@@ -92,12 +113,10 @@ class TestApiPrescriptionEndpoint(TestCase):
             service_physician.assert_called_once()
         self.assertJSONEqual(raw=response.content, expected_data=self.response)
 
-    def test_should_only_accept_post_method(self):
+    def test_should_only_accept_post_and_get_methods(self):
         invalid_method = [
-            'get',
             'put',
             'patch',
-            'head',
             'delete',
         ]
         for method in invalid_method:
@@ -251,6 +270,23 @@ class TestApiPrescriptionEndpoint(TestCase):
                     content_type='application/json',
                 )
 
+    def test_should_save_prescription_without_clinic_when_clinic_service_fails(self):
+        """ Testing that clinic not found or not available doesn't fail request, prescription and metric are
+        saved without clinic """
+        for error in [ExternalResourceNotFound, ExternalApiError(status=503)]:
+            with patch.object(PrescriptionSerializer, 'record_metric') as record_metric, \
+                 patch.object(ClientExternalService, '_api_request', side_effect=error), \
+                 patch.object(PatientExternalService, 'do_request', return_value=self.FAKE_PATIENT_RESPONSE), \
+                 patch.object(PhysicianExternalService, 'do_request', return_value=self.FAKE_PHYSICIAN_RESPONSE):
+                response = self.client.post(
+                    path=self.ENDPOINT,
+                    data=self.test_data,
+                    content_type='application/json',
+                )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertIsNone(Prescription.objects.get(id=response.json()['data']['id']).clinic_id)
+            self.assertIsNone(record_metric.call_args.args[0]['clinic_id'])
+
     def test_should_response_code_error_seven_when_some_service_give_info_with_unexpected_schema(self):
         """ Testing case where some patient, physician or client service give unexpected dictionary of data
         unable to create metrics information, server should response with error code 07 """
@@ -291,4 +327,728 @@ class TestApiPrescriptionEndpoint(TestCase):
                 data=self.test_data,
                 content_type='application/json',
             )
-            self.assertJSONEqual(raw=response.content, expected_data=error_response)
\ No newline at end of file
+            self.assertJSONEqual(raw=response.content, expected_data=error_response)
+
+
+@override_settings(EXTERNAL_PARALLEL_LOOKUPS=True)
+class TestApiPrescriptionParallelLookups(TestApiPrescriptionEndpoint):
+    """ Run /prescriptions endpoint cases with clinic, physician and patient lookups in parallel """
+
+    def test_should_send_lookups_at_same_time(self):
+        """ Testing that the three lookups are in flight together, a sequential run would break the barrier """
+        barrier = threading.Barrier(3, timeout=5)
+
+        def wait_lookups(response):
+            def do_request(*args, **kwargs):
+                barrier.wait()
+                return response
+            return do_request
+
+        with patch.object(MetricExternalService, 'do_request', return_value=self.FAKE_METRIC_RESPONSE), \
+             patch.object(ClientExternalService, 'do_request', wait_lookups(self.FAKE_CLINIC_RESPONSE)), \
+             patch.object(PatientExternalService, 'do_request', wait_lookups(self.FAKE_PATIENT_RESPONSE)), \
+             patch.object(PhysicianExternalService, 'do_request', wait_lookups(self.FAKE_PHYSICIAN_RESPONSE)):
+            response = self.client.post(
+                path=self.ENDPOINT,
+                data=self.test_data,
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertJSONEqual(raw=response.content, expected_data=self.response)
+
+
+@override_settings(PRESCRIPTION_FAST_PATH=False)
+class TestApiPrescriptionDRFValidation(TestApiPrescriptionEndpoint):
+    """ Run /prescriptions endpoint cases validating and rendering through DRF fields only """
+
+
+class TestPrescriptionSerializerFastPath(TestCase):
+    """ Test fast path validation and rendering give the same results as DRF fields """
+    VALID = {'clinic': {'id': 1}, 'physician': {'id': 1}, 'patient': {'id': 1}, 'text': 'Dipirona 1x ao dia'}
+    PAYLOADS = [
+        VALID,
+        dict(VALID, text='  Dipirona  ', extra=True),
+        dict(VALID, clinic={'name': 'no id'}),
+        dict(VALID, physician={'name': 'no id'}),
+        dict(VALID, physician={'id': 404}),
+        dict(VALID, physician={'id': 404}, patient={'id': 404}),
+        dict(VALID, physician={'id': '1'}),
+        dict(VALID, patient={'id': True}),
+        dict(VALID, patient={}),
+        dict(VALID, patient=[1]),
+        dict(VALID, text=''),
+        dict(VALID, text='x' * 501),
+        dict(VALID, text=None),
+        dict(VALID, text=1),
+        {key: value for key, value in VALID.items() if key != 'text'},
+        [VALID],
+    ]
+
+    @staticmethod
+    def lookup(field_name, resource_id):
+        if resource_id == 404:
+            raise serializers.ValidationError(
+                detail={'error': {'message': f'{field_name} not found', 'code': '02'}},
+            )
+        return {'id': str(resource_id), 'field': field_name}
+
+    def validate(self, payload, fast_path):
+        with override_settings(PRESCRIPTION_FAST_PATH=fast_path), \
+             patch.object(PrescriptionSerializer, 'lookup', side_effect=self.lookup):
+            serializer = PrescriptionSerializer(data=payload)
+            is_valid = serializer.is_valid()
+            return is_valid, serializer.errors, serializer.validated_data if is_valid else None
+
+    def test_should_validate_like_drf_fields(self):
+        for payload in self.PAYLOADS:
+            with self.subTest(payload=payload):
+                self.assertEqual(self.validate(payload, fast_path=True), self.validate(payload, fast_path=False))
+
+    def test_should_render_like_drf_fields(self):
+        instances = [
+            Prescription(id=1, clinic_id=None, physician_id=2, patient_id=3, description='saved'),
+            Prescription(id=2, clinic_id='1', physician_id='2', patient_id='3', description='just created'),
+        ]
+        for instance in instances:
+            with override_settings(PRESCRIPTION_FAST_PATH=False):
+                expected = PrescriptionSerializer(instance).data
+            self.assertEqual(PrescriptionSerializer(instance).data, expected)
+            self.assertEqual(PrescriptionSerializer(instances, many=True).data[0].keys(), expected.keys())
+
+
+@override_settings(METRIC_DELIVERY='async')
+class TestApiPrescriptionAsyncMetrics(TestCase):
+    """ Test /prescriptions endpoint with metrics queued out of the request path """
+    ENDPOINT = TestApiPrescriptionEndpoint.ENDPOINT
+
+    def setUp(self):
+        self.test_data = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+
+    def test_should_create_prescription_when_metric_service_is_not_available(self):
+        """ Testing that metric is queued and code 04 is not returned on async delivery """
+        with patch.object(MetricExternalService, '_api_request', side_effect=ExternalApiError) as service_metric, \
+             patch('prescription.api.serializers.metric_dispatcher') as dispatcher, \
+             patch.object(ClientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE), \
+             patch.object(PatientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE), \
+             patch.object(PhysicianExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE):
+            response = self.client.post(
+                path=self.ENDPOINT,
+                data=self.test_data,
+                content_type='application/json',
+            )
+            service_metric.assert_not_called()
+            dispatcher.return_value.submit.assert_called_once()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Prescription.objects.count(), 1)
+        metric = dispatcher.return_value.submit.call_args[0][0]
+        self.assertEqual(metric['physician_name'], TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE['name'])
+
+
+@override_settings(METRIC_DELIVERY='outbox')
+class TestApiPrescriptionOutboxMetrics(TestApiPrescriptionAsyncMetrics):
+    """ Test /prescriptions endpoint with metrics saved on outbox table """
+
+    def test_should_create_prescription_when_metric_service_is_not_available(self):
+        """ Testing that metric is saved with prescription and metric service is not called """
+        with patch.object(MetricExternalService, '_api_request', side_effect=ExternalApiError) as service_metric, \
+             patch.object(ClientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE), \
+             patch.object(PatientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE), \
+             patch.object(PhysicianExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE):
+            response = self.client.post(
+                path=self.ENDPOINT,
+                data=self.test_data,
+                content_type='application/json',
+            )
+            service_metric.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Prescription.objects.count(), 1)
+        metric = MetricOutbox.objects.get()
+        self.assertEqual(metric.payload['physician_name'], TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE['name'])
+        self.assertIsNone(metric.delivered_at)
+
+
+@override_settings(METRIC_DELIVERY='sync')
+class TestApiPrescriptionDeadline(TestCase):
+    """ Test /prescriptions endpoint external requests share the request time budget """
+    ENDPOINT = TestApiPrescriptionEndpoint.ENDPOINT
+    RESPONSES = {
+        'clinics': TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE,
+        'physicians': TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE,
+        'patients': TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE,
+        'metrics': TestApiPrescriptionEndpoint.FAKE_METRIC_RESPONSE,
+    }
+
+    def setUp(self):
+        self.test_data = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+        self.timeouts = []
+        self.slow_resource = None
+        clear_caches()
+        self.addCleanup(clear_caches)
+        reset_breakers()
+        self.addCleanup(reset_breakers)
+
+    def fake_api_request(self, request_obj, timeout, **kwargs):
+        self.timeouts.append(timeout)
+        resource = request_obj.selector.strip('/').split('/')[0]
+        if resource == self.slow_resource:
+            time.sleep(timeout)
+        return self.RESPONSES[resource]
+
+    def post(self, **headers):
+        with patch('prescription.utils.api_request', side_effect=self.fake_api_request):
+            return self.client.post(self.ENDPOINT, data=self.test_data, content_type='application/json', **headers)
+
+    def test_should_give_external_requests_the_time_left(self):
+        for parallel in (False, True):
+            self.timeouts.clear()
+            clear_caches()
+            with override_settings(EXTERNAL_PARALLEL_LOOKUPS=parallel):
+                response = self.post(HTTP_X_REQUEST_TIMEOUT='2')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(len(self.timeouts), 4)
+            self.assertTrue(all(0 < timeout <= 2 for timeout in self.timeouts), self.timeouts)
+
+    def test_should_fail_fast_once_budget_ran_out(self):
+        """ Testing that a physician lookup taking the whole budget makes patient lookup fail without being sent """
+        self.slow_resource = 'physicians'
+        response = self.post(HTTP_X_REQUEST_TIMEOUT='0.2')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['error']['code'], '06')
+        self.assertEqual(len(self.timeouts), 2)
+        self.assertEqual(Prescription.objects.count(), 0)
+
+    def test_should_bound_header_budget(self):
+        response = self.post(HTTP_X_REQUEST_TIMEOUT='3600')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(all(timeout <= 30 for timeout in self.timeouts), self.timeouts)
+
+
+class TestApiPrescriptionLoadShedding(TestCase):
+    """ Test /prescriptions endpoint fails fast when an external service has no free request slot """
+    ENDPOINT = TestApiPrescriptionEndpoint.ENDPOINT
+
+    def setUp(self):
+        self.test_data = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+        self.resources = []
+        clear_caches()
+        self.addCleanup(clear_caches)
+        reset_limiters()
+        self.addCleanup(reset_limiters)
+
+    def fake_api_request(self, request_obj, **kwargs):
+        resource = request_obj.selector.strip('/').split('/')[0]
+        self.resources.append(resource)
+        return TestApiPrescriptionDeadline.RESPONSES[resource]
+
+    def test_should_reject_lookup_of_saturated_service(self):
+        services = {name: dict(config) for name, config in settings.EXTERNAL_SERVICES.items()}
+        limit = {'enabled': True, 'max_concurrency': 1, 'max_queue': 1, 'queue_timeout': 0.05}
+        services[settings.EXTERNAL_PHYSICIAN]['limit'] = limit
+        with override_settings(EXTERNAL_SERVICES=services), \
+                patch('prescription.utils.api_request', side_effect=self.fake_api_request):
+            limiter = service_limiter('physician', services[settings.EXTERNAL_PHYSICIAN])
+            limiter.acquire()
+            try:
+                response = self.client.post(self.ENDPOINT, data=self.test_data, content_type='application/json')
+            finally:
+                limiter.release()
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.json()['error']['code'], '05')
+            self.assertNotIn('physicians', self.resources)
+            self.assertEqual(limiter.snapshot()['timed_out'], 1)
+
+            response = self.client.post(self.ENDPOINT, data=self.test_data, content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+@override_settings(METRIC_DELIVERY='sync')
+class TestApiPrescriptionTracing(TestCase):
+    """ Test /prescriptions endpoint requests are traced with nested spans """
+    ENDPOINT = TestApiPrescriptionEndpoint.ENDPOINT
+
+    def setUp(self):
+        self.test_data = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+        self.trace_headers = []
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.exporter = JsonlExporter(os.path.join(directory.name, 'traces.jsonl'), flush_interval=0.01)
+        clear_caches()
+        self.addCleanup(clear_caches)
+
+    def fake_urlopen(self, request_obj, timeout):
+        self.trace_headers.append(request_obj.get_header('X-trace-id'))
+        resource = request_obj.selector.strip('/').split('/')[0]
+        response = Mock(status=status.HTTP_200_OK)
+        response.read.return_value = json.dumps(TestApiPrescriptionDeadline.RESPONSES[resource]).encode()
+        return response
+
+    def post(self, **headers):
+        with override_settings(TRACING=dict(settings.TRACING, enabled=True)), \
+                patch('prescription.tracing.span_exporter', return_value=self.exporter), \
+                patch('prescription.utils.urlopen', side_effect=self.fake_urlopen):
+            response = self.client.post(self.ENDPOINT, data=self.test_data, content_type='application/json', **headers)
+        self.exporter.close()
+        with open(self.exporter.path) as file:
+            return response, [json.loads(line) for line in file]
+
+    def test_should_trace_request_spans(self):
+        response, spans = self.post()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        trace_id = response['X-Trace-Id']
+        self.assertEqual({span['trace_id'] for span in spans}, {trace_id})
+        self.assertEqual(self.trace_headers, [trace_id] * 4)
+
+        names = [span['name'] for span in spans]
+        for name, count in (('POST /prescriptions', 1), ('PrescriptionViewSet.create', 1), ('validate_physician', 1),
+                            ('ExternalServiceContext.do_request', 4), ('api_request', 4), ('metric', 1),
+                            ('insert', 1)):
+            self.assertEqual(names.count(name), count, name)
+        by_id = {span['span_id']: span for span in spans}
+        root = next(span for span in spans if span['parent_id'] is None)
+        self.assertEqual(root['attributes']['status'], status.HTTP_201_CREATED)
+        for span in spans:
+            if span is not root:
+                self.assertIn(span['parent_id'], by_id)
+        physician = next(span for span in spans if span['name'] == 'api_request'
+                         and span['attributes']['service'] == 'physician')
+        self.assertEqual(physician['attributes']['endpoint'], '/physicians/1/')
+        self.assertEqual(physician['attributes']['status'], status.HTTP_200_OK)
+        self.assertGreater(physician['attributes']['bytes'], 0)
+        self.assertEqual(by_id[by_id[physician['parent_id']]['parent_id']]['name'], 'validate_physician')
+
+    def test_should_keep_trace_id_of_request(self):
+        trace_id = 'a' * 32
+        response, spans = self.post(HTTP_X_TRACE_ID=trace_id)
+        self.assertEqual(response['X-Trace-Id'], trace_id)
+        self.assertEqual({span['trace_id'] for span in spans}, {trace_id})
+
+    def test_should_not_trace_when_disabled(self):
+        with patch('prescription.tracing.span_exporter') as exporter, \
+                patch('prescription.utils.urlopen', side_effect=self.fake_urlopen):
+            response = self.client.post(self.ENDPOINT, data=self.test_data, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(response.has_header('X-Trace-Id'))
+        self.assertEqual(self.trace_headers, [None] * 4)
+        exporter.assert_not_called()
+
+
+@override_settings(METRIC_DELIVERY='sync')
+class TestApiPrescriptionIdempotency(TestCase):
+    """ Test /prescriptions endpoint requests with Idempotency-Key header """
+    ENDPOINT = TestApiPrescriptionEndpoint.ENDPOINT
+
+    def setUp(self):
+        self.test_data = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+
+    def post(self, data, key='retry-1', physician=TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE):
+        with patch.object(MetricExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_METRIC_RESPONSE) as service_metric, \
+             patch.object(ClientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE), \
+             patch.object(PatientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE), \
+             patch.object(PhysicianExternalService, 'do_request', **physician) as service_physician:
+            response = self.client.post(
+                self.ENDPOINT,
+                data=data,
+                content_type='application/json',
+                HTTP_IDEMPOTENCY_KEY=key,
+            )
+        return response, service_physician.call_count + service_metric.call_count
+
+    def test_should_replay_stored_response(self):
+        """ Testing that a retry gets the first response without external requests nor a new prescription """
+        response, calls = self.post(self.test_data, physician={'return_value': {'id': '1', 'name': 'A', 'crm': '1'}})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(calls, 2)
+        replay, calls = self.post(self.test_data)
+        self.assertEqual(replay.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertJSONEqual(raw=replay.content, expected_data=response.json())
+        self.assertEqual(calls, 0)
+        self.assertEqual(Prescription.objects.count(), 1)
+
+    def test_should_reject_key_reused_with_another_body(self):
+        self.post(self.test_data, physician={'return_value': TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE})
+        response, calls = self.post(dict(self.test_data, text='Other'))
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(response.json()['error']['code'], '08')
+        self.assertEqual(calls, 0)
+
+    def test_should_do_work_again_after_failed_request(self):
+        response, _ = self.post(self.test_data, physician={'side_effect': serializers.ValidationError(
+            detail={'error': {'message': 'physicians service not available', 'code': '05'}},
+        )})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response, calls = self.post(self.test_data, physician={
+            'return_value': TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE,
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(calls, 2)
+        self.assertEqual(Prescription.objects.count(), 1)
+
+    def test_should_do_work_again_after_database_was_busy(self):
+        """ Testing that a prescription not saved in time gets error 10 and its key is released for the retry """
+        physician = {'return_value': TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE}
+        with override_settings(GROUP_COMMIT=dict(settings.GROUP_COMMIT, enabled=True)), \
+                patch.object(GroupCommitWriter, 'insert', side_effect=WriterUnavailable):
+            response, _ = self.post(self.test_data, physician=physician)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertJSONEqual(
+            raw=response.content,
+            expected_data={'error': {'message': 'database not available', 'code': '10'}},
+        )
+        response, _ = self.post(self.test_data, physician=physician)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Prescription.objects.count(), 1)
+
+    def test_should_reject_too_long_key(self):
+        response, calls = self.post(self.test_data, key='k' * 256)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()['error']['code'], '01')
+
+
+@override_settings(METRIC_DELIVERY='sync')
+class TestApiPrescriptionBulkEndpoint(TestCase):
+    """ Test for /prescriptions/bulk endpoint cases """
+    ENDPOINT = '/prescriptions/bulk'
+
+    def setUp(self):
+        self.item = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+
+    def post_bulk(self, data):
+        def patient_request(service):
+            if service.request_obj.full_url.endswith('/patients/2/'):
+                raise serializers.ValidationError({'error': {'message': 'patient not found', 'code': '03'}})
+            return TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE
+
+        with patch.object(MetricExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_METRIC_RESPONSE) as service_metric, \
+             patch.object(ClientExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE) as service_client, \
+             patch.object(PatientExternalService, 'do_request', autospec=True,
+                          side_effect=patient_request) as service_patient, \
+             patch.object(PhysicianExternalService, 'do_request',
+                          return_value=TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE) as service_physician:
+            response = self.client.post(
+                path=self.ENDPOINT,
+                data=data,
+                content_type='application/json',
+            )
+            self.calls = {
+                'metric': service_metric.call_count,
+                'clinic': service_client.call_count,
+                'patient': service_patient.call_count,
+                'physician': service_physician.call_count,
+            }
+        return response
+
+    def test_should_only_accept_post_method(self):
+        response = self.client.get(path=self.ENDPOINT)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_should_create_prescriptions_looking_up_each_resource_once(self):
+        """ Testing that distinct resources are looked up once and each item gets its result """
+        items = [self.item, dict(self.item, text='Paracetamol'), dict(self.item, patient={'id': 2})]
+        response = self.post_bulk(data=items)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.calls, {'metric': 2, 'clinic': 1, 'patient': 2, 'physician': 1})
+        created = list(Prescription.objects.order_by('id'))
+        self.assertEqual([prescription.description for prescription in created], ['Dipirona 1x ao dia', 'Paracetamol'])
+        self.assertJSONEqual(raw=response.content, expected_data={
+            'data': [
+                {'data': dict(self.item, id=created[0].id)},
+                {'data': dict(self.item, text='Paracetamol', id=created[1].id)},
+                {'error': {'message': 'patient not found', 'code': '03'}},
+            ],
+        })
+
+    def test_should_send_metrics_of_items_in_one_request_with_batch_endpoint(self):
+        """ Testing that metrics of valid items are sent together instead of one request per item """
+        metric = dict(settings.EXTERNAL_SERVICES[settings.EXTERNAL_METRIC], batch_endpoint='/metrics/batch/')
+        services = dict(settings.EXTERNAL_SERVICES, **{settings.EXTERNAL_METRIC: metric})
+        with override_settings(EXTERNAL_SERVICES=services):
+            response = self.post_bulk(data=[dict(self.item, text=f'{number}') for number in range(5)])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.calls['metric'], 1)
+        self.assertEqual(Prescription.objects.count(), 5)
+
+    def test_should_fail_only_items_whose_metric_fails(self):
+        """ Testing that metrics are sent one per item and a failed one gives code 04 to its item only """
+        def metric_request(service):
+            if service.request_obj.data and b'"patient_id": "2"' in service.request_obj.data:
+                raise serializers.ValidationError(
+                    {'error': {'message': 'metrics service not available', 'code': '04'}})
+            return TestApiPrescriptionEndpoint.FAKE_METRIC_RESPONSE
+
+        def patient_request(service):
+            patient_id = service.request_obj.full_url.split('/')[-2]
+            return dict(TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE, id=patient_id)
+
+        with patch.object(PatientExternalService, 'do_request', autospec=True, side_effect=patient_request), \
+                patch.object(MetricExternalService, 'do_request', autospec=True,
+                             side_effect=metric_request) as metric, \
+                patch.object(ClientExternalService, 'do_request',
+                             return_value=TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE), \
+                patch.object(PhysicianExternalService, 'do_request',
+                             return_value=TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE):
+            response = self.client.post(
+                path=self.ENDPOINT,
+                data=[dict(self.item, patient={'id': number}) for number in range(1, 4)],
+                content_type='application/json',
+            )
+        self.assertEqual(metric.call_count, 3)
+        results = response.json()['data']
+        self.assertEqual(results[1], {'error': {'message': 'metrics service not available', 'code': '04'}})
+        self.assertEqual([prescription.patient_id for prescription in Prescription.objects.order_by('id')], [1, 3])
+
+    def test_should_response_code_one_for_malformed_items(self):
+        """ Testing that malformed items get code 01 and don't stop valid ones """
+        response = self.post_bulk(data=[1, {'clinic': 1}, self.item])
+        results = response.json()['data']
+        self.assertEqual(results[0], {'error': {'message': 'malformed request', 'code': '01'}})
+        self.assertEqual(results[1], {'error': {'message': 'malformed request', 'code': '01'}})
+        self.assertIn('data', results[2])
+        self.assertEqual(Prescription.objects.count(), 1)
+
+    def test_should_response_code_one_when_body_is_not_a_list(self):
+        """ Testing that body must be a non empty list """
+        for data in [self.item, []]:
+            response = self.post_bulk(data=data)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertJSONEqual(raw=response.content, expected_data={
+                'error': {'message': 'malformed request', 'code': '01'},
+            })
+
+
+@override_settings(METRIC_DELIVERY='sync')
+class TestApiAsyncPrescriptionEndpoint(TestCase):
+    """ Test for /prescriptions/async endpoint, it should behave as /prescriptions """
+    ENDPOINT = '/prescriptions/async'
+
+    def setUp(self):
+        self.test_data = {
+            'clinic': {'id': 1},
+            'physician': {'id': 1},
+            'patient': {'id': 1},
+            'text': 'Dipirona 1x ao dia',
+        }
+
+    def post(self, data, headers=None, **responses):
+        services = {
+            'metric': (MetricExternalService, TestApiPrescriptionEndpoint.FAKE_METRIC_RESPONSE),
+            'clinic': (ClientExternalService, TestApiPrescriptionEndpoint.FAKE_CLINIC_RESPONSE),
+            'patient': (PatientExternalService, TestApiPrescriptionEndpoint.FAKE_PATIENT_RESPONSE),
+            'physician': (PhysicianExternalService, TestApiPrescriptionEndpoint.FAKE_PHYSICIAN_RESPONSE),
+        }
+        patches = [
+            patch.object(strategy, '_async_api_request', **(
+                {'side_effect': responses[name]} if name in responses else {'return_value': response}
+            ))
+            for name, (strategy, response) in services.items()
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return self.client.post(
+            path=self.ENDPOINT,
+            data=data,
+            content_type='application/json',
+            **(headers or {}),
+        )
+
+    def test_should_create_prescription(self):
+        response = self.post(data=self.test_data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        prescription = Prescription.objects.get()
+        self.assertJSONEqual(raw=response.content, expected_data={'data': dict(self.test_data, id=prescription.id)})
+
+    def test_should_response_same_error_codes(self):
+        """ Testing error codes 01, 02, 03, 04, 05, 06 """
+        cases = [
+            ({}, {'physician': ExternalResourceNotFound}, {'message': 'physician not found', 'code': '02'}),
+            ({}, {'patient': ExternalResourceNotFound}, {'message': 'patient not found', 'code': '03'}),
+            ({}, {'metric': ExternalApiError}, {'message': 'metrics service not available', 'code': '04'}),
+            ({}, {'physician': ExternalApiError}, {'message': 'physicians service not available', 'code': '05'}),
+            ({}, {'patient': ExternalApiError}, {'message': 'patients service not available', 'code': '06'}),
+        ]
+        for overrides, responses, error in cases:
+            with self.subTest(error=error):
+                response = self.post(data=dict(self.test_data, **overrides), **responses)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertJSONEqual(raw=response.content, expected_data={'error': error})
+        for data in [{'clinic': 1}, {}]:
+            with self.subTest(data=data):
+                response = self.post(data=data)
+                error = {'message': 'malformed request', 'code': '01'}
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertJSONEqual(raw=response.content, expected_data={'error': error})
+        self.assertEqual(Prescription.objects.count(), 0)
+
+    @override_settings(GROUP_COMMIT={'enabled': True})
+    def test_should_response_code_ten_when_database_is_busy(self):
+        with patch.object(GroupCommitWriter, 'insert', side_effect=WriterUnavailable):
+            response = self.post(data=self.test_data)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertJSONEqual(
+            raw=response.content,
+            expected_data={'error': {'message': 'database not available', 'code': '10'}},
+        )
+
+    def test_should_replay_stored_response_of_idempotency_key(self):
+        """ Testing that a retry with the same Idempotency-Key gets the first response without a new prescription """
+        response = self.post(data=self.test_data, headers={'HTTP_IDEMPOTENCY_KEY': 'retry-1'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        replay = self.post(data=self.test_data, headers={'HTTP_IDEMPOTENCY_KEY': 'retry-1'},
+                           physician=ExternalApiError)
+        self.assertEqual(replay.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertJSONEqual(raw=replay.content, expected_data=response.json())
+        self.assertEqual(Prescription.objects.count(), 1)
+        response = self.post(data=dict(self.test_data, text='Other'), headers={'HTTP_IDEMPOTENCY_KEY': 'retry-1'})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(response.json()['error']['code'], '08')
+
+    def test_should_do_work_again_after_failed_request_of_idempotency_key(self):
+        response = self.post(data=self.test_data, headers={'HTTP_IDEMPOTENCY_KEY': 'retry-1'},
+                             physician=ExternalApiError)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post(data=self.test_data, headers={'HTTP_IDEMPOTENCY_KEY': 'retry-1'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Prescription.objects.count(), 1)
+
+    def test_should_only_accept_post_method(self):
+        response = self.client.get(path=self.ENDPOINT)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class TestApiPrescriptionReadEndpoint(TestCase):
+    """ Test for [GET] /prescriptions and /prescriptions/{id} endpoints """
+    ENDPOINT = '/prescriptions'
+
+    def setUp(self):
+        self.prescriptions = Prescription.objects.bulk_insert([
+            Prescription(clinic_id=number % 2, physician_id=number % 3, patient_id=number, description=f'{number}')
+            for number in range(7)
+        ])
+
+    def representation(self, prescription):
+        return {
+            'id': prescription.id,
+            'clinic': {'id': prescription.clinic_id},
+            'physician': {'id': prescription.physician_id},
+            'patient': {'id': prescription.patient_id},
+            'text': prescription.description,
+        }
+
+    def test_should_retrieve_prescription(self):
+        prescription = self.prescriptions[3]
+        response = self.client.get(f'{self.ENDPOINT}/{prescription.id}')
+        self.assertJSONEqual(raw=response.content, expected_data={'data': self.representation(prescription)})
+        response = self.client.get(f'{self.ENDPOINT}/0')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_should_list_newest_first_following_cursor(self):
+        """ Testing that pages follow next cursor until every prescription is listed """
+        ids = []
+        url = f'{self.ENDPOINT}?page_size=3'
+        while url:
+            response = self.client.get(url).json()
+            self.assertLessEqual(len(response['data']), 3)
+            ids.extend(item['id'] for item in response['data'])
+            url = response['next']
+        self.assertEqual(ids, sorted((prescription.id for prescription in self.prescriptions), reverse=True))
+
+    def test_should_filter_by_patient_physician_and_clinic(self):
+        response = self.client.get(self.ENDPOINT, {'physician': 0, 'clinic': 0}).json()
+        expected = [
+            self.representation(prescription) for prescription in reversed(self.prescriptions)
+            if prescription.physician_id == 0 and prescription.clinic_id == 0
+        ]
+        self.assertEqual(response['data'], expected)
+        response = self.client.get(self.ENDPOINT, {'patient': 5}).json()
+        self.assertEqual(response['data'], [self.representation(self.prescriptions[5])])
+
+    def test_should_response_code_one_for_malformed_filters(self):
+        response = self.client.get(self.ENDPOINT, {'patient': 'one'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertJSONEqual(raw=response.content, expected_data={
+            'error': {'message': 'malformed request', 'code': '01'},
+        })
+
+
+class TestApiPrescriptionExportEndpoint(TestCase):
+    """ Test for [GET] /prescriptions/export endpoint """
+    ENDPOINT = '/prescriptions/export'
+
+    def setUp(self):
+        self.prescriptions = Prescription.objects.bulk_insert([
+            Prescription(
+                clinic_id=None if number == 0 else 1, physician_id=2, patient_id=number, description=f'{number}',
+            )
+            for number in range(5)
+        ])
+
+    def test_should_stream_ndjson_in_id_range(self):
+        first, last = self.prescriptions[1].id, self.prescriptions[3].id
+        response = self.client.get(self.ENDPOINT, {'id_from': first, 'id_to': last})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line['id'] for line in lines], list(range(first, last + 1)))
+        self.assertEqual(lines[0]['text'], '1')
+        self.assertEqual(set(lines[0]), {'id', 'clinic_id', 'physician_id', 'patient_id', 'text', 'created_at'})
+
+    def test_should_stream_csv_in_created_range(self):
+        Prescription.objects.filter(id=self.prescriptions[0].id).update(created_at='2020-01-01T10:00:00Z')
+        response = self.client.get(self.ENDPOINT, {'output': 'csv', 'created_from': '2020-01-01',
+                                                   'created_to': '2020-01-02'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'clinic_id', 'physician_id', 'patient_id', 'text', 'created_at'])
+        self.assertEqual(rows[1:], [[str(self.prescriptions[0].id), '', '2', '0', '0', '2020-01-01T10:00:00+00:00']])
+
+    def test_should_response_code_one_for_malformed_params(self):
+        for params in [{'output': 'xml'}, {'id_from': 'one'}, {'created_from': 'yesterday'}]:
+            response = self.client.get(self.ENDPOINT, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertJSONEqual(raw=response.content, expected_data={
+                'error': {'message': 'malformed request', 'code': '01'},
+            })
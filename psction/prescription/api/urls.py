@@ -5,13 +5,17 @@ from django.views.generic import TemplateView
 
 from rest_framework.routers import SimpleRouter
 
+from prescription.api.views import create_prescription
 from prescription.api.viewsets import PrescriptionViewSet
 
 router = SimpleRouter(trailing_slash=False)
 router.register(prefix='prescriptions', viewset=PrescriptionViewSet)
 
 app_name = 'prescription_api'
-urlpatterns = router.urls
+urlpatterns = [
+    path('prescriptions/async', create_prescription, name='prescription-async'),
+]
+urlpatterns.extend(router.urls)
 
 urlpatterns.extend(
     [
@@ -0,0 +1,80 @@
+""" Module to define async api views, served without blocking a worker thread when running over ASGI """
+import json
+
+from collections.abc import Mapping
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from rest_framework import status
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+from prescription.api.serializers import PrescriptionSerializer
+from prescription.deadline import deadline
+from prescription.deadline import request_budget
+from prescription.idempotency import aidempotent_call
+from prescription.tracing import span
+from prescription.tracing import trace
+from prescription.writer import WriterUnavailable
+
+
+def render(data, status_code: int) -> HttpResponse:
+    """ Function to render data like the api viewsets do """
+    return HttpResponse(
+        JSONRenderer().render(data),
+        status=status_code,
+        content_type='application/json',
+    )
+
+
+async def create_prescription(request):
+    """ Async counterpart of [POST] /prescriptions, external lookups run together on the event loop
+    and response format, error codes and Idempotency-Key handling are the same as PrescriptionViewSet.create """
+    if request.method != 'POST':
+        return render({'detail': f'Method "{request.method}" not allowed.'}, status.HTTP_405_METHOD_NOT_ALLOWED)
+    if request.content_type != 'application/json':
+        return render(
+            {'detail': f'Unsupported media type "{request.content_type}" in request.'},
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        )
+    try:
+        data = json.loads(request.body) if request.body else {}
+    except ValueError as exc:
+        return render({'detail': f'JSON parse error - {exc}'}, status.HTTP_400_BAD_REQUEST)
+
+    async def create():
+        serializer = PrescriptionSerializer(data=data)
+        if isinstance(data, Mapping):
+            await serializer.aprefetch_lookups(items=[data])
+        serializer.is_valid(raise_exception=True)
+        await serializer.asave()
+        return status.HTTP_201_CREATED, {'data': serializer.data}
+
+    key = request.headers.get(settings.IDEMPOTENCY['header'])
+    with trace(f'{request.method} {request.path}', request, method=request.method) as root:
+        try:
+            with deadline(request_budget(request)), span('create_prescription'):
+                if key is None:
+                    status_code, response_data = await create()
+                    replayed = False
+                else:
+                    status_code, response_data, replayed = await aidempotent_call(key, data, create)
+        except serializers.ValidationError as exc:
+            response = render(exc.detail, status.HTTP_400_BAD_REQUEST)
+        except WriterUnavailable:
+            response = render(
+                {'error': {'message': 'database not available', 'code': '10'}},
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        else:
+            response = render(response_data, status_code)
+            if replayed:
+                response['Idempotent-Replayed'] = 'true'
+        root.set(status=response.status_code)
+    if root.trace_id is not None:
+        response[settings.TRACING['header']] = root.trace_id
+    return response
+
+
+create_prescription.csrf_exempt = True
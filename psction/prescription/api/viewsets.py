@@ -1,25 +1,169 @@
 """ Module to define viewsets """
 
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
 from rest_framework import status
 from rest_framework import serializers
+from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.mixins import ListModelMixin
 from rest_framework.mixins import CreateModelMixin
+from rest_framework.mixins import RetrieveModelMixin
 from rest_framework.viewsets import GenericViewSet
 
 from prescription.models import Prescription
+from prescription.idempotency import idempotent_call
+from prescription.deadline import deadline
+from prescription.deadline import request_budget
+from prescription.instrumentation import timed
+from prescription.instrumentation import STAGE_SECONDS
+from prescription.export import EXPORT_FORMATS
+from prescription.export import iter_export
+from prescription.export import export_queryset
+from prescription.tracing import span
+from prescription.tracing import trace
+from prescription.writer import WriterUnavailable
 
+from prescription.api.pagination import PrescriptionCursorPagination
 from prescription.api.serializers import PrescriptionSerializer
 
 
-class PrescriptionViewSet(GenericViewSet, CreateModelMixin):
+class PrescriptionViewSet(GenericViewSet, CreateModelMixin, ListModelMixin, RetrieveModelMixin):
     """ Class to manage view set logic """
-    queryset = Prescription.objects.none()
+    queryset = Prescription.objects.all()
     serializer_class = PrescriptionSerializer
+    pagination_class = PrescriptionCursorPagination
+    filter_params = {
+        'patient': 'patient_id',
+        'physician': 'physician_id',
+        'clinic': 'clinic_id',
+    }
 
-    def create(self, request, *args, **kwargs):
+    def dispatch(self, request, *args, **kwargs):
+        """ Override method to give external requests of the request a shared time budget, and a trace whose id
+        is answered in the trace header """
+        with deadline(request_budget(request)), \
+                trace(f'{request.method} {request.path}', request, method=request.method) as root:
+            response = super().dispatch(request, *args, **kwargs)
+            root.set(status=response.status_code)
+        if root.trace_id is not None:
+            response[settings.TRACING['header']] = root.trace_id
+        return response
+
+    def get_queryset(self):
+        """ Override method to filter list by patient, physician and clinic query params """
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+        filters = {}
+        for param, field in self.filter_params.items():
+            value = self.request.query_params.get(param)
+            if value is None:
+                continue
+            if not value.isdigit():
+                raise serializers.ValidationError(
+                    detail={
+                        'error': {
+                            'message': 'malformed request',
+                            'code': '01',
+                        }
+                    },
+                )
+            filters[field] = int(value)
+        return queryset.filter(**filters)
+
+    def retrieve(self, request, *args, **kwargs):
         """ Override method to customize response format """
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
+        serializer = self.get_serializer(self.get_object())
+        return Response({'data': serializer.data})
+
+    def create(self, request, *args, **kwargs):
+        """ Override method to customize response format, a request with an Idempotency-Key header is done once
+        and its retries get the same response, a prescription not saved because the database is busy gets a 503
+        response, not kept for the key so the request can be retried """
+        with span('PrescriptionViewSet.create'):
+            try:
+                return self.idempotent_create(request)
+            except WriterUnavailable:
+                return Response(
+                    {
+                        'error': {
+                            'message': 'database not available',
+                            'code': '10',
+                        }
+                    },
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                )
+
+    def idempotent_create(self, request):
+        key = request.headers.get(settings.IDEMPOTENCY['header'])
+        if key is None:
+            return self.create_prescription(request)
+
+        def create():
+            response = self.create_prescription(request)
+            return response.status_code, response.data
+
+        status_code, data, replayed = idempotent_call(key, request.data, create)
+        return Response(data, status=status_code, headers={'Idempotent-Replayed': 'true'} if replayed else None)
+
+    def create_prescription(self, request):
+        """ Method to validate and save the prescription of request """
+        with timed(STAGE_SECONDS, stage='parse'):
+            data = request.data
+        serializer = self.get_serializer(data=data)
+        with timed(STAGE_SECONDS, stage='validate'):
+            serializer.is_valid(raise_exception=True)
+        with timed(STAGE_SECONDS, stage='create'):
+            self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
         return Response({'data': serializer.data}, status=status.HTTP_201_CREATED, headers=headers)
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request, *args, **kwargs):
+        """ Endpoint to create a list of prescriptions, response has a result for each item in the same order """
+        if not isinstance(request.data, list) or not 0 < len(request.data) <= settings.PRESCRIPTION_BULK_MAX_ITEMS:
+            raise serializers.ValidationError(
+                detail={
+                    'error': {
+                        'message': 'malformed request',
+                        'code': '01',
+                    }
+                },
+            )
+        results = self.get_serializer_class().bulk_create(
+            items=request.data,
+            context=self.get_serializer_context(),
+        )
+        return Response({'data': results}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='export')
+    def export(self, request, *args, **kwargs):
+        """ Endpoint to stream prescriptions in an id and created date range as ndjson or csv """
+        params = request.query_params
+        export_format = params.get('output', 'ndjson')
+        try:
+            if export_format not in EXPORT_FORMATS:
+                raise ValueError(f'{export_format} is not a valid output')
+            queryset = export_queryset(
+                id_from=int(params['id_from']) if 'id_from' in params else None,
+                id_to=int(params['id_to']) if 'id_to' in params else None,
+                created_from=params.get('created_from'),
+                created_to=params.get('created_to'),
+            )
+        except ValueError:
+            raise serializers.ValidationError(
+                detail={
+                    'error': {
+                        'message': 'malformed request',
+                        'code': '01',
+                    }
+                },
+            )
+        response = StreamingHttpResponse(
+            iter_export(queryset, export_format=export_format),
+            content_type=EXPORT_FORMATS[export_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="prescriptions.{export_format}"'
+        return response
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class PrescriptionConfig(AppConfig):
     name = 'prescription'
+
+    def ready(self):
+        from prescription import utils
+        from prescription import writer
+        writer.connect_signals()
+        utils.connect_signals()
+        utils.load_clients()
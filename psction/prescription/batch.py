@@ -0,0 +1,141 @@
+""" Module to define micro-batching of concurrent external lookups, following the DataLoader pattern """
+import threading
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+
+from prescription.exceptions import ExternalApiError
+
+
+class _Batch:
+    """ Class holding the keys collected by a batch and the futures of their callers """
+
+    def __init__(self) -> None:
+        self.futures = {}
+        self.full = threading.Event()
+
+
+class BatchLoader:
+    """ Class collecting the keys of concurrent callers during window seconds after the first one, or until there
+    are max_size of them, and loading them with one call of load_many(keys). load_many returns a list of results
+    in keys order, where an exception is the error of its key. The first caller of a batch waits the window and
+    calls load_many from its thread, the other ones wait their result """
+
+    def __init__(self, load_many, window: float = 0.002, max_size: int = 32) -> None:
+        self.load_many = load_many
+        self.window = window
+        self.max_size = max_size
+        self._batch = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'loads': 0,
+            'batches': 0,
+            'keys': 0,
+            'failed': 0,
+        }
+
+    def load(self, key, timeout: float = None):
+        """ Method to get the result of key, loaded with the keys other callers ask in the same window.
+        ExternalApiError is raised when it is not loaded within timeout seconds """
+        with self._lock:
+            self.stats['loads'] += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            future = batch.futures.get(key)
+            if future is None:
+                future = batch.futures[key] = Future()
+            if len(batch.futures) >= self.max_size:
+                self._batch = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._dispatch(batch)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise ExternalApiError
+
+    def _dispatch(self, batch: _Batch) -> None:
+        keys = list(batch.futures)
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['keys'] += len(keys)
+        try:
+            results = self.load_many(keys)
+            if len(results) != len(keys):
+                raise ExternalApiError
+        except Exception as exc:
+            with self._lock:
+                self.stats['failed'] += 1
+            for future in batch.futures.values():
+                future.set_exception(exc)
+            return
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                batch.futures[key].set_exception(result)
+            else:
+                batch.futures[key].set_result(result)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+
+def batch_executor() -> ThreadPoolExecutor:
+    """ Function to get the thread pool where single requests of services without a multi-id endpoint are sent,
+    apart from the lookup pool whose threads wait the batches """
+    global _batch_executor
+    if _batch_executor is None:
+        with _batch_executor_lock:
+            if _batch_executor is None:
+                _batch_executor = ThreadPoolExecutor(
+                    max_workers=settings.EXTERNAL_BATCH_WORKERS,
+                    thread_name_prefix='external-batch',
+                )
+    return _batch_executor
+
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+
+def service_loader(service_name: str, config: dict, load_many):
+    """ Function to get the batch loader of service configured by its 'batch' options, None when it is
+    not batched """
+    options = config.get('batch')
+    if not options or not options.get('enabled'):
+        return None
+    loader = _loaders.get(service_name)
+    if loader is None or loader.options != options:
+        with _loaders_lock:
+            loader = _loaders.get(service_name)
+            if loader is None or loader.options != options:
+                loader = _loaders[service_name] = BatchLoader(
+                    load_many,
+                    window=options.get('window', 0.002),
+                    max_size=options.get('max_size', 32),
+                )
+                loader.options = options
+    return loader
+
+
+def batch_stats() -> dict:
+    """ Function to get batched lookups counters of every service """
+    return {service_name: loader.snapshot() for service_name, loader in list(_loaders.items())}
+
+
+def reset_loaders() -> None:
+    with _loaders_lock:
+        _loaders.clear()
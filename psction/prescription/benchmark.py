@@ -0,0 +1,234 @@
+""" Module to define a load benchmark of [POST] /prescriptions against local stub external services """
+import http.client
+import json
+import random
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.core.servers.basehttp import WSGIRequestHandler
+from django.core.servers.basehttp import get_internal_wsgi_application
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Keep-alive handler imitating clinics, physicians, patients and metrics services, every response waits
+    server.latency seconds and fails with 500 with server.error_rate probability. /<resources>?ids=1,2 answers
+    the list of those resources """
+    protocol_version = 'HTTP/1.1'
+
+    RESOURCES = {
+        'clinics': lambda resource_id: {'id': resource_id, 'name': f'Clinic {resource_id}'},
+        'physicians': lambda resource_id: {
+            'id': resource_id,
+            'name': f'Physician {resource_id}',
+            'crm': f'{resource_id}',
+        },
+        'patients': lambda resource_id: {
+            'id': resource_id,
+            'name': f'Patient {resource_id}',
+            'email': f'patient{resource_id}@example.com',
+            'phone': f'{resource_id}',
+        },
+    }
+
+    def respond(self, code: int, data) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self) -> bool:
+        """ Method to wait configured latency, returns True when the response should fail """
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.count(urlsplit(self.path).path.strip('/').split('/')[0])
+        return random.random() < self.server.error_rate
+
+    def do_GET(self):
+        if self.delay():
+            return self.respond(500, {'detail': 'stub error'})
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        ids = parse_qs(url.query).get('ids')
+        if ids and len(parts) == 1 and parts[0] in self.RESOURCES:
+            resource_ids = [resource_id for resource_id in ids[0].split(',') if resource_id.isdigit()]
+            return self.respond(200, [self.RESOURCES[parts[0]](resource_id) for resource_id in resource_ids])
+        if len(parts) != 2 or parts[0] not in self.RESOURCES or not parts[1].isdigit():
+            return self.respond(404, {})
+        return self.respond(200, self.RESOURCES[parts[0]](parts[1]))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.delay():
+            return self.respond(500, {'detail': 'stub error'})
+        return self.respond(201, {'id': '1'})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """ Class defining the stub external services server, counting requests by resource """
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0, error_rate: float = 0) -> None:
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}/'
+
+    def count(self, resource: str) -> None:
+        with self._lock:
+            self.requests[resource] = self.requests.get(resource, 0) + 1
+
+    def start(self) -> 'StubServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def stub_external_services(services: dict, base_url: str) -> dict:
+    """ Function to get a copy of EXTERNAL_SERVICES pointing every service to base_url """
+    return {name: dict(config, base_url=base_url) for name, config in services.items()}
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class AppServer:
+    """ Class serving the django wsgi application on a local port from a background thread """
+
+    def __init__(self) -> None:
+        self.httpd = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler, allow_reuse_address=False)
+        self.httpd.daemon_threads = True
+        self.httpd.set_app(get_internal_wsgi_application())
+        self.port = self.httpd.server_port
+
+    def start(self) -> 'AppServer':
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def percentile(values: list, percent: float) -> float:
+    """ Function to get the nearest-rank percentile of sorted values """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+def summarize(latencies: list, statuses: dict, elapsed: float) -> dict:
+    """ Function to get throughput and latency percentiles in milliseconds of a run """
+    latencies = sorted(latencies)
+    total = len(latencies)
+    return {
+        'requests': total,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(total / elapsed, 2) if elapsed else 0.0,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def prescription_payload(number: int, distinct_ids: int) -> bytes:
+    resource_id = number % distinct_ids + 1
+    return json.dumps({
+        'clinic': {'id': resource_id},
+        'physician': {'id': resource_id},
+        'patient': {'id': resource_id},
+        'text': f'Benchmark prescription {number}',
+    }).encode()
+
+
+def drive(port: int, path: str, total: int, concurrency: int, distinct_ids: int) -> dict:
+    """ Function to post total prescriptions from concurrency keep-alive clients, returns summarize result """
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    results_lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        local_latencies, local_statuses = [], {}
+        try:
+            while True:
+                with counter_lock:
+                    number = next(counter, None)
+                if number is None:
+                    break
+                body = prescription_payload(number, distinct_ids)
+                start = time.perf_counter()
+                try:
+                    connection.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+                    response = connection.getresponse()
+                    response.read()
+                    code = response.status
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    code = 'connection_error'
+                local_latencies.append(time.perf_counter() - start)
+                local_statuses[code] = local_statuses.get(code, 0) + 1
+        finally:
+            connection.close()
+            with results_lock:
+                latencies.extend(local_latencies)
+                for code, count in local_statuses.items():
+                    statuses[code] = statuses.get(code, 0) + count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+
+def git_revision() -> str:
+    """ Function to get the current commit, empty when it is not available """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> list:
+    """ Function to get regressions of result against baseline, a throughput drop or a p50/p95/p99 raise
+    bigger than threshold percent """
+    regressions = []
+    old, new = baseline['throughput'], result['throughput']
+    if old and (old - new) / old * 100 > threshold:
+        regressions.append(f'throughput {old} -> {new} req/s')
+    for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+        old, new = baseline[key], result[key]
+        if old and (new - old) / old * 100 > threshold:
+            regressions.append(f'{key} {old} -> {new}')
+    return regressions
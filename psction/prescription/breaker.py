@@ -0,0 +1,139 @@
+""" Module to define circuit breakers of external services """
+import threading
+import time
+
+from prescription.exceptions import DeadlineExceeded
+from prescription.exceptions import ExternalApiError
+from prescription.exceptions import ExternalServiceUnavailable
+from prescription.exceptions import ServiceOverloaded
+
+
+class CircuitBreaker:
+    """ Class defining a circuit breaker, after failure_threshold consecutive ExternalApiError it opens and requests
+    fail fast during recovery_timeout seconds, then it goes half open letting half_open_max_calls requests try
+    the service, closing again on success or opening again on failure """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30, half_open_max_calls: int = 1,
+                 timer=time.monotonic) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.timer = timer
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_calls = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            'opened': 0,
+            'rejected': 0,
+            'successes': 0,
+            'failures': 0,
+        }
+
+    def before_call(self) -> None:
+        """ Method to ask permission to call service, raising ExternalServiceUnavailable when circuit is open """
+        with self._lock:
+            if self.state == self.OPEN and self.timer() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self.half_open_calls = 0
+            if self.state == self.OPEN or (
+                    self.state == self.HALF_OPEN and self.half_open_calls >= self.half_open_max_calls):
+                self.stats['rejected'] += 1
+                raise ExternalServiceUnavailable
+            if self.state == self.HALF_OPEN:
+                self.half_open_calls += 1
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.stats['successes'] += 1
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def release(self) -> None:
+        """ Method to give back a half open trial call that ended without telling whether service is up """
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.half_open_calls > 0:
+                self.half_open_calls -= 1
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.stats['failures'] += 1
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats['opened'] += 1
+                self.state = self.OPEN
+                self.opened_at = self.timer()
+
+    def call(self, function):
+        """ Method to call function through the breaker, only ExternalApiError counts as failure,
+        any other outcome like a not found response means service is up, running out of request budget or
+        being shed by the concurrency limiter says nothing about the service """
+        self.before_call()
+        try:
+            result = function()
+        except (DeadlineExceeded, ServiceOverloaded):
+            self.release()
+            raise
+        except ExternalApiError:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    async def acall(self, function):
+        """ Coroutine counterpart of call, function is a coroutine function """
+        self.before_call()
+        try:
+            result = await function()
+        except (DeadlineExceeded, ServiceOverloaded):
+            self.release()
+            raise
+        except ExternalApiError:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, state=self.state, consecutive_failures=self.failures)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def service_breaker(service_name: str, config: dict):
+    """ Function to get the breaker of service configured by its 'breaker' options, None when it has not one """
+    options = config.get('breaker')
+    if not options:
+        return None
+    breaker = _breakers.get(service_name)
+    if breaker is None or breaker.options != options:
+        with _breakers_lock:
+            breaker = _breakers.get(service_name)
+            if breaker is None or breaker.options != options:
+                breaker = _breakers[service_name] = CircuitBreaker(**options)
+                breaker.options = options
+    return breaker
+
+
+def breaker_states() -> dict:
+    """ Function to get state of every service breaker """
+    return {service_name: breaker.snapshot() for service_name, breaker in list(_breakers.items())}
+
+
+def reset_breakers() -> None:
+    with _breakers_lock:
+        _breakers.clear()
@@ -0,0 +1,130 @@
+""" Module to define in-process cache of external resources """
+import threading
+import time
+
+from collections import OrderedDict
+
+from prescription.exceptions import ExternalResourceNotFound
+
+
+class TTLCache:
+    """ Class defining a bounded LRU cache whose entries expire after ttl seconds, it can remember
+    ExternalResourceNotFound responses during negative_ttl seconds to avoid asking again for missing resources """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, negative_ttl: float = 0, timer=time.monotonic) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'expired': 0,
+            'evicted': 0,
+        }
+
+    def _get(self, key):
+        """ Method to get (found, value) for key, value None means a cached not found response """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if self.timer() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.stats['hits' if value is not None else 'negative_hits'] += 1
+                    return True, value
+                del self._entries[key]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return False, None
+
+    def _set(self, key, value, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (self.timer() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def lookup(self, key) -> tuple:
+        """ Method to get (found, value) for key, raising ExternalResourceNotFound for cached not found responses """
+        found, value = self._get(key)
+        if found and value is None:
+            raise ExternalResourceNotFound
+        return found, value
+
+    def store(self, key, value) -> None:
+        if value is not None:
+            self._set(key, value, ttl=self.ttl)
+
+    def store_not_found(self, key) -> None:
+        if self.negative_ttl > 0:
+            self._set(key, None, ttl=self.negative_ttl)
+
+    def get_or_load(self, key, loader):
+        """ Method to get key value from cache or from loader callable, caching its result """
+        found, value = self.lookup(key)
+        if found:
+            return value
+        try:
+            value = loader()
+        except ExternalResourceNotFound:
+            self.store_not_found(key)
+            raise
+        self.store(key, value)
+        return value
+
+    async def aget_or_load(self, key, loader):
+        """ Coroutine counterpart of get_or_load, loader is a coroutine function """
+        found, value = self.lookup(key)
+        if found:
+            return value
+        try:
+            value = await loader()
+        except ExternalResourceNotFound:
+            self.store_not_found(key)
+            raise
+        self.store(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self) -> dict:
+        """ Method to get cache hit/miss counters """
+        with self._lock:
+            return dict(self.stats, size=len(self._entries), maxsize=self.maxsize)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def service_cache(service_name: str, config: dict):
+    """ Function to get the cache of service configured by its 'cache' options, None when it is not cached """
+    options = config.get('cache') or {}
+    if options.get('ttl', 0) <= 0:
+        return None
+    options = (options.get('maxsize', 1024), options['ttl'], options.get('negative_ttl', 0))
+    cache = _caches.get(service_name)
+    if cache is None or (cache.maxsize, cache.ttl, cache.negative_ttl) != options:
+        with _caches_lock:
+            cache = _caches.get(service_name)
+            if cache is None or (cache.maxsize, cache.ttl, cache.negative_ttl) != options:
+                maxsize, ttl, negative_ttl = options
+                cache = _caches[service_name] = TTLCache(maxsize=maxsize, ttl=ttl, negative_ttl=negative_ttl)
+    return cache
+
+
+def cache_stats() -> dict:
+    """ Function to get stats of every service cache """
+    return {service_name: cache.snapshot() for service_name, cache in list(_caches.items())}
+
+
+def clear_caches() -> None:
+    with _caches_lock:
+        _caches.clear()
@@ -0,0 +1,61 @@
+""" Module to define the time budget of a request shared by every external request it performs """
+import time
+
+from contextvars import ContextVar
+
+from django.conf import settings
+
+from prescription.exceptions import DeadlineExceeded
+
+_deadline = ContextVar('prescription_deadline', default=None)
+
+
+def current_deadline():
+    """ Function to get the monotonic time when current request budget runs out, None outside a request """
+    return _deadline.get()
+
+
+class deadline:
+    """ Context manager giving its block a budget of seconds, a nested budget never extends the outer one """
+    __slots__ = ('seconds', 'token')
+
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+
+    def __enter__(self):
+        expires_at = time.monotonic() + self.seconds
+        outer = _deadline.get()
+        self.token = _deadline.set(expires_at if outer is None else min(outer, expires_at))
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _deadline.reset(self.token)
+        return False
+
+
+def time_left(expires_at=None, timeout: float = None) -> float:
+    """ Function to get seconds an external request can take, the remaining budget capped by the per request
+    timeout, DeadlineExceeded is raised when the budget already ran out """
+    timeout = settings.EXTERNAL_TIMEOUT if timeout is None else timeout
+    if expires_at is None:
+        return timeout
+    left = expires_at - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded
+    return min(left, timeout)
+
+
+def expired(expires_at) -> bool:
+    return expires_at is not None and time.monotonic() >= expires_at
+
+
+def request_budget(request) -> float:
+    """ Function to get budget seconds of request, from its deadline header when valid, bounded by the maximum """
+    options = settings.REQUEST_DEADLINE
+    try:
+        seconds = float(request.headers.get(options['header'], ''))
+    except ValueError:
+        return options['default']
+    if seconds != seconds:  # NaN
+        return options['default']
+    return max(0.0, min(seconds, options['max']))
@@ -2,8 +2,24 @@
 
 
 class ExternalApiError(Exception):
-    """ Exception to segment external api conexion error """
+    """ Exception to segment external api conexion error, status is the response status when there was one """
+
+    def __init__(self, *args, status: int = None) -> None:
+        super().__init__(*args)
+        self.status = status
 
 
 class ExternalResourceNotFound(Exception):
     """ Exception to segment external api with 404 response """
+
+
+class ExternalServiceUnavailable(ExternalApiError):
+    """ Exception to segment external api requests rejected before being sent, like an open circuit breaker """
+
+
+class DeadlineExceeded(ExternalServiceUnavailable):
+    """ Exception to segment external api requests without time left in the request budget """
+
+
+class ServiceOverloaded(ExternalServiceUnavailable):
+    """ Exception to segment external api requests rejected because too many requests to the service are running """
@@ -0,0 +1,83 @@
+""" Module to define streaming export of prescriptions """
+import csv
+import json
+
+from datetime import datetime
+from datetime import time
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_datetime
+
+from prescription.models import Prescription
+
+EXPORT_FIELDS = ('id', 'clinic_id', 'physician_id', 'patient_id', 'text', 'created_at')
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def parse_export_datetime(value: str) -> datetime:
+    """ Function to parse a date or datetime filter, dates are the start of the day and naive values are UTC """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'{value} is not a valid date')
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+
+def export_queryset(id_from: int = None, id_to: int = None, created_from: str = None, created_to: str = None):
+    """ Function to get rows of prescriptions with id in [id_from, id_to] and created in [created_from, created_to),
+    ValueError is raised for malformed dates """
+    queryset = Prescription.objects.order_by('id')
+    if id_from is not None:
+        queryset = queryset.filter(id__gte=id_from)
+    if id_to is not None:
+        queryset = queryset.filter(id__lte=id_to)
+    if created_from:
+        queryset = queryset.filter(created_at__gte=parse_export_datetime(created_from))
+    if created_to:
+        queryset = queryset.filter(created_at__lt=parse_export_datetime(created_to))
+    return queryset.values_list('id', 'clinic_id', 'physician_id', 'patient_id', 'description', 'created_at')
+
+
+def iter_rows(queryset, chunk_size: int = None):
+    """ Function to iterate rows fetched chunk by chunk, so the whole result is never in memory """
+    return queryset.iterator(chunk_size=chunk_size or settings.PRESCRIPTION_EXPORT_CHUNK_SIZE)
+
+
+def iter_ndjson(queryset, chunk_size: int = None):
+    """ Function to yield a json line per prescription """
+    for row in iter_rows(queryset, chunk_size=chunk_size):
+        item = dict(zip(EXPORT_FIELDS, row))
+        item['created_at'] = item['created_at'].isoformat() if item['created_at'] else None
+        yield json.dumps(item) + '\n'
+
+
+class _LineBuffer:
+    """ File-like object returning what is written, to let csv.writer produce one line at a time """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def iter_csv(queryset, chunk_size: int = None):
+    """ Function to yield csv header and then a line per prescription """
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in iter_rows(queryset, chunk_size=chunk_size):
+        *values, created_at = row
+        yield writer.writerow([*values, created_at.isoformat() if created_at else ''])
+
+
+def iter_export(queryset, export_format: str, chunk_size: int = None):
+    if export_format == 'csv':
+        return iter_csv(queryset, chunk_size=chunk_size)
+    return iter_ndjson(queryset, chunk_size=chunk_size)
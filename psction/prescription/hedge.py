@@ -0,0 +1,228 @@
+""" Module to define hedged requests, a late idempotent request is sent again and the first response is used """
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextvars import copy_context
+
+from django.conf import settings
+
+from prescription.exceptions import ExternalApiError
+
+
+class LatencyTracker:
+    """ Class keeping the latencies of the last window requests to get their percentiles,
+    sorted latencies are refreshed every refresh observations """
+
+    def __init__(self, window: int = 200, refresh: int = 20) -> None:
+        self.refresh = refresh
+        self._latencies = deque(maxlen=window)
+        self._sorted = []
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def observe(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self._pending += 1
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def percentile(self, percent: float) -> float:
+        with self._lock:
+            if self._pending >= self.refresh or not self._sorted:
+                self._sorted = sorted(self._latencies)
+                self._pending = 0
+            if not self._sorted:
+                return 0.0
+            index = min(len(self._sorted) - 1, int(len(self._sorted) * percent / 100))
+            return self._sorted[index]
+
+
+class HedgePool:
+    """ Class running calls on a thread pool only while it has an idle worker, a call finding every worker busy is
+    not queued so the caller can run it in its own thread """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = 'external-hedge') -> None:
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.Semaphore(max_workers)
+
+    def try_submit(self, function, *args):
+        """ Method to run function on an idle worker, returning its future, None when every worker is busy """
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _future: self._slots.release())
+        return future
+
+
+class Hedger:
+    """ Class calling a function and, when it has not finished after the percentile of recent latencies, calling it
+    again and using the first outcome. Each call earns budget hedge tokens (up to max_tokens) and a hedge spends
+    one, so hedges stay around budget of calls. Only calls with a response are tracked, a failure is not a latency.
+    A call that can't be hedged, because there is no token or no idle worker in the pool, runs in the calling
+    thread without a hedge, so the pool size never limits calls """
+
+    def __init__(self, percentile: float = 95, budget: float = 0.05, window: int = 200, min_samples: int = 20,
+                 max_tokens: float = 10, pool: HedgePool = None) -> None:
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self.tracker = LatencyTracker(window=window)
+        self.pool = pool
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'inline': 0,
+            'sent': 0,
+            'won': 0,
+            'throttled': 0,
+        }
+
+    def _timed(self, function):
+        start = time.perf_counter()
+        try:
+            result = function()
+        except ExternalApiError:
+            raise
+        except Exception:
+            self.tracker.observe(time.perf_counter() - start)
+            raise
+        self.tracker.observe(time.perf_counter() - start)
+        return result
+
+    def _submit(self, function):
+        return (self.pool or hedge_pool()).try_submit(copy_context().run, self._timed, function)
+
+    def _inline(self, function, delay: float = None):
+        """ Method to call function in the calling thread, a call late after delay counts as a throttled hedge """
+        with self._lock:
+            self.stats['inline'] += 1
+        start = time.perf_counter()
+        try:
+            return self._timed(function)
+        finally:
+            if delay is not None and time.perf_counter() - start > delay:
+                with self._lock:
+                    self.stats['throttled'] += 1
+
+    def _hedge(self, function):
+        """ Method to send a hedge of function spending a token, None when there is no token or no idle worker """
+        with self._lock:
+            future = self._submit(function) if self._tokens >= 1 else None
+            if future is None:
+                self.stats['throttled'] += 1
+                return None
+            self._tokens -= 1
+            self.stats['sent'] += 1
+            return future
+
+    def call(self, function, timeout: float = None):
+        """ Method to call function hedging it when late, function must be idempotent. A not found response is a
+        response, an ExternalApiError of one request waits the other one. ExternalApiError is raised when no
+        request finished within timeout seconds """
+        with self._lock:
+            self.stats['calls'] += 1
+            self._tokens = min(self.max_tokens, self._tokens + self.budget)
+            hedgeable = self._tokens >= 1
+        if len(self.tracker) < self.min_samples:
+            return self._inline(function)
+        delay = self.tracker.percentile(self.percentile)
+        primary = self._submit(function) if hedgeable else None
+        if primary is None:
+            return self._inline(function, delay)
+
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        pending = {primary}
+        done, _ = wait(pending, timeout=self._left(expires_at, delay))
+        if not done:
+            hedge = self._hedge(function)
+            if hedge is not None:
+                pending.add(hedge)
+        while pending:
+            done, pending = wait(pending, timeout=self._left(expires_at), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            responded = [future for future in done if not isinstance(future.exception(), ExternalApiError)]
+            if responded:
+                future = primary if primary in responded else responded[0]
+                if future is not primary:
+                    with self._lock:
+                        self.stats['won'] += 1
+                return future.result()
+            if not pending:
+                return (primary if primary in done else done.pop()).result()
+        raise ExternalApiError
+
+    @staticmethod
+    def _left(expires_at, wait_for: float = None):
+        """ Method to get seconds to wait, at most wait_for and never after expires_at """
+        if expires_at is None:
+            return wait_for
+        left = max(0.0, expires_at - time.monotonic())
+        return left if wait_for is None else min(left, wait_for)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(
+                self.stats,
+                tokens=round(self._tokens, 2),
+                delay=round(self.tracker.percentile(self.percentile), 6),
+                samples=len(self.tracker),
+            )
+
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def hedge_pool() -> HedgePool:
+    """ Function to get the thread pool where hedged requests and their hedges are sent, it should have a worker
+    for each hedged request running at the same time, the ones beyond it are sent unhedged """
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_pool_lock:
+            if _hedge_pool is None:
+                _hedge_pool = HedgePool(max_workers=settings.EXTERNAL_HEDGE_WORKERS)
+    return _hedge_pool
+
+
+_hedgers = {}
+_hedgers_lock = threading.Lock()
+
+
+def service_hedger(service_name: str, config: dict):
+    """ Function to get the hedger of service configured by its 'hedge' options, None when it is not hedged """
+    options = config.get('hedge')
+    if not options or not options.get('enabled'):
+        return None
+    hedger = _hedgers.get(service_name)
+    if hedger is None or hedger.options != options:
+        with _hedgers_lock:
+            hedger = _hedgers.get(service_name)
+            if hedger is None or hedger.options != options:
+                hedger = _hedgers[service_name] = Hedger(
+                    **{key: value for key, value in options.items() if key != 'enabled'}
+                )
+                hedger.options = options
+    return hedger
+
+
+def hedge_stats() -> dict:
+    """ Function to get hedged requests counters of every service """
+    return {service_name: hedger.snapshot() for service_name, hedger in list(_hedgers.items())}
+
+
+def reset_hedgers() -> None:
+    with _hedgers_lock:
+        _hedgers.clear()
@@ -0,0 +1,153 @@
+""" Module to define Idempotency-Key handling, a request and its retries are done once and answered the same """
+import hashlib
+import json
+import time
+
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+from django.utils import timezone
+
+from rest_framework import status
+
+from prescription.deadline import current_deadline
+from prescription.models import IdempotencyKey
+
+
+class IdempotencyKeyMismatch(Exception):
+    """ Exception to segment a key already used by a request with another body """
+
+
+class IdempotencyKeyInProgress(Exception):
+    """ Exception to segment a key still held by a running request once the wait ran out """
+
+
+def request_fingerprint(data) -> str:
+    """ Function to get a digest of request data identifying requests with the same body """
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def acquire_key(key: str, fingerprint: str, wait: float = None) -> IdempotencyKey:
+    """ Function to get the row of key, a completed row holds the response to replay, otherwise the row is claimed
+    by the caller, who must call complete_key. While another request holds the key it is polled up to wait
+    seconds, by default until the request deadline """
+    options = settings.IDEMPOTENCY
+    if wait is None:
+        expires_at = current_deadline() or time.monotonic() + options['lock_timeout']
+    else:
+        expires_at = time.monotonic() + wait
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(
+                    key=key,
+                    fingerprint=fingerprint,
+                    locked_until=now + timedelta(seconds=options['lock_timeout']),
+                    expires_at=now + timedelta(seconds=options['ttl']),
+                )
+        except IntegrityError:
+            pass
+        row = IdempotencyKey.objects.filter(key=key).first()
+        if row is None:
+            continue
+        if row.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=row.pk, expires_at__lte=now).delete()
+            continue
+        if row.fingerprint != fingerprint:
+            raise IdempotencyKeyMismatch
+        if row.completed:
+            return row
+        if row.locked_until <= now:
+            # holder died without completing, the first retry taking the stale lock does the work
+            locked_until = now + timedelta(seconds=options['lock_timeout'])
+            taken = IdempotencyKey.objects.filter(
+                pk=row.pk,
+                status_code__isnull=True,
+                locked_until=row.locked_until,
+            ).update(locked_until=locked_until)
+            if taken:
+                row.locked_until = locked_until
+                return row
+            continue
+        if time.monotonic() + options['poll_interval'] > expires_at:
+            raise IdempotencyKeyInProgress
+        time.sleep(options['poll_interval'])
+
+
+def complete_key(row: IdempotencyKey, status_code: int, response) -> None:
+    """ Function to save a successful response of a claimed key to be replayed, any other outcome releases
+    the key so a retry does the work again """
+    if 200 <= status_code < 300:
+        row.status_code = status_code
+        row.response = response
+        row.save(update_fields=['status_code', 'response'])
+    else:
+        release_key(row)
+
+
+def release_key(row: IdempotencyKey) -> None:
+    IdempotencyKey.objects.filter(pk=row.pk, status_code__isnull=True).delete()
+
+
+def claim_key(key: str, data) -> tuple:
+    """ Function to claim key for a request with data, it returns (row, None) when the caller must do the work,
+    otherwise (None, answer) where answer is the (status_code, response, replayed) the request gets """
+    if not 0 < len(key) <= IdempotencyKey._meta.get_field('key').max_length:
+        return None, (status.HTTP_400_BAD_REQUEST, {'error': {'message': 'malformed request', 'code': '01'}}, False)
+    try:
+        row = acquire_key(key, request_fingerprint(data))
+    except IdempotencyKeyMismatch:
+        return None, (
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            {'error': {'message': 'idempotency key already used by another request', 'code': '08'}},
+            False,
+        )
+    except IdempotencyKeyInProgress:
+        return None, (
+            status.HTTP_409_CONFLICT,
+            {'error': {'message': 'request with this idempotency key in progress', 'code': '09'}},
+            False,
+        )
+    if row.completed:
+        return None, (row.status_code, row.response, True)
+    return row, None
+
+
+def idempotent_call(key: str, data, function) -> tuple:
+    """ Function to call function, returning (status_code, response), once for key and data, it returns
+    (status_code, response, replayed). A function raising releases the key so a retry does the work again """
+    row, answer = claim_key(key, data)
+    if answer is not None:
+        return answer
+    try:
+        status_code, response = function()
+    except Exception:
+        release_key(row)
+        raise
+    complete_key(row, status_code, response)
+    return status_code, response, False
+
+
+async def aidempotent_call(key: str, data, function) -> tuple:
+    """ Coroutine counterpart of idempotent_call, function is a coroutine function """
+    row, answer = await sync_to_async(claim_key)(key, data)
+    if answer is not None:
+        return answer
+    try:
+        status_code, response = await function()
+    except Exception:
+        await sync_to_async(release_key)(row)
+        raise
+    await sync_to_async(complete_key)(row, status_code, response)
+    return status_code, response, False
+
+
+def purge_expired_keys() -> int:
+    """ Function to delete expired keys, returns how many were deleted """
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
@@ -0,0 +1,123 @@
+""" Module to define in-process latency histograms rendered in Prometheus text format """
+import threading
+
+from bisect import bisect_left
+from time import perf_counter
+
+from django.conf import settings
+
+from rest_framework import serializers
+
+from prescription.exceptions import DeadlineExceeded
+from prescription.exceptions import ExternalApiError
+from prescription.exceptions import ExternalResourceNotFound
+from prescription.exceptions import ExternalServiceUnavailable
+from prescription.exceptions import ServiceOverloaded
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """ Class defining a cumulative histogram with labels, observing a value costs a bisect and a lock """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        """ Method to get histogram lines in Prometheus text format """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, key))
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+EXTERNAL_API_SECONDS = Histogram(
+    name='psction_external_api_request_seconds',
+    documentation='Time of http requests to external services',
+    label_names=('service', 'outcome'),
+)
+EXTERNAL_SERVICE_SECONDS = Histogram(
+    name='psction_external_service_request_seconds',
+    documentation='Time of external service requests including cache, coalescing and circuit breaker',
+    label_names=('service', 'outcome'),
+)
+STAGE_SECONDS = Histogram(
+    name='psction_prescription_stage_seconds',
+    documentation='Time of each stage of prescription requests',
+    label_names=('stage', 'outcome'),
+)
+HISTOGRAMS = (EXTERNAL_API_SECONDS, EXTERNAL_SERVICE_SECONDS, STAGE_SECONDS)
+
+
+def outcome_of(exc: BaseException) -> str:
+    """ Function to get outcome label of an exception """
+    if isinstance(exc, DeadlineExceeded):
+        return 'deadline'
+    if isinstance(exc, ServiceOverloaded):
+        return 'shed'
+    if isinstance(exc, ExternalServiceUnavailable):
+        return 'rejected'
+    if isinstance(exc, ExternalApiError):
+        return 'error'
+    if isinstance(exc, ExternalResourceNotFound):
+        return 'not_found'
+    if isinstance(exc, serializers.ValidationError):
+        return 'invalid'
+    return 'exception'
+
+
+class timed:
+    """ Context manager observing time of its block on histogram, outcome label comes from the raised exception """
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, **labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if settings.INSTRUMENTATION_ENABLED:
+            self.histogram.observe(
+                perf_counter() - self.start,
+                outcome='ok' if exc is None else outcome_of(exc),
+                **self.labels,
+            )
+        return False
+
+
+def render_histograms() -> list:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return lines
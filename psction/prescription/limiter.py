@@ -0,0 +1,181 @@
+""" Module to define per service concurrency limits, requests beyond them wait in a bounded queue or are rejected """
+import asyncio
+import threading
+
+from collections import deque
+
+from prescription.exceptions import ServiceOverloaded
+
+
+class _Waiter:
+    """ Class holding a queued thread, woken up when a slot is handed over to it """
+
+    def __init__(self) -> None:
+        self.granted = False
+        self._event = threading.Event()
+
+    def grant(self) -> bool:
+        self.granted = True
+        self._event.set()
+        return True
+
+    def wait(self, timeout: float) -> bool:
+        return self._event.wait(timeout)
+
+
+class _AsyncWaiter:
+    """ Class holding a queued coroutine, its future is resolved on its event loop when a slot is handed over """
+
+    def __init__(self) -> None:
+        self.granted = False
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def _resolve(self) -> None:
+        if not self.future.done():
+            self.future.set_result(True)
+
+    def grant(self) -> bool:
+        try:
+            self.loop.call_soon_threadsafe(self._resolve)
+        except RuntimeError:  # loop closed
+            return False
+        self.granted = True
+        return True
+
+
+class ConcurrencyLimiter:
+    """ Class admitting at most max_concurrency calls at the same time, further calls wait their turn in a queue of
+    at most max_queue calls for at most queue_timeout seconds. A call that finds the queue full, or whose wait runs
+    out, is rejected with ServiceOverloaded so it fails fast instead of holding a worker """
+
+    def __init__(self, max_concurrency: int = 10, max_queue: int = 20, queue_timeout: float = 0.5) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._in_flight = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.stats = {
+            'admitted': 0,
+            'queued': 0,
+            'rejected': 0,
+            'timed_out': 0,
+        }
+
+    def _enter(self, waiter_class):
+        """ Method to take a free slot, returning None, or a queued waiter of waiter_class """
+        with self._lock:
+            if self._in_flight < self.max_concurrency and not self._waiters:
+                self._in_flight += 1
+                self.stats['admitted'] += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.stats['rejected'] += 1
+                raise ServiceOverloaded
+            waiter = waiter_class()
+            self._waiters.append(waiter)
+            self.stats['queued'] += 1
+            return waiter
+
+    def _leave_queue(self, waiter) -> bool:
+        """ Method to drop a waiter whose wait ran out, returns False when it got a slot meanwhile """
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters.remove(waiter)
+            self.stats['timed_out'] += 1
+            return True
+
+    def _wait_for(self, timeout: float = None) -> float:
+        return self.queue_timeout if timeout is None else max(0.0, min(timeout, self.queue_timeout))
+
+    def acquire(self, timeout: float = None) -> None:
+        """ Method to take a slot waiting at most queue_timeout, and at most timeout, seconds """
+        waiter = self._enter(_Waiter)
+        if waiter is None or waiter.wait(self._wait_for(timeout)):
+            return
+        if self._leave_queue(waiter):
+            raise ServiceOverloaded
+
+    async def aacquire(self, timeout: float = None) -> None:
+        """ Coroutine counterpart of acquire, waiting without blocking the event loop """
+        waiter = self._enter(_AsyncWaiter)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self._wait_for(timeout))
+        except asyncio.TimeoutError:
+            if self._leave_queue(waiter):
+                raise ServiceOverloaded
+        except asyncio.CancelledError:
+            if not self._leave_queue(waiter):
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """ Method to give back a slot, handed over to the first queued call when there is one """
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if waiter.grant():
+                    self.stats['admitted'] += 1
+                    return
+            self._in_flight -= 1
+
+    def call(self, function, timeout: float = None):
+        """ Method to call function holding a slot """
+        self.acquire(timeout)
+        try:
+            return function()
+        finally:
+            self.release()
+
+    async def acall(self, function, timeout: float = None):
+        """ Coroutine counterpart of call, function is a coroutine function """
+        await self.aacquire(timeout)
+        try:
+            return await function()
+        finally:
+            self.release()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(
+                self.stats,
+                in_flight=self._in_flight,
+                queue_depth=len(self._waiters),
+                max_concurrency=self.max_concurrency,
+            )
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def service_limiter(service_name: str, config: dict):
+    """ Function to get the concurrency limiter of service configured by its 'limit' options, None when it is
+    not limited """
+    options = config.get('limit')
+    if not options or not options.get('enabled'):
+        return None
+    limiter = _limiters.get(service_name)
+    if limiter is None or limiter.options != options:
+        with _limiters_lock:
+            limiter = _limiters.get(service_name)
+            if limiter is None or limiter.options != options:
+                limiter = _limiters[service_name] = ConcurrencyLimiter(
+                    **{key: value for key, value in options.items() if key != 'enabled'}
+                )
+                limiter.options = options
+    return limiter
+
+
+def limiter_stats() -> dict:
+    """ Function to get concurrency limiters stats of every service """
+    return {service_name: limiter.snapshot() for service_name, limiter in list(_limiters.items())}
+
+
+def reset_limiters() -> None:
+    with _limiters_lock:
+        _limiters.clear()
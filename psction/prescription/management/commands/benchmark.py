@@ -0,0 +1,117 @@
+""" Module to define command benchmarking [POST] /prescriptions against local stub external services """
+import json
+import tempfile
+
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from prescription.benchmark import AppServer
+from prescription.benchmark import StubServer
+from prescription.benchmark import compare
+from prescription.benchmark import drive
+from prescription.benchmark import git_revision
+from prescription.benchmark import stub_external_services
+from prescription.batch import reset_loaders
+from prescription.breaker import reset_breakers
+from prescription.cache import clear_caches
+from prescription.pool import close_pools
+
+
+class Command(BaseCommand):
+    help = ('Benchmark [POST] /prescriptions at fixed concurrency against local stub external services, '
+            'on a temporary database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='measured requests')
+        parser.add_argument('--warmup', type=int, default=50, help='requests sent before measuring')
+        parser.add_argument('--concurrency', type=int, default=16, help='clients sending requests at the same time')
+        parser.add_argument('--latency', type=float, default=0.01, help='seconds stub services wait to answer')
+        parser.add_argument('--error-rate', type=float, default=0, help='probability of a stub 500 response')
+        parser.add_argument('--distinct-ids', type=int, default=100, help='distinct clinic/physician/patient ids')
+        parser.add_argument('--path', default='/prescriptions', help='endpoint receiving the prescriptions')
+        parser.add_argument('--output', help='file where the result is saved as json')
+        parser.add_argument('--compare', help='json result of a previous run to compare with')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='percent of throughput drop or latency raise failing the comparison')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                baseline = json.loads(Path(options['compare']).read_text())
+            except (OSError, ValueError) as exc:
+                raise CommandError(f'Baseline {options["compare"]} can not be read: {exc}')
+
+        result = self.run(options)
+        self.report(result)
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(result, indent=2) + '\n')
+
+        if baseline is not None:
+            regressions = compare(result, baseline, threshold=options['threshold'])
+            self.stdout.write(f'Compared with {baseline.get("revision") or options["compare"]}')
+            if regressions:
+                raise CommandError('Performance regression: ' + ', '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regression'))
+
+    def run(self, options) -> dict:
+        stubs = StubServer(latency=options['latency'], error_rate=options['error_rate']).start()
+        with tempfile.TemporaryDirectory() as directory:
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = str(Path(directory) / 'benchmark.sqlite3')
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                with override_settings(
+                        EXTERNAL_SERVICES=stub_external_services(settings.EXTERNAL_SERVICES, stubs.base_url),
+                        ALLOWED_HOSTS=['*'],
+                        DEBUG=False):
+                    reset_breakers()
+                    reset_loaders()
+                    clear_caches()
+                    app = AppServer().start()
+                    try:
+                        if options['warmup']:
+                            drive(app.port, options['path'], options['warmup'], options['concurrency'],
+                                  options['distinct_ids'])
+                        stubs.requests.clear()
+                        result = drive(app.port, options['path'], options['requests'], options['concurrency'],
+                                       options['distinct_ids'])
+                    finally:
+                        app.stop()
+                        close_pools()
+                        reset_breakers()
+                        reset_loaders()
+                        clear_caches()
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                stubs.stop()
+
+        result['upstream_requests'] = dict(stubs.requests)
+        result['revision'] = git_revision()
+        result['options'] = {
+            key: options[key]
+            for key in ('requests', 'concurrency', 'latency', 'error_rate', 'distinct_ids', 'path')
+        }
+        result['settings'] = {
+            'EXTERNAL_PARALLEL_LOOKUPS': settings.EXTERNAL_PARALLEL_LOOKUPS,
+            'EXTERNAL_SINGLE_FLIGHT': settings.EXTERNAL_SINGLE_FLIGHT,
+            'EXTERNAL_HTTP_POOL': settings.EXTERNAL_HTTP_POOL['enabled'],
+            'EXTERNAL_BATCH': settings.EXTERNAL_BATCH['enabled'],
+            'METRIC_DELIVERY': settings.METRIC_DELIVERY,
+            'GROUP_COMMIT': settings.GROUP_COMMIT['enabled'],
+        }
+        return result
+
+    def report(self, result: dict) -> None:
+        self.stdout.write(
+            f'{result["requests"]} requests in {result["elapsed"]}s at concurrency '
+            f'{result["options"]["concurrency"]}: {result["throughput"]} req/s'
+        )
+        self.stdout.write(
+            f'latency ms p50 {result["p50_ms"]} p95 {result["p95_ms"]} p99 {result["p99_ms"]} max {result["max_ms"]}'
+        )
+        self.stdout.write(f'statuses {result["statuses"]} upstream requests {result["upstream_requests"]}')
@@ -0,0 +1,25 @@
+""" Module to define command delivering pending metric outbox rows """
+import time
+
+from django.core.management.base import BaseCommand
+
+from prescription.metrics import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver pending metric outbox rows to metric service'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='rows claimed by each batch')
+        parser.add_argument('--loop', action='store_true', help='keep waiting for new rows once outbox is empty')
+        parser.add_argument('--interval', type=float, default=1, help='seconds to wait when outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            delivered, failed = drain_outbox(batch_size=options['batch_size'])
+            if delivered or failed:
+                self.stdout.write(f'Metrics delivered: {delivered} failed: {failed}')
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,38 @@
+""" Module to define command exporting prescriptions """
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from prescription.export import EXPORT_FORMATS
+from prescription.export import iter_export
+from prescription.export import export_queryset
+
+
+class Command(BaseCommand):
+    help = 'Export prescriptions in an id and created date range as ndjson or csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-format', choices=list(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--output', default='-', help='file path, stdout by default')
+        parser.add_argument('--id-from', type=int, default=None)
+        parser.add_argument('--id-to', type=int, default=None)
+        parser.add_argument('--created-from', default=None, help='ISO date or datetime, inclusive')
+        parser.add_argument('--created-to', default=None, help='ISO date or datetime, exclusive')
+        parser.add_argument('--chunk-size', type=int, default=None, help='rows fetched by each database step')
+
+    def handle(self, *args, **options):
+        try:
+            queryset = export_queryset(
+                id_from=options['id_from'],
+                id_to=options['id_to'],
+                created_from=options['created_from'],
+                created_to=options['created_to'],
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        lines = iter_export(queryset, export_format=options['output_format'], chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='') as output:
+            output.writelines(lines)
@@ -0,0 +1,11 @@
+""" Module to define command deleting expired idempotency keys """
+from django.core.management.base import BaseCommand
+
+from prescription.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = 'Delete expired Idempotency-Key responses'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Idempotency keys deleted: {purge_expired_keys()}')
@@ -0,0 +1,250 @@
+""" Module to define metric delivery out of the request path """
+import atexit
+import hashlib
+import logging
+import queue
+import threading
+import time
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from prescription.models import MetricOutbox
+from prescription.utils import ExternalServiceContext
+
+logger = logging.getLogger(__name__)
+
+
+def deliver_metrics(payloads: list, keys: list = None) -> None:
+    """ Function to post metric payloads, in one request when metric service has a batch_endpoint configured.
+    keys are the idempotency keys of payloads, kept by every delivery of a payload, by default new ones """
+    keys = keys or [None] * len(payloads)
+    batch_endpoint = settings.EXTERNAL_SERVICES[settings.EXTERNAL_METRIC].get('batch_endpoint')
+    if batch_endpoint:
+        ExternalServiceContext(
+            service=settings.EXTERNAL_METRIC,
+            method='POST',
+            endpoint=batch_endpoint,
+            data=payloads,
+            idempotency_key=batch_key(keys),
+        ).do_request()
+        return
+    for payload, key in zip(payloads, keys):
+        ExternalServiceContext(
+            service=settings.EXTERNAL_METRIC,
+            method='POST',
+            endpoint='/metrics/',
+            data=payload,
+            idempotency_key=key,
+        ).do_request()
+
+
+def batch_key(keys: list):
+    """ Function to get the idempotency key of a batch from the keys of its payloads, None when one is missing """
+    if not keys or None in keys:
+        return None
+    if len(keys) == 1:
+        return keys[0]
+    return hashlib.sha256(','.join(keys).encode()).hexdigest()
+
+
+def outbox_key(row: MetricOutbox) -> str:
+    """ Function to get the idempotency key of an outbox row, the same on every attempt to deliver it """
+    return f'outbox-{row.pk}-{row.created_at:%Y%m%d%H%M%S%f}'
+
+
+def delivery_groups(items: list) -> list:
+    """ Function to split items in the groups sent with one request each, all of them when metric service has a
+    batch_endpoint configured, otherwise one group per item so a failed item doesn't fail the other ones """
+    if settings.EXTERNAL_SERVICES[settings.EXTERNAL_METRIC].get('batch_endpoint'):
+        return [items] if items else []
+    return [[item] for item in items]
+
+
+class MetricDispatcher:
+    """ Class to queue metric payloads and deliver them in batches from a background thread,
+    a batch is collected when it has batch_size payloads or flush_interval seconds after its first one,
+    then sent as split by delivery_groups """
+    STOP = object()
+
+    def __init__(self, send=deliver_metrics, max_queue: int = 1000, batch_size: int = 50,
+                 flush_interval: float = 1.0, put_timeout: float = 0.05) -> None:
+        self.send = send
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'dropped': 0,
+            'delivered': 0,
+            'failed': 0,
+            'batches': 0,
+        }
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='metric-dispatcher', daemon=True)
+                self._thread.start()
+
+    def submit(self, payload: dict) -> bool:
+        """ Method to queue payload with its idempotency key, when queue stays full for put_timeout seconds payload
+        is dropped """
+        self.start()
+        try:
+            self._queue.put((uuid.uuid4().hex, payload), timeout=self.put_timeout)
+        except queue.Full:
+            self._count('dropped')
+            logger.warning('Metric queue is full, metric dropped')
+            return False
+        self._count('submitted')
+        return True
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+
+    def _collect(self, first) -> tuple:
+        """ Method to collect a batch starting with first, it returns (batch, stop requested) """
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is self.STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is self.STOP:
+                break
+            batch, stop = self._collect(item)
+            self._deliver(batch)
+
+    def _deliver(self, batch: list) -> None:
+        self._count('batches')
+        for group in delivery_groups(batch):
+            try:
+                self.send([payload for _, payload in group], keys=[key for key, _ in group])
+            except Exception:  # ValidationError with code 04 included
+                self._count('failed', len(group))
+                logger.exception('Unable to deliver %s metrics', len(group))
+                continue
+            self._count('delivered', len(group))
+
+    def close(self, timeout: float = 5) -> None:
+        """ Method to flush queued payloads and stop background thread """
+        with self._lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout=timeout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, queued=self._queue.qsize())
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def metric_dispatcher() -> MetricDispatcher:
+    """ Function to get the process metric dispatcher, flushed at interpreter exit """
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = MetricDispatcher(**settings.METRIC_DISPATCHER)
+                atexit.register(_dispatcher.close)
+    return _dispatcher
+
+
+def dispatcher_stats() -> dict:
+    """ Function to get stats of the metric dispatcher, empty when it was never started """
+    return _dispatcher.snapshot() if _dispatcher is not None else {}
+
+
+def outbox_backoff(attempts: int) -> timedelta:
+    """ Function to get the exponential wait before retrying an outbox row failed attempts times """
+    options = settings.METRIC_OUTBOX
+    return timedelta(seconds=min(options['backoff'] * 2 ** (attempts - 1), options['max_backoff']))
+
+
+def claim_outbox(batch_size: int, lease: float) -> list:
+    """ Function to claim up to batch_size pending outbox rows during lease seconds, a row whose claim
+    expires without ack can be claimed by another drainer """
+    now = timezone.now()
+    pending = MetricOutbox.objects.filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now),
+        delivered_at__isnull=True,
+        available_at__lte=now,
+        attempts__lt=settings.METRIC_OUTBOX['max_attempts'],
+    )
+    ids = list(pending.order_by('id').values_list('id', flat=True)[:batch_size])
+    token = uuid.uuid4()
+    pending.filter(id__in=ids).update(claim_token=token, claimed_until=now + timedelta(seconds=lease))
+    return list(MetricOutbox.objects.filter(claim_token=token).order_by('id'))
+
+
+def ack_outbox(rows: list) -> None:
+    MetricOutbox.objects.filter(
+        id__in=[row.id for row in rows],
+        claim_token=rows[0].claim_token,
+    ).update(delivered_at=timezone.now(), claim_token=None, claimed_until=None)
+
+
+def fail_outbox(rows: list, error: Exception) -> None:
+    """ Function to release failed rows with an attempt more, rows claimed again by another drainer since their
+    lease expired are left to it """
+    now = timezone.now()
+    attempts = {}
+    for row in rows:
+        attempts.setdefault(row.attempts + 1, []).append(row.id)
+    for attempt, ids in attempts.items():
+        MetricOutbox.objects.filter(id__in=ids, claim_token=rows[0].claim_token).update(
+            attempts=attempt,
+            available_at=now + outbox_backoff(attempt),
+            claim_token=None,
+            claimed_until=None,
+            last_error=repr(error),
+        )
+
+
+def drain_outbox(batch_size: int = None, send=None) -> tuple:
+    """ Function to deliver a batch of pending outbox rows, returns (delivered, failed) count. Rows are sent in
+    one request when metric service has a batch_endpoint, otherwise each row is sent and acked by its own """
+    options = settings.METRIC_OUTBOX
+    send = send or deliver_metrics
+    rows = claim_outbox(batch_size=batch_size or options['batch_size'], lease=options['lease'])
+    delivered = failed = 0
+    for group in delivery_groups(rows):
+        try:
+            send([row.payload for row in group], keys=[outbox_key(row) for row in group])
+        except Exception as exc:  # ValidationError with code 04 included
+            fail_outbox(group, error=exc)
+            failed += len(group)
+            continue
+        ack_outbox(group)
+        delivered += len(group)
+    return delivered, failed
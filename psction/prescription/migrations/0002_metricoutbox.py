@@ -0,0 +1,32 @@
+# Generated by Django 3.1.4 on 2026-10-18 15:46
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prescription', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('claim_token', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('claimed_until', models.DateTimeField(blank=True, null=True)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='metricoutbox',
+            index=models.Index(fields=['delivered_at', 'available_at'], name='outbox_pending_idx'),
+        ),
+    ]
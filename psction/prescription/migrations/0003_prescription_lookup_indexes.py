@@ -0,0 +1,25 @@
+# Generated by Django 3.1.4 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prescription', '0002_metricoutbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['patient_id', 'id'], name='prescription_patient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['physician_id', 'id'], name='prescription_physician_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='prescription',
+            index=models.Index(fields=['clinic_id', 'id'], name='prescription_clinic_idx'),
+        ),
+    ]
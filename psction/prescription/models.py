@@ -1,16 +1,44 @@
 """ Module to define model structure """
 
 from django.db import models
+from django.db import transaction
+from django.utils import timezone
 
 
 # Create your models here.
 
+class PrescriptionManager(models.Manager):
+    """ Class defining Prescription manager """
+
+    def bulk_insert(self, instances: list) -> list:
+        """ Method to insert instances in one transaction and set their ids """
+        with transaction.atomic(using=self.db):
+            created = self.bulk_create(instances)
+            if created and created[0].pk is None:
+                # SQLite backend can't return ids of a bulk insert on this Django version, while this
+                # transaction holds the write lock its rows are the last inserted, so ids are read back in order
+                ids = self.order_by('-id').values_list('id', flat=True)[:len(created)]
+                for instance, pk in zip(created, reversed(list(ids))):
+                    instance.pk = pk
+        return created
+
+
 class Prescription(models.Model):
     """ Class defining Prescription database table schema """
     clinic_id = models.IntegerField(null=True, blank=True)
     physician_id = models.IntegerField()
     patient_id = models.IntegerField()
     description = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True, null=True, db_index=True)
+
+    objects = PrescriptionManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient_id', 'id'], name='prescription_patient_idx'),
+            models.Index(fields=['physician_id', 'id'], name='prescription_physician_idx'),
+            models.Index(fields=['clinic_id', 'id'], name='prescription_clinic_idx'),
+        ]
 
     def __str__(self):
         """ Defining display text """
@@ -41,3 +69,44 @@ class Prescription(models.Model):
     def text(self):
         """ Defining property to define display attribute """
         return self.description
+
+
+class MetricOutbox(models.Model):
+    """ Class defining metric events saved with their prescription and pending to be delivered """
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    claim_token = models.UUIDField(null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['delivered_at', 'available_at'], name='outbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        """ Defining display text """
+        return f'[{self.id}] attempts: {self.attempts} delivered: {self.delivered_at}'
+
+
+class IdempotencyKey(models.Model):
+    """ Class defining Idempotency-Key header values, claimed by the request doing the work and then holding its
+    response to answer retries until expires_at """
+    key = models.CharField(max_length=255, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    locked_until = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        """ Defining display text """
+        return f'[{self.key}] status: {self.status_code}'
+
+    @property
+    def completed(self) -> bool:
+        return self.status_code is not None
@@ -0,0 +1,201 @@
+""" Module to define a keep-alive http connection pool shared by external services """
+import threading
+import time
+
+from collections import deque
+
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPSConnection
+from http.client import RemoteDisconnected
+
+from urllib.error import HTTPError
+from urllib.error import URLError
+from urllib.parse import urlsplit
+from urllib.request import Request
+
+
+class PooledResponse:
+    """ Class holding an already read response, so its connection can go back to the pool """
+
+    def __init__(self, status: int, reason: str, headers, body: bytes) -> None:
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self) -> bytes:
+        return self.body
+
+
+class ConnectionPool:
+    """ Class to keep idle keep-alive connections to one base_url and reuse them between requests """
+
+    STALE_ERRORS = (RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+    def __init__(self, base_url: str, maxsize: int = 10, idle_timeout: float = 60) -> None:
+        """ Initializing pool, connections are opened lazily and at most maxsize idle ones are kept """
+        parts = urlsplit(base_url)
+        self.base_url = base_url
+        self.connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.stats = {
+            'requests': 0,
+            'created': 0,
+            'reused': 0,
+            'evicted': 0,
+            'discarded': 0,
+            'errors': 0,
+        }
+
+    def _evict(self, now: float) -> None:
+        """ Method to close idle connections unused for more than idle_timeout, oldest are on the left """
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            connection, _last_used = self._idle.popleft()
+            connection.close()
+            self.stats['evicted'] += 1
+
+    def _acquire(self, timeout: float):
+        with self._lock:
+            self.stats['requests'] += 1
+            self._in_use += 1
+            self._evict(now=time.monotonic())
+            if self._idle:
+                connection, _last_used = self._idle.pop()
+                self.stats['reused'] += 1
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+            self.stats['created'] += 1
+        return self.connection_class(self.host, self.port, timeout=timeout), False
+
+    def _release(self, connection, reusable: bool) -> None:
+        with self._lock:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.maxsize:
+                self._idle.append((connection, time.monotonic()))
+                return
+            if reusable:
+                self.stats['discarded'] += 1
+        connection.close()
+
+    def prime(self, count: int, timeout: float = 5) -> int:
+        """ Method to open idle connections ahead of traffic until count are idle, returns how many were opened """
+        opened = 0
+        while True:
+            with self._lock:
+                if len(self._idle) >= min(count, self.maxsize):
+                    return opened
+            connection = self.connection_class(self.host, self.port, timeout=timeout)
+            try:
+                connection.connect()
+            except OSError:
+                connection.close()
+                with self._lock:
+                    self.stats['errors'] += 1
+                return opened
+            with self._lock:
+                self.stats['created'] += 1
+                self._idle.append((connection, time.monotonic()))
+            opened += 1
+
+    def urlopen(self, request_obj: Request, timeout: float = 30) -> PooledResponse:
+        """ Method to send request_obj over a pooled connection, it follows urllib.request.urlopen
+        conventions raising HTTPError for error status and URLError for connection failures.
+        A reused connection closed by server while idle is retried once over a new one. """
+        headers = dict(request_obj.header_items())
+        while True:
+            connection, reused = self._acquire(timeout=timeout)
+            try:
+                connection.request(
+                    method=request_obj.get_method(),
+                    url=request_obj.selector,
+                    body=request_obj.data,
+                    headers=headers,
+                )
+                response = connection.getresponse()
+                body = response.read()
+            except self.STALE_ERRORS as exc:
+                self._release(connection, reusable=False)
+                if reused:
+                    continue
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise URLError(exc)
+            except (OSError, HTTPException) as exc:  # socket errors and broken responses like IncompleteRead
+                self._release(connection, reusable=False)
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise URLError(exc)
+            self._release(connection, reusable=not response.will_close)
+            break
+        if response.status >= 400:
+            raise HTTPError(
+                url=request_obj.full_url,
+                code=response.status,
+                msg=response.reason,
+                hdrs=response.headers,
+                fp=None,
+            )
+        return PooledResponse(
+            status=response.status,
+            reason=response.reason,
+            headers=response.headers,
+            body=body,
+        )
+
+    def snapshot(self) -> dict:
+        """ Method to get pool usage stats """
+        with self._lock:
+            return dict(
+                self.stats,
+                idle=len(self._idle),
+                in_use=self._in_use,
+                maxsize=self.maxsize,
+            )
+
+    def close(self) -> None:
+        """ Method to close every idle connection """
+        with self._lock:
+            while self._idle:
+                connection, _last_used = self._idle.pop()
+                connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(base_url: str, maxsize: int = 10, idle_timeout: float = 60) -> ConnectionPool:
+    """ Function to get the pool of base_url, services sharing base_url share the pool """
+    pool = _pools.get(base_url)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(base_url)
+            if pool is None:
+                pool = _pools[base_url] = ConnectionPool(
+                    base_url=base_url,
+                    maxsize=maxsize,
+                    idle_timeout=idle_timeout,
+                )
+    return pool
+
+
+def pool_stats() -> dict:
+    """ Function to get stats of every pool keyed by base_url """
+    return {base_url: pool.snapshot() for base_url, pool in list(_pools.items())}
+
+
+def close_pools() -> None:
+    """ Function to close and forget every pool """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,128 @@
+""" Module to define sampled profiling of live requests, saved as cProfile stats files """
+import asyncio
+import cProfile
+import hmac
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+
+_upstreams = ContextVar('prescription_profiled_upstreams', default=None)
+_profiling = threading.local()
+
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+def record_upstream(service: str) -> None:
+    """ Function to note a request to service when the current request is profiled, otherwise it does nothing """
+    upstreams = _upstreams.get()
+    if upstreams is not None:
+        upstreams[service] = upstreams.get(service, 0) + 1
+
+
+def should_profile(request) -> bool:
+    """ Function to decide whether request is profiled, a sampled rate of the profiled paths or any request with
+    the privileged header holding the profiling token """
+    options = settings.PROFILING
+    if request.method != 'POST' or request.path_info.rstrip('/') not in options['paths']:
+        return False
+    token = options['token']
+    forced = request.headers.get(options['header'])
+    if forced and token and hmac.compare_digest(forced.encode(), token.encode()):
+        return True
+    return options['rate'] > 0 and random.random() < options['rate']
+
+
+def request_id(request) -> str:
+    """ Function to get the id of request from its X-Request-ID header when it is safe in a file name """
+    value = request.headers.get('X-Request-ID', '')
+    return value if REQUEST_ID_PATTERN.fullmatch(value) else uuid.uuid4().hex
+
+
+def save_profile(profile: cProfile.Profile, name: str) -> Path:
+    """ Function to write profile stats in the profiles directory, keeping only its newest files """
+    options = settings.PROFILING
+    directory = Path(options['directory'])
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / name
+    temporary = directory / f'.{name}.tmp'
+    profile.dump_stats(temporary)
+    os.replace(temporary, path)
+    files = sorted(directory.glob('*.prof'), key=lambda file: file.stat().st_mtime, reverse=True)
+    for old in files[options['keep']:]:
+        try:
+            old.unlink()
+        except OSError:
+            pass
+    return path
+
+
+def profile_name(request_id_: str, wall: float, upstreams: dict) -> str:
+    """ Function to get file name of a profile tagged with request id, wall milliseconds and services called """
+    services = '+'.join(sorted(upstreams)) or 'none'
+    return f'{time.strftime("%Y%m%dT%H%M%S")}-{request_id_}-{wall * 1000:.0f}ms-{services}.prof'
+
+
+class ProfilingMiddleware:
+    """ Middleware profiling sampled requests with cProfile, only one request per thread is profiled at a time,
+    on the event loop the profile also holds the work of requests running meanwhile """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not should_profile(request) or getattr(_profiling, 'active', False):
+            return self.get_response(request)
+        profile, token, start = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            upstreams = self._stop(profile, token)
+        return self._finish(request, response, profile, upstreams, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        if not should_profile(request) or getattr(_profiling, 'active', False):
+            return await self.get_response(request)
+        profile, token, start = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            upstreams = self._stop(profile, token)
+        return self._finish(request, response, profile, upstreams, time.perf_counter() - start)
+
+    @staticmethod
+    def _start() -> tuple:
+        _profiling.active = True
+        token = _upstreams.set({})
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        return profile, token, start
+
+    @staticmethod
+    def _stop(profile: cProfile.Profile, token) -> dict:
+        profile.disable()
+        upstreams = _upstreams.get()
+        _upstreams.reset(token)
+        _profiling.active = False
+        return upstreams
+
+    @staticmethod
+    def _finish(request, response, profile: cProfile.Profile, upstreams: dict, wall: float):
+        path = save_profile(profile, profile_name(request_id(request), wall, upstreams))
+        response['X-Profile-File'] = path.name
+        return response
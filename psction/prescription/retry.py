@@ -0,0 +1,131 @@
+""" Module to define retries of failed external requests with jittered exponential backoff """
+import asyncio
+import random
+import threading
+import time
+
+from prescription.exceptions import ExternalApiError
+from prescription.exceptions import ExternalServiceUnavailable
+
+
+class RetryPolicy:
+    """ Class calling a function again when it fails with a retryable ExternalApiError, at most attempts times.
+    Before each retry it waits a random time up to backoff seconds doubled on every retry and capped by max_backoff
+    (full jitter), a retry whose wait would reach the deadline is not done. retry_on holds the retryable statuses,
+    a class like '5xx', a status like '429', and 'connection' for connection errors and timeouts without status.
+    Requests rejected before being sent, like an open breaker or a shed request, are never retried """
+
+    def __init__(self, attempts: int = 2, backoff: float = 0.05, max_backoff: float = 0.5,
+                 retry_on: tuple = ('connection', '5xx', '429')) -> None:
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = frozenset(retry_on)
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'retries': 0,
+            'recovered': 0,
+            'exhausted': 0,
+        }
+
+    def retryable(self, exc: ExternalApiError) -> bool:
+        if isinstance(exc, ExternalServiceUnavailable):
+            return False
+        if exc.status is None:
+            return 'connection' in self.retry_on
+        return str(exc.status) in self.retry_on or f'{exc.status // 100}xx' in self.retry_on
+
+    def delay(self, retry: int) -> float:
+        """ Method to get the wait before retry number retry, counted from 1 """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+    def _next_delay(self, exc: ExternalApiError, attempt: int, deadline: float = None):
+        """ Method to get the wait before retrying a call failed with exc on attempt, None when it is not retried """
+        if attempt >= self.attempts or not self.retryable(exc):
+            return None
+        delay = self.delay(attempt)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def call(self, function, deadline: float = None):
+        """ Method to call function retrying it, deadline is the monotonic time no retry starts after """
+        self._count('calls')
+        attempt = 1
+        while True:
+            try:
+                result = function()
+            except ExternalApiError as exc:
+                delay = self._next_delay(exc, attempt, deadline)
+                if delay is None:
+                    if attempt > 1:
+                        self._count('exhausted')
+                    raise
+                self._count('retries')
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if attempt > 1:
+                self._count('recovered')
+            return result
+
+    async def acall(self, function, deadline: float = None):
+        """ Coroutine counterpart of call, function is a coroutine function """
+        self._count('calls')
+        attempt = 1
+        while True:
+            try:
+                result = await function()
+            except ExternalApiError as exc:
+                delay = self._next_delay(exc, attempt, deadline)
+                if delay is None:
+                    if attempt > 1:
+                        self._count('exhausted')
+                    raise
+                self._count('retries')
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if attempt > 1:
+                self._count('recovered')
+            return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def service_retry(service_name: str, config: dict):
+    """ Function to get the retry policy of service configured by its 'retry' options, None when it is not retried """
+    options = config.get('retry')
+    if not options or not options.get('enabled'):
+        return None
+    policy = _policies.get(service_name)
+    if policy is None or policy.options != options:
+        with _policies_lock:
+            policy = _policies.get(service_name)
+            if policy is None or policy.options != options:
+                policy = _policies[service_name] = RetryPolicy(
+                    **{key: value for key, value in options.items() if key != 'enabled'}
+                )
+                policy.options = options
+    return policy
+
+
+def retry_stats() -> dict:
+    """ Function to get retries counters of every service """
+    return {service_name: policy.snapshot() for service_name, policy in list(_policies.items())}
+
+
+def reset_retries() -> None:
+    with _policies_lock:
+        _policies.clear()
@@ -0,0 +1,117 @@
+""" Module to define request coalescing of identical concurrent external requests """
+import asyncio
+import threading
+import time
+
+from prescription.exceptions import DeadlineExceeded
+from prescription.exceptions import ExternalApiError
+
+
+class _Call:
+    """ Class holding an in-flight call outcome for the callers waiting it """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """ Class to share one in-flight call, and its result or exception, between concurrent callers of the same key.
+    Threads share calls of the process, coroutines share calls of their event loop """
+
+    def __init__(self) -> None:
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'shared': 0,
+        }
+
+    def do(self, key, function, timeout: float = None):
+        """ Method to call function, or wait the result of the call already in flight for key. A caller joining
+        a call waits it at most timeout seconds, ExternalApiError is raised when it is still in flight. The budget
+        of a request is its own, when the joined call ran out of its caller budget function is called again """
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self.stats['calls'] += 1
+                else:
+                    self.stats['shared'] += 1
+            if leader:
+                break
+            if not call.done.wait(None if expires_at is None else max(0.0, expires_at - time.monotonic())):
+                raise ExternalApiError
+            if isinstance(call.exception, DeadlineExceeded):
+                continue
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = function()
+        except Exception as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def ado(self, key, function, timeout: float = None):
+        """ Coroutine counterpart of do, function is a coroutine function. When the leading caller is cancelled the
+        joined callers call function again """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                future = self._async_calls.get(loop_key)
+                leader = future is None
+                if leader:
+                    future = self._async_calls[loop_key] = loop.create_future()
+                    self.stats['calls'] += 1
+                else:
+                    self.stats['shared'] += 1
+            if leader:
+                break
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(future),
+                    None if expires_at is None else max(0.0, expires_at - time.monotonic()),
+                )
+            except asyncio.TimeoutError:
+                raise ExternalApiError
+            except DeadlineExceeded:
+                continue
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                continue  # the leader was cancelled, not this caller, so the call is made again
+        try:
+            result = await function()
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # retrieved by the leader, waiters get it from await
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._async_calls[loop_key]
+        return result
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._calls) + len(self._async_calls))
+
+
+single_flight = SingleFlight()
@@ -1,48 +1,121 @@
 """ Module to define prescription app tests """
+import asyncio
+import pstats
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import timedelta
+from functools import partial
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest.mock import Mock
+from unittest.mock import patch, MagicMock
 from urllib.error import HTTPError
+from urllib.parse import urljoin
 from urllib.request import Request
-from unittest.mock import patch, MagicMock
-from unittest.mock import Mock
 
+from django.conf import settings
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import override_settings
+from django.test import RequestFactory
 from django.test import TestCase
+from django.utils import timezone
+
+from rest_framework import serializers
 from rest_framework import status
 from rest_framework.utils import json
 
+from prescription.batch import BatchLoader
+from prescription.batch import reset_loaders
+from prescription.benchmark import compare
+from prescription.benchmark import stub_external_services
+from prescription.benchmark import StubServer
+from prescription.benchmark import summarize
+from prescription.breaker import CircuitBreaker
+from prescription.breaker import reset_breakers
+from prescription.cache import TTLCache
+from prescription.deadline import current_deadline
+from prescription.deadline import deadline
+from prescription.deadline import request_budget
+from prescription.deadline import time_left
+from prescription.exceptions import DeadlineExceeded
 from prescription.exceptions import ExternalApiError, ExternalResourceNotFound
+from prescription.exceptions import ExternalServiceUnavailable
+from prescription.exceptions import ServiceOverloaded
+from prescription.hedge import HedgePool
+from prescription.hedge import Hedger
+from prescription.idempotency import acquire_key
+from prescription.idempotency import complete_key
+from prescription.idempotency import IdempotencyKeyInProgress
+from prescription.idempotency import IdempotencyKeyMismatch
+from prescription.instrumentation import Histogram
+from prescription.instrumentation import timed
+from prescription.limiter import ConcurrencyLimiter
+from prescription.metrics import claim_outbox
+from prescription.metrics import deliver_metrics
+from prescription.metrics import drain_outbox
+from prescription.metrics import fail_outbox
+from prescription.metrics import MetricDispatcher
+from prescription.metrics import outbox_key
+from prescription.models import IdempotencyKey
+from prescription.models import MetricOutbox
+from prescription.models import Prescription
+from prescription.pool import close_pools
+from prescription.pool import ConnectionPool
+from prescription.pool import pool_stats
+from prescription.profiling import ProfilingMiddleware
+from prescription.profiling import record_upstream
+from prescription.retry import reset_retries
+from prescription.retry import RetryPolicy
+from prescription.singleflight import SingleFlight
 from prescription.utils import api_request
-from prescription.utils import prepare_request_obj
+from prescription.utils import async_api_request
+from prescription.utils import ExternalServiceContext
+from prescription.utils import PhysicianExternalService
+from prescription.utils import service_client
+from prescription.utils import ServiceClient
+from prescription.warmup import warm_up
+from prescription.writer import enable_sqlite_wal
+from prescription.writer import GroupCommitWriter
+from prescription.writer import write_prescriptions
+from prescription.writer import WriterUnavailable
 
 
 # Create your tests here.
 
 class TestingUtilFunction(TestCase):
 
-    def test_should_prepare_request_obj_add_always_json_content_type_on_headers(self):
+    def test_should_client_request_obj_add_always_json_content_type_on_headers(self):
         """ Testing Content-Type header always with application/json value """
         config = {
             'base_url': 'http://8.8.8.8/',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
         )
         self.assertEqual(request_.headers.get('Content-type'), 'application/json')
 
-    def test_should_prepare_request_obj_add_authorization_header_if_config_has_auth_toke(self):
+    def test_should_client_request_obj_add_authorization_header_if_config_has_auth_toke(self):
         """ Testing Authorization header is set when config has auth_toke set """
         config = {
             'base_url': 'http://8.8.8.8/',
             'auth_token': 'JWT token_text',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
         )
         self.assertEqual(request_.headers.get('Authorization'), config['auth_token'])
 
-    def test_should_prepare_request_obj_raise_key_error_if_config_has_not_base_url(self):
+    def test_should_client_request_obj_raise_key_error_if_config_has_not_base_url(self):
         """ Testing that fnc raise Key Error when config dict has not base_url information """
         configs = [
             {},
@@ -50,20 +123,18 @@ class TestingUtilFunction(TestCase):
         ]
         for config in configs:
             with self.assertRaises(KeyError):
-                prepare_request_obj(
-                    config=config,
+                ServiceClient('TEST', config, None).request_obj(
                     method='GET',
                     endpoint='/test.html',
                 )
 
-    def test_should_prepare_request_obj_accept_data_kwargs(self):
+    def test_should_client_request_obj_accept_data_kwargs(self):
         """ Testing that fnc accept data kwargs and add it like requests payload, and dont add it
         when type is different of dict"""
         config = {
             'base_url': 'http://8.8.8.8/',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
             data='not inserted',
@@ -72,21 +143,19 @@ class TestingUtilFunction(TestCase):
         data = {
             'testing': 'data payload',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
             data=data,
         )
         self.assertJSONEqual(request_.data, data)
 
-    def test_should_prepare_request_obj_return_a_request_object(self):
+    def test_should_client_request_obj_return_a_request_object(self):
         """ Testing that function return a urllib.request.Request object"""
         config = {
             'base_url': 'http://8.8.8.8/',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
         )
@@ -99,8 +168,7 @@ class TestingUtilFunction(TestCase):
         config = {
             'base_url': 'http://8.8.8.8/',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
         )
@@ -123,6 +191,25 @@ class TestingUtilFunction(TestCase):
             api_request(request_obj=request_)
         response_mock.read.assert_called_once()
 
+    @patch('prescription.utils.urlopen')
+    def test_api_request_should_trigger_external_resource_not_found_when_a_404_http_error_happen(self, mocked_urlopen):
+        """ Testing that ExternalResourceNotFound is raised when urlopen raise HTTPError with 404 code """
+        config = {
+            'base_url': 'http://8.8.8.8/',
+        }
+        request_ = ServiceClient('TEST', config, None).request_obj(
+            method='GET',
+            endpoint='/test.html',
+        )
+        mocked_urlopen.side_effect = HTTPError(
+            url='http://test.com',
+            code=404,
+            msg='not found', hdrs={},
+            fp=None
+        )
+        with self.assertRaises(ExternalResourceNotFound):
+            api_request(request_obj=request_)
+
     @patch('prescription.utils.urlopen')
     def test_api_request_should_trigger_external_resource_not_found_when_a_404_response_happen(self, mocked_urlopen):
         """ Testing that ExternalResourceNotFound is raised when a 404 response happen """
@@ -130,8 +217,7 @@ class TestingUtilFunction(TestCase):
         config = {
             'base_url': 'http://8.8.8.8/',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
         )
@@ -150,8 +236,7 @@ class TestingUtilFunction(TestCase):
         config = {
             'base_url': 'http://8.8.8.8/',
         }
-        request_ = prepare_request_obj(
-            config=config,
+        request_ = ServiceClient('TEST', config, None).request_obj(
             method='GET',
             endpoint='/test.html',
         )
@@ -164,3 +249,1246 @@ class TestingUtilFunction(TestCase):
         mocked_urlopen.return_value = response_mock
         response = api_request(request_obj=request_)
         self.assertJSONEqual(raw=raw_response, expected_data=response)
+
+
+class TestingServiceClient(TestCase):
+
+    def test_should_concatenate_endpoint_to_origin_or_directory(self):
+        cases = [
+            ('https://api.test/v1', '/clinics/1/', 'https://api.test/clinics/1/'),
+            ('https://api.test/v1', 'clinics/1/', 'https://api.test/clinics/1/'),
+            ('https://api.test/v1/', 'clinics/1/', 'https://api.test/v1/clinics/1/'),
+            ('https://api.test/v1/', 'physicians?ids=1,2', 'https://api.test/v1/physicians?ids=1,2'),
+            ('http://api.test', 'metrics/', 'http://api.test/metrics/'),
+            ('http://127.0.0.1:8000/v1/', '/metrics/', 'http://127.0.0.1:8000/metrics/'),
+            ('https://api.test/v1/', '#top', 'https://api.test/v1/#top'),
+            ('https://api.test/v1', '#top', 'https://api.test/#top'),
+            ('https://api.test/v1/', 'a;b', 'https://api.test/v1/a;b'),
+        ]
+        for base_url, endpoint, url in cases:
+            with self.subTest(base_url=base_url, endpoint=endpoint):
+                self.assertEqual(ServiceClient('CLINIC', {'base_url': base_url}, None).url(endpoint), url)
+
+    def test_should_join_urls_with_urljoin_when_endpoint_is_not_a_plain_path(self):
+        bases = ['https://api.test/v1', 'https://api.test/v1/', 'http://127.0.0.1:8000/', 'http://api.test']
+        endpoints = ['', '?page=2', '../up/', './here', '//other.test/path', 'https://other.test/path', 'file.json']
+        for base_url in bases:
+            client = ServiceClient('CLINIC', {'base_url': base_url}, None)
+            for endpoint in endpoints:
+                with self.subTest(base_url=base_url, endpoint=endpoint):
+                    self.assertEqual(client.url(endpoint), urljoin(base_url, endpoint))
+
+    def test_should_create_request_with_client_config(self):
+        config = {'base_url': 'https://api.test/v1', 'auth_token': 'Bearer token'}
+        client = ServiceClient('METRIC', config, None)
+        for data, body in ((None, None), ({'id': 1}, b'{"id": 1}'), ([{'id': 1}], b'[{"id": 1}]'), ('text', None)):
+            request_obj = client.request_obj(method='POST', endpoint='/metrics/', data=data)
+            self.assertEqual(
+                (request_obj.full_url, request_obj.get_method(), request_obj.headers, request_obj.data),
+                (
+                    'https://api.test/metrics/',
+                    'POST',
+                    {'Content-type': 'application/json', 'Authorization': 'Bearer token'},
+                    body,
+                ),
+            )
+
+    def test_should_reuse_client_until_settings_change(self):
+        client = service_client('CLINIC')
+        self.assertIs(service_client('CLINIC'), client)
+        services = {'CLINIC': {'base_url': 'https://clinics.test/'}}
+        with override_settings(EXTERNAL_SERVICES=services):
+            changed = ExternalServiceContext(service='CLINIC', method='GET', endpoint='clinics/1/').strategy
+            self.assertEqual(changed.request_obj.full_url, 'https://clinics.test/clinics/1/')
+            self.assertRaises(ValueError, service_client, 'PATIENT')
+        self.assertEqual(service_client('CLINIC').base_url, client.base_url)
+
+
+class StubServiceHandler(BaseHTTPRequestHandler):
+    """ Keep-alive json handler answering 404 for /missing/ paths, the status of /status/<code>/ paths, closing
+    the connection after /close/ paths and after a body shorter than its Content-Length for /short/ paths """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        code = status.HTTP_404_NOT_FOUND if self.path.startswith('/missing/') else status.HTTP_200_OK
+        if self.path.startswith('/status/'):
+            code = int(self.path.split('/')[2])
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(code)
+        if self.path.startswith('/close/'):
+            self.send_header('Connection', 'close')
+        self.send_header('Content-Type', 'application/json')
+        if self.path.startswith('/short/'):
+            self.send_header('Content-Length', str(len(body) + 10))
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServiceTestCase(TestCase):
+    """ TestCase serving StubServiceHandler on a local port """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubServiceHandler)
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}/'
+        cls.service = ServiceClient('STUB', {'base_url': cls.base_url}, None)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+
+class TestingConnectionPool(StubServiceTestCase):
+
+    def test_should_reuse_keep_alive_connection(self):
+        """ Testing that sequential requests share one connection """
+        pool = ConnectionPool(base_url=self.base_url, maxsize=2)
+        for _ in range(3):
+            request_ = self.service.request_obj(method='GET', endpoint='/one/')
+            self.assertEqual(api_request(request_obj=request_, pool=pool), {'path': '/one/'})
+        stats = pool.snapshot()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['idle'], 1)
+        pool.close()
+
+    def test_should_evict_idle_connections(self):
+        """ Testing that connections idle for more than idle_timeout are closed instead of reused """
+        pool = ConnectionPool(base_url=self.base_url, maxsize=2, idle_timeout=0)
+        for _ in range(2):
+            request_ = self.service.request_obj(method='GET', endpoint='/one/')
+            api_request(request_obj=request_, pool=pool)
+        stats = pool.snapshot()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['evicted'], 1)
+        pool.close()
+
+    def test_should_raise_http_error_on_error_status_and_keep_connection(self):
+        """ Testing that pooled error responses follow urlopen behavior """
+        pool = ConnectionPool(base_url=self.base_url)
+        request_ = self.service.request_obj(method='GET', endpoint='/missing/')
+        with self.assertRaises(HTTPError):
+            pool.urlopen(request_)
+        with self.assertRaises(ExternalResourceNotFound):
+            api_request(request_obj=request_, pool=pool)
+        self.assertEqual(pool.snapshot()['created'], 1)
+        pool.close()
+
+
+    def test_should_release_connection_and_raise_api_error_on_broken_response(self):
+        """ Testing that a body shorter than its Content-Length is an ExternalApiError and frees its connection """
+        pool = ConnectionPool(base_url=self.base_url)
+        request_ = self.service.request_obj(method='GET', endpoint='/short/')
+        with self.assertRaises(ExternalApiError):
+            api_request(request_obj=request_, pool=pool)
+        stats = pool.snapshot()
+        self.assertEqual((stats['in_use'], stats['idle'], stats['errors']), (0, 0, 1))
+        with self.assertRaises(ExternalApiError):
+            api_request(request_obj=request_)
+        pool.close()
+
+
+class TestingWarmUp(StubServiceTestCase):
+
+    def test_should_prime_idle_connections(self):
+        pool = ConnectionPool(base_url=self.base_url, maxsize=2)
+        self.assertEqual(pool.prime(3), 2)
+        self.assertEqual(pool.prime(3), 0)
+        request_ = self.service.request_obj(method='GET', endpoint='/one/')
+        api_request(request_obj=request_, pool=pool)
+        self.assertEqual((pool.snapshot()['created'], pool.snapshot()['reused']), (2, 1))
+        pool.close()
+
+    def test_should_warm_up_resolver_database_and_pools(self):
+        services = {name: {'base_url': self.base_url} for name in ('CLINIC', 'PATIENT')}
+        with override_settings(EXTERNAL_SERVICES=services,
+                               EXTERNAL_HTTP_POOL={'enabled': True, 'maxsize': 4, 'idle_timeout': 60}):
+            self.addCleanup(close_pools)
+            summary = warm_up(prime_connections=3)
+            self.assertEqual(summary['primed_connections'], {self.base_url: 3})
+            self.assertEqual(pool_stats()[self.base_url]['idle'], 3)
+        self.assertGreater(summary['url_patterns'], 0)
+
+
+class TestingAsyncApiRequest(StubServiceTestCase):
+
+    def request(self, endpoint):
+        request_ = self.service.request_obj(method='GET', endpoint=endpoint)
+        return asyncio.run(async_api_request(request_obj=request_))
+
+    def test_should_return_a_dict_information(self):
+        self.assertEqual(self.request('/one/'), {'path': '/one/'})
+
+    def test_should_trigger_external_resource_not_found_when_a_404_response_happen(self):
+        with self.assertRaises(ExternalResourceNotFound):
+            self.request('/missing/')
+
+    def test_should_trigger_external_api_error_when_service_is_not_reachable(self):
+        client = ServiceClient('TEST', {'base_url': 'http://127.0.0.1:1/'}, None)
+        request_ = client.request_obj(method='GET', endpoint='/one/')
+        with self.assertRaises(ExternalApiError):
+            asyncio.run(async_api_request(request_obj=request_))
+
+    def test_should_trigger_external_api_error_when_status_is_not_success(self):
+        """ Testing that informational and redirect responses are errors with their status """
+        for code in (103, 204, 302, 500):
+            with self.subTest(code=code), self.assertRaises(ExternalApiError) as context:
+                self.request(f'/status/{code}/')
+            self.assertEqual(context.exception.status, code)
+
+    def test_should_send_over_the_service_pool(self):
+        """ Testing that async requests reuse the keep-alive connections of the sync client """
+        pool = ConnectionPool(base_url=self.base_url, maxsize=2)
+        for endpoint in ('/one/', '/two/'):
+            request_ = self.service.request_obj(method='GET', endpoint=endpoint)
+            self.assertEqual(asyncio.run(async_api_request(request_obj=request_, pool=pool)), {'path': endpoint})
+        self.assertEqual((pool.snapshot()['created'], pool.snapshot()['reused']), (1, 1))
+        pool.close()
+
+
+class TestingTTLCache(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.loader = Mock(return_value={'id': '1'})
+
+    def timer(self):
+        return self.now
+
+    def test_should_load_once_until_ttl_expires(self):
+        """ Testing that cached value is served until ttl and then loaded again """
+        cache = TTLCache(ttl=10, timer=self.timer)
+        self.assertEqual(cache.get_or_load('key', self.loader), {'id': '1'})
+        self.now = 9
+        self.assertEqual(cache.get_or_load('key', self.loader), {'id': '1'})
+        self.assertEqual(self.loader.call_count, 1)
+        self.now = 10
+        cache.get_or_load('key', self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+        stats = cache.snapshot()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expired']), (1, 2, 1))
+
+    def test_should_evict_least_recently_used(self):
+        """ Testing that cache keeps maxsize entries dropping the least recently used """
+        cache = TTLCache(maxsize=2, ttl=10, timer=self.timer)
+        cache.get_or_load('a', self.loader)
+        cache.get_or_load('b', self.loader)
+        cache.get_or_load('a', self.loader)
+        cache.get_or_load('c', self.loader)
+        self.assertEqual(self.loader.call_count, 3)
+        cache.get_or_load('a', self.loader)
+        self.assertEqual(self.loader.call_count, 3)
+        cache.get_or_load('b', self.loader)
+        self.assertEqual(self.loader.call_count, 4)
+        self.assertEqual(cache.snapshot()['evicted'], 2)
+
+    def test_should_cache_not_found_during_negative_ttl(self):
+        """ Testing that ExternalResourceNotFound is remembered only during negative_ttl """
+        cache = TTLCache(ttl=10, negative_ttl=1, timer=self.timer)
+        self.loader.side_effect = ExternalResourceNotFound
+        for _ in range(2):
+            with self.assertRaises(ExternalResourceNotFound):
+                cache.get_or_load('key', self.loader)
+        self.assertEqual(self.loader.call_count, 1)
+        self.assertEqual(cache.snapshot()['negative_hits'], 1)
+        self.now = 1
+        with self.assertRaises(ExternalResourceNotFound):
+            cache.get_or_load('key', self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_should_not_cache_external_api_errors(self):
+        """ Testing that service errors are never cached """
+        cache = TTLCache(ttl=10, negative_ttl=10, timer=self.timer)
+        self.loader.side_effect = ExternalApiError
+        for _ in range(2):
+            with self.assertRaises(ExternalApiError):
+                cache.get_or_load('key', self.loader)
+        self.assertEqual(self.loader.call_count, 2)
+
+
+class TestingMetricDispatcher(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.delivered = threading.Event()
+
+    def send(self, batch, keys=None):
+        self.batches.append(list(batch))
+        self.delivered.set()
+
+    @override_settings(EXTERNAL_SERVICES={
+        'METRIC': {'base_url': 'http://8.8.8.8/', 'batch_endpoint': '/metrics/batch/'},
+    })
+    def test_should_deliver_batch_when_batch_size_is_reached(self):
+        """ Testing that a full batch is sent without waiting flush_interval """
+        dispatcher = MetricDispatcher(send=self.send, batch_size=3, flush_interval=60)
+        for number in range(3):
+            self.assertTrue(dispatcher.submit({'number': number}))
+        self.assertTrue(self.delivered.wait(timeout=5))
+        self.assertEqual(self.batches, [[{'number': 0}, {'number': 1}, {'number': 2}]])
+        dispatcher.close()
+
+    def test_should_flush_queued_metrics_on_close(self):
+        """ Testing that close delivers pending metrics one by one before stopping """
+        dispatcher = MetricDispatcher(send=self.send, batch_size=10, flush_interval=60)
+        dispatcher.submit({'number': 0})
+        dispatcher.submit({'number': 1})
+        dispatcher.close()
+        self.assertEqual(self.batches, [[{'number': 0}], [{'number': 1}]])
+        self.assertEqual(dispatcher.snapshot()['delivered'], 2)
+
+    def test_should_deliver_other_metrics_of_batch_when_one_fails(self):
+        """ Testing that a failed payload doesn't stop the rest of its batch and is counted alone """
+        def send(batch, keys=None):
+            if batch == [{'number': 1}]:
+                raise ExternalApiError(status=500)
+            self.send(batch)
+
+        dispatcher = MetricDispatcher(send=send, batch_size=10, flush_interval=60)
+        for number in range(3):
+            dispatcher.submit({'number': number})
+        with self.assertLogs('prescription.metrics', level='ERROR'):
+            dispatcher.close()
+        self.assertEqual(self.batches, [[{'number': 0}], [{'number': 2}]])
+        stats = dispatcher.snapshot()
+        self.assertEqual((stats['delivered'], stats['failed'], stats['batches']), (2, 1, 1))
+
+    def test_should_drop_metrics_when_queue_is_full(self):
+        """ Testing backpressure, submit gives up after put_timeout when queue is full """
+        blocked = threading.Event()
+        dispatcher = MetricDispatcher(send=lambda batch, keys: blocked.wait(timeout=5), max_queue=1, batch_size=1,
+                                      put_timeout=0.01)
+        with self.assertLogs('prescription.metrics', level='WARNING'):
+            results = [dispatcher.submit({'number': number}) for number in range(5)]
+        self.assertFalse(all(results))
+        self.assertEqual(dispatcher.snapshot()['dropped'], results.count(False))
+        blocked.set()
+        dispatcher.close()
+
+    def test_should_count_failed_deliveries(self):
+        """ Testing that send errors are counted and don't stop dispatcher """
+        dispatcher = MetricDispatcher(send=Mock(side_effect=ExternalApiError), batch_size=1)
+        with self.assertLogs('prescription.metrics', level='ERROR'):
+            dispatcher.submit({'number': 0})
+            dispatcher.close()
+        self.assertEqual(dispatcher.snapshot()['failed'], 1)
+
+    def test_should_give_each_metric_its_idempotency_key(self):
+        """ Testing that every queued payload is sent with its own key """
+        send = Mock()
+        dispatcher = MetricDispatcher(send=send, batch_size=10, flush_interval=60)
+        dispatcher.submit({'number': 0})
+        dispatcher.submit({'number': 1})
+        dispatcher.close()
+        keys = [call.kwargs['keys'][0] for call in send.call_args_list]
+        self.assertEqual(len(set(keys)), 2)
+
+
+class TestingMetricOutbox(TestCase):
+
+    def setUp(self):
+        self.rows = [MetricOutbox.objects.create(payload={'number': number}) for number in range(3)]
+
+    def test_should_deliver_and_ack_pending_rows(self):
+        """ Testing that pending rows are sent one by one and marked as delivered """
+        send = Mock()
+        self.assertEqual(drain_outbox(send=send), (3, 0))
+        self.assertEqual(send.call_count, 3)
+        self.assertFalse(MetricOutbox.objects.filter(delivered_at__isnull=True).exists())
+        self.assertEqual(drain_outbox(send=send), (0, 0))
+
+    @override_settings(EXTERNAL_SERVICES={
+        'METRIC': {'base_url': 'http://8.8.8.8/', 'batch_endpoint': '/metrics/batch/'},
+    })
+    def test_should_deliver_rows_in_one_request_with_batch_endpoint(self):
+        """ Testing that rows are sent together when metric service accepts batches """
+        send = Mock()
+        self.assertEqual(drain_outbox(send=send), (3, 0))
+        send.assert_called_once_with([{'number': 0}, {'number': 1}, {'number': 2}],
+                                     keys=[outbox_key(row) for row in self.rows])
+
+    def test_should_send_same_idempotency_key_when_row_is_delivered_again(self):
+        """ Testing that a row failed or delivered without ack keeps its key on the next attempt """
+        send = Mock(side_effect=ExternalApiError)
+        drain_outbox(send=send)
+        MetricOutbox.objects.update(available_at=timezone.now())
+        send.side_effect = None
+        drain_outbox(send=send)
+        keys = [call.kwargs['keys'] for call in send.call_args_list]
+        self.assertEqual(keys[:3], keys[3:])
+        self.assertEqual(len({key for key, in keys}), 3)
+
+    def test_should_backoff_failed_rows(self):
+        """ Testing that failed rows are released with an attempt more and are not retried before backoff """
+        self.assertEqual(drain_outbox(send=Mock(side_effect=ExternalApiError)), (0, 3))
+        row = MetricOutbox.objects.get(id=self.rows[0].id)
+        self.assertEqual(row.attempts, 1)
+        self.assertIsNone(row.claim_token)
+        self.assertGreater(row.available_at, timezone.now())
+        self.assertEqual(drain_outbox(send=Mock()), (0, 0))
+
+    def test_should_not_fail_rows_claimed_again_by_another_drainer(self):
+        """ Testing that a drainer whose lease expired does not release rows another drainer claimed """
+        rows = claim_outbox(batch_size=10, lease=60)
+        MetricOutbox.objects.update(claimed_until=timezone.now())
+        claimed = claim_outbox(batch_size=10, lease=60)
+        fail_outbox(rows, error=ExternalApiError())
+        self.assertEqual(MetricOutbox.objects.filter(claim_token=claimed[0].claim_token, attempts=0).count(), 3)
+        fail_outbox(claimed, error=ExternalApiError())
+        self.assertEqual(MetricOutbox.objects.filter(claim_token__isnull=True, attempts=1).count(), 3)
+
+    def test_should_not_claim_rows_with_active_claim(self):
+        """ Testing that claimed rows are skipped by other drainers until lease expires """
+        self.assertEqual(len(claim_outbox(batch_size=2, lease=60)), 2)
+        self.assertEqual([row.id for row in claim_outbox(batch_size=10, lease=60)], [self.rows[2].id])
+        self.assertEqual(claim_outbox(batch_size=10, lease=60), [])
+        MetricOutbox.objects.update(claimed_until=timezone.now())
+        self.assertEqual(len(claim_outbox(batch_size=10, lease=60)), 3)
+
+    @patch('prescription.metrics.deliver_metrics')
+    def test_drain_command_should_deliver_every_pending_row(self, deliver_metrics):
+        """ Testing drain_metric_outbox command """
+        call_command('drain_metric_outbox', '--batch-size', '2', stdout=Mock())
+        self.assertEqual(MetricOutbox.objects.filter(delivered_at__isnull=False).count(), 3)
+
+
+class TestingCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, timer=lambda: self.now)
+        self.failing = Mock(side_effect=ExternalApiError)
+
+    def open_breaker(self):
+        for _ in range(2):
+            with self.assertRaises(ExternalApiError):
+                self.breaker.call(self.failing)
+
+    def test_should_open_after_consecutive_failures_and_fail_fast(self):
+        """ Testing that an open breaker rejects calls without calling service """
+        self.open_breaker()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(ExternalServiceUnavailable):
+            self.breaker.call(self.failing)
+        self.assertEqual(self.failing.call_count, 2)
+        self.assertEqual(self.breaker.snapshot()['rejected'], 1)
+
+    def test_should_not_count_not_found_as_failure(self):
+        """ Testing that not found responses keep breaker closed """
+        for _ in range(3):
+            with self.assertRaises(ExternalResourceNotFound):
+                self.breaker.call(Mock(side_effect=ExternalResourceNotFound))
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_should_close_when_half_open_trial_succeed(self):
+        """ Testing half open state lets one trial call and closes on success """
+        self.open_breaker()
+        self.now = 10
+        self.assertEqual(self.breaker.call(Mock(return_value={'id': 1})), {'id': 1})
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_should_open_again_when_half_open_trial_fails(self):
+        """ Testing half open state opens again on failure and rejects extra calls while trial is in flight """
+        self.open_breaker()
+        self.now = 10
+        self.breaker.before_call()
+        with self.assertRaises(ExternalServiceUnavailable):
+            self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.now = 15
+        with self.assertRaises(ExternalServiceUnavailable):
+            self.breaker.call(self.failing)
+
+    @override_settings(EXTERNAL_SERVICES={
+        'PHYSICIAN': {'base_url': 'http://8.8.8.8/', 'breaker': {'failure_threshold': 1, 'recovery_timeout': 60}},
+    })
+    @patch('prescription.utils.api_request', side_effect=ExternalApiError)
+    def test_open_breaker_should_keep_service_error_code(self, mocked_api_request):
+        """ Testing that requests rejected by breaker get the service not available error """
+        reset_breakers()
+        self.addCleanup(reset_breakers)
+        for _ in range(2):
+            with self.assertRaises(serializers.ValidationError) as error:
+                ExternalServiceContext(service='PHYSICIAN', method='GET', endpoint='/physicians/1/').do_request()
+            self.assertEqual(error.exception.detail['error']['code'], '05')
+        mocked_api_request.assert_called_once()
+        response = self.client.get('/status/upstreams')
+        self.assertEqual(response.json()['breakers']['physician']['state'], CircuitBreaker.OPEN)
+
+
+class TestingSingleFlight(TestCase):
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_request(self):
+        self.calls += 1
+        self.release.wait(timeout=5)
+        return {'id': '1'}
+
+    def test_should_share_in_flight_call_between_threads(self):
+        """ Testing that concurrent callers of the same key get the result of one call """
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.single_flight.do('key', self.slow_request)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        while self.single_flight.snapshot()['shared'] < 4:
+            threading.Event().wait(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'id': '1'}] * 5)
+        self.assertEqual(self.single_flight.snapshot()['in_flight'], 0)
+
+    def test_should_share_exception_and_forget_finished_calls(self):
+        """ Testing that exception is raised to callers and next call for key is a new one """
+        with self.assertRaises(ExternalResourceNotFound):
+            self.single_flight.do('key', Mock(side_effect=ExternalResourceNotFound))
+        self.release.set()
+        self.assertEqual(self.single_flight.do('key', self.slow_request), {'id': '1'})
+        self.assertEqual(self.calls, 1)
+
+    def test_should_share_in_flight_call_between_coroutines(self):
+        """ Testing that concurrent coroutines of the same key get the result of one call """
+        async def request():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            return {'id': '1'}
+
+        async def run():
+            return await asyncio.gather(*[self.single_flight.ado('key', request) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), [{'id': '1'}] * 5)
+        self.assertEqual(self.calls, 1)
+
+        async def failing_request():
+            raise ExternalApiError
+
+        async def run_failing():
+            return await asyncio.gather(
+                *[self.single_flight.ado('other', failing_request) for _ in range(3)],
+                return_exceptions=True,
+            )
+
+        self.assertTrue(all(isinstance(result, ExternalApiError) for result in asyncio.run(run_failing())))
+
+    def test_should_call_again_when_leading_coroutine_is_cancelled(self):
+        """ Testing that joined coroutines are not cancelled with the caller leading the call """
+        async def request():
+            self.calls += 1
+            await asyncio.sleep(0.05)
+            return {'id': '1'}
+
+        async def run():
+            leader = asyncio.ensure_future(self.single_flight.ado('key', request))
+            await asyncio.sleep(0)
+            waiters = [asyncio.ensure_future(self.single_flight.ado('key', request)) for _ in range(3)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await asyncio.gather(*waiters)
+
+        self.assertEqual(asyncio.run(run()), [{'id': '1'}] * 3)
+        self.assertEqual(self.calls, 2)
+
+
+@override_settings(EXTERNAL_SINGLE_FLIGHT=True)
+class TestingSingleFlightBudget(TestCase):
+    """ Testing that requests joining a call in flight keep their own time budget """
+
+    def setUp(self):
+        self.timeouts = []
+
+    def slow_api_request(self, request_obj, timeout, **kwargs):
+        self.timeouts.append(timeout)
+        time.sleep(min(timeout, 0.3))
+        if timeout < 0.3:
+            raise ExternalApiError
+        return {'id': '1'}
+
+    def lookup(self, seconds):
+        return ExternalServiceContext(
+            service='PATIENT', method='GET', endpoint='/patients/1/', deadline=time.monotonic() + seconds,
+        ).do_request()
+
+    def test_should_call_again_when_joined_call_ran_out_of_budget(self):
+        services = {'PATIENT': {'base_url': 'http://patients.test/'}}
+        with override_settings(EXTERNAL_SERVICES=services), \
+                patch('prescription.utils.api_request', side_effect=self.slow_api_request):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                short = executor.submit(self.lookup, 0.1)
+                time.sleep(0.02)
+                long = executor.submit(self.lookup, 30)
+            self.assertRaises(serializers.ValidationError, short.result)
+            self.assertEqual(long.result(), {'id': '1'})
+        self.assertEqual(len(self.timeouts), 2)
+
+    def test_should_not_wait_call_in_flight_beyond_budget(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(single_flight.do, 'key', lambda: release.wait(5))
+            while single_flight.snapshot()['in_flight'] == 0:
+                time.sleep(0.01)
+            start = time.monotonic()
+            self.assertRaises(ExternalApiError, single_flight.do, 'key', Mock(), timeout=0.05)
+            self.assertLess(time.monotonic() - start, 1)
+            release.set()
+
+
+class TestingExportCommand(TestCase):
+
+    def test_should_write_prescriptions_in_range(self):
+        """ Testing export_prescriptions command with id range and small chunks """
+        prescriptions = Prescription.objects.bulk_insert([
+            Prescription(physician_id=1, patient_id=number, description=f'{number}') for number in range(5)
+        ])
+        output = StringIO()
+        call_command('export_prescriptions', '--id-from', str(prescriptions[1].id), '--chunk-size', '2',
+                     stdout=output)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([line['patient_id'] for line in lines], [1, 2, 3, 4])
+
+
+class TestingInstrumentation(TestCase):
+
+    def test_should_render_cumulative_buckets(self):
+        histogram = Histogram(name='test_seconds', documentation='Test', label_names=('stage',), buckets=(0.1, 1))
+        histogram.observe(0.05, stage='a')
+        histogram.observe(0.5, stage='a')
+        histogram.observe(5, stage='a')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{stage="a",le="0.1"} 1',
+            'test_seconds_bucket{stage="a",le="1"} 2',
+            'test_seconds_bucket{stage="a",le="+Inf"} 3',
+            'test_seconds_sum{stage="a"} 5.55',
+            'test_seconds_count{stage="a"} 3',
+        ])
+
+    def test_should_label_outcome_of_timed_block(self):
+        histogram = Histogram(name='test_seconds', documentation='Test', label_names=('stage', 'outcome'))
+        with timed(histogram, stage='a'):
+            pass
+        with self.assertRaises(ExternalApiError):
+            with timed(histogram, stage='a'):
+                raise ExternalApiError
+        with override_settings(INSTRUMENTATION_ENABLED=False):
+            with timed(histogram, stage='b'):
+                pass
+        rendered = '\n'.join(histogram.render())
+        self.assertIn('test_seconds_count{stage="a",outcome="ok"} 1', rendered)
+        self.assertIn('test_seconds_count{stage="a",outcome="error"} 1', rendered)
+        self.assertNotIn('stage="b"', rendered)
+
+    @patch('prescription.utils.api_request', side_effect=ExternalApiError)
+    def test_should_export_metrics_in_prometheus_format(self, mocked_api_request):
+        """ Testing /metrics endpoint exports the external service histogram and breaker state """
+        reset_breakers()
+        self.addCleanup(reset_breakers)
+        with self.assertRaises(serializers.ValidationError):
+            ExternalServiceContext(service='PATIENT', method='GET', endpoint='/patients/1/').do_request()
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        content = response.content.decode()
+        self.assertIn('# TYPE psction_external_service_request_seconds histogram', content)
+        self.assertRegex(
+            content, r'psction_external_service_request_seconds_count\{service="patient",outcome="error"\} \d+',
+        )
+        self.assertIn('psction_breaker{service="patient",stat="state"} 0', content)
+
+
+class TestingBenchmark(TestCase):
+
+    def test_should_summarize_percentiles(self):
+        result = summarize([number / 1000 for number in range(100, 0, -1)], {201: 100}, elapsed=2)
+        self.assertEqual(result['throughput'], 50)
+        self.assertEqual((result['p50_ms'], result['p95_ms'], result['p99_ms']), (50, 95, 99))
+        self.assertEqual(result['statuses'], {'201': 100})
+
+    def test_should_report_regressions_beyond_threshold(self):
+        baseline = {'throughput': 100, 'p50_ms': 10, 'p95_ms': 20, 'p99_ms': 30}
+        self.assertEqual(compare(dict(baseline, throughput=95, p99_ms=32), baseline, threshold=10), [])
+        self.assertEqual(
+            compare(dict(baseline, throughput=80, p95_ms=30), baseline, threshold=10),
+            ['throughput 100 -> 80 req/s', 'p95_ms 20 -> 30'],
+        )
+
+    def test_should_serve_stub_resources(self):
+        stubs = StubServer().start()
+        self.addCleanup(stubs.stop)
+        services = stub_external_services({'PATIENT': {'base_url': 'https://example.com/v1'}}, stubs.base_url)
+        with override_settings(EXTERNAL_SERVICES=services):
+            patient = ExternalServiceContext(service='PATIENT', method='GET', endpoint='/patients/7/').do_request()
+        self.assertEqual(patient['id'], '7')
+        self.assertIn('email', patient)
+        self.assertEqual(stubs.requests, {'patients': 1})
+
+
+class TestingDeadline(TestCase):
+
+    def test_should_cap_time_left_by_budget(self):
+        self.assertEqual(time_left(None, timeout=30), 30)
+        with deadline(5):
+            self.assertLessEqual(time_left(current_deadline(), timeout=30), 5)
+            self.assertEqual(time_left(current_deadline(), timeout=1), 1)
+            with deadline(60):
+                self.assertLessEqual(time_left(current_deadline(), timeout=30), 5)
+        self.assertIsNone(current_deadline())
+        with self.assertRaises(DeadlineExceeded):
+            time_left(time.monotonic() - 1)
+
+    def test_should_read_budget_from_header(self):
+        factory = RequestFactory()
+        self.assertEqual(request_budget(factory.get('/', HTTP_X_REQUEST_TIMEOUT='2.5')), 2.5)
+        with override_settings(REQUEST_DEADLINE={'default': 10, 'max': 20, 'header': 'X-Request-Timeout'}):
+            self.assertEqual(request_budget(factory.get('/')), 10)
+            self.assertEqual(request_budget(factory.get('/', HTTP_X_REQUEST_TIMEOUT='soon')), 10)
+            self.assertEqual(request_budget(factory.get('/', HTTP_X_REQUEST_TIMEOUT='100')), 20)
+            self.assertEqual(request_budget(factory.get('/', HTTP_X_REQUEST_TIMEOUT='-1')), 0)
+
+    def test_should_not_count_deadline_as_breaker_failure(self):
+        """ Testing that a trial call without budget neither opens the breaker nor keeps its half open slot """
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=10, timer=lambda: now[0])
+        with self.assertRaises(ExternalApiError):
+            breaker.call(Mock(side_effect=ExternalApiError))
+        now[0] = 10
+        with self.assertRaises(DeadlineExceeded):
+            breaker.call(Mock(side_effect=DeadlineExceeded))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.call(Mock(return_value={})), {})
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_should_fail_fast_when_budget_ran_out(self):
+        with patch('prescription.utils.api_request') as mocked_api_request:
+            with self.assertRaises(serializers.ValidationError) as error:
+                ExternalServiceContext(
+                    service='PATIENT', method='GET', endpoint='/patients/1/', deadline=time.monotonic() - 1,
+                ).do_request()
+        self.assertEqual(error.exception.detail['error']['code'], '06')
+        mocked_api_request.assert_not_called()
+
+
+class TestingHedger(TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def hedger(self, **options):
+        hedger = Hedger(percentile=50, min_samples=5, **options)
+        for _ in range(5):
+            hedger.tracker.observe(0.01)
+        return hedger
+
+    def slow_first_request(self):
+        with self.lock:
+            self.calls += 1
+            number = self.calls
+        if number == 1:
+            self.release.wait(timeout=5)
+            return {'id': 'primary'}
+        return {'id': 'hedge'}
+
+    def test_should_use_hedge_answering_first(self):
+        hedger = self.hedger(budget=1)
+        self.assertEqual(hedger.call(self.slow_first_request, timeout=5), {'id': 'hedge'})
+        self.assertEqual((hedger.stats['sent'], hedger.stats['won']), (1, 1))
+
+    def test_should_not_hedge_beyond_budget(self):
+        hedger = self.hedger(budget=0.5)
+        threading.Timer(0.05, self.release.set).start()
+        self.assertEqual(hedger.call(self.slow_first_request, timeout=5), {'id': 'primary'})
+        self.assertEqual((hedger.stats['sent'], hedger.stats['throttled'], self.calls), (0, 1, 1))
+
+    def test_should_wait_other_request_when_one_fails(self):
+        hedger = self.hedger(budget=1)
+
+        def failing_first_request():
+            with self.lock:
+                self.calls += 1
+                number = self.calls
+            if number == 1:
+                time.sleep(0.05)
+                raise ExternalApiError
+            self.release.wait(timeout=5)
+            return {'id': 'hedge'}
+
+        threading.Timer(0.1, self.release.set).start()
+        self.assertEqual(hedger.call(failing_first_request, timeout=5), {'id': 'hedge'})
+        self.assertEqual(hedger.stats['won'], 1)
+
+    def test_should_skip_hedging_until_enough_samples(self):
+        hedger = Hedger(min_samples=2, budget=1, pool=Mock())
+        self.assertEqual(hedger.call(lambda: {'id': '1'}), {'id': '1'})
+        hedger.pool.try_submit.assert_not_called()
+        self.assertEqual(len(hedger.tracker), 1)
+
+    def test_should_call_in_calling_thread_when_pool_is_busy(self):
+        """ Testing that a call finding every worker busy is not queued, it runs unhedged in the calling thread """
+        pool = HedgePool(max_workers=1)
+        self.addCleanup(pool.executor.shutdown)
+        busy = pool.try_submit(self.release.wait, 5)
+        self.assertIsNone(pool.try_submit(self.release.wait, 5))
+        hedger = self.hedger(budget=1, pool=pool)
+        self.assertEqual(hedger.call(lambda: threading.current_thread().name, timeout=5),
+                         threading.current_thread().name)
+        self.assertEqual((hedger.stats['inline'], hedger.stats['sent']), (1, 0))
+        self.release.set()
+        busy.result(timeout=5)
+
+
+@override_settings(IDEMPOTENCY={'header': 'Idempotency-Key', 'ttl': 60, 'lock_timeout': 30, 'poll_interval': 0.01})
+class TestingIdempotencyKey(TestCase):
+
+    def test_should_wait_key_held_by_running_request(self):
+        row = acquire_key('key', 'body')
+        self.assertFalse(row.completed)
+        with self.assertRaises(IdempotencyKeyInProgress):
+            acquire_key('key', 'body', wait=0.05)
+        with self.assertRaises(IdempotencyKeyMismatch):
+            acquire_key('key', 'other body', wait=0.05)
+        complete_key(row, 201, {'data': {'id': 1}})
+        replay = acquire_key('key', 'body', wait=0)
+        self.assertTrue(replay.completed)
+        self.assertEqual((replay.status_code, replay.response), (201, {'data': {'id': 1}}))
+
+    def test_should_release_key_of_failed_request(self):
+        complete_key(acquire_key('key', 'body'), 400, {'error': {}})
+        self.assertFalse(acquire_key('key', 'body', wait=0).completed)
+
+    def test_should_take_stale_and_expired_keys(self):
+        row = acquire_key('stale', 'body')
+        IdempotencyKey.objects.filter(pk=row.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        taken = acquire_key('stale', 'body', wait=0)
+        self.assertEqual(taken.pk, row.pk)
+        self.assertFalse(taken.completed)
+
+        complete_key(acquire_key('expired', 'body'), 201, {})
+        IdempotencyKey.objects.filter(key='expired').update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertFalse(acquire_key('expired', 'other body', wait=0).completed)
+        IdempotencyKey.objects.filter(key='expired').update(expires_at=timezone.now() - timedelta(seconds=1))
+        output = StringIO()
+        call_command('purge_idempotency_keys', stdout=output)
+        self.assertEqual(output.getvalue().strip(), 'Idempotency keys deleted: 1')
+
+
+class TestingGroupCommitWriter(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def write(self, items):
+        self.batches.append(len(items))
+        if len(self.batches) == 1:
+            self.release.wait(timeout=5)
+        if any(item == 'bad' for item, _payload in items):
+            raise ValueError
+        return [f'saved {item}' for item, _payload in items]
+
+    def test_should_write_queued_items_together(self):
+        """ Testing that items queued while a transaction is committing share the next one """
+        writer = GroupCommitWriter(write=self.write, max_batch=10, max_wait=0)
+        self.addCleanup(writer.close)
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            first = executor.submit(writer.insert, 0)
+            while not self.batches:
+                time.sleep(0.001)
+            others = [executor.submit(writer.insert, number) for number in range(1, 6)]
+            while writer.snapshot()['queued'] < 5:
+                time.sleep(0.001)
+            self.release.set()
+            self.assertEqual(first.result(), 'saved 0')
+            self.assertEqual([future.result() for future in others], [f'saved {number}' for number in range(1, 6)])
+        self.assertEqual(self.batches, [1, 5])
+        self.assertEqual((writer.stats['transactions'], writer.stats['items']), (2, 6))
+
+    def test_should_fail_only_failing_item(self):
+        self.release.set()
+        writer = GroupCommitWriter(write=self.write, max_batch=10, max_wait=0)
+        self.addCleanup(writer.close)
+        writer.insert(0)
+        batch = [((item, None), Future()) for item in (1, 'bad', 2)]
+        with self.assertLogs('prescription.writer', level='WARNING'):
+            writer._commit(batch)
+        self.assertEqual(batch[0][1].result(), 'saved 1')
+        self.assertIsInstance(batch[1][1].exception(), ValueError)
+        self.assertEqual(batch[2][1].result(), 'saved 2')
+        self.assertEqual((writer.stats['fallbacks'], writer.stats['failed']), (1, 1))
+
+    def test_should_reject_item_when_queue_stays_full(self):
+        writer = GroupCommitWriter(write=self.write, max_queue=1, timeout=0.01)
+        writer.start = Mock()
+        writer._queue.put(((0, None), Future()))
+        with self.assertRaises(WriterUnavailable):
+            writer.insert(1)
+        self.assertEqual(writer.stats['rejected'], 1)
+
+    def test_should_cancel_item_whose_commit_does_not_start_in_time(self):
+        """ Testing that a timed out item is never written, while an item whose commit started is waited """
+        writer = GroupCommitWriter(write=self.write, max_batch=10, max_wait=0, timeout=0.05)
+        self.addCleanup(writer.close)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            first = executor.submit(writer.insert, 0)
+            while not self.batches:
+                time.sleep(0.001)
+            with self.assertRaises(WriterUnavailable):
+                writer.insert(1)
+            self.release.set()
+            self.assertEqual(first.result(), 'saved 0')
+        writer.close()
+        self.assertEqual(self.batches, [1])
+        self.assertEqual((writer.stats['items'], writer.stats['timed_out']), (1, 1))
+
+    def test_should_save_prescriptions_and_outbox_rows(self):
+        prescriptions = write_prescriptions([
+            (Prescription(physician_id=1, patient_id=1, description='first'), {'patient_id': 1}),
+            (Prescription(physician_id=1, patient_id=2, description='second'), None),
+        ])
+        self.assertEqual([prescription.description for prescription in prescriptions], ['first', 'second'])
+        self.assertEqual(Prescription.objects.get(pk=prescriptions[1].pk).patient_id, 2)
+        self.assertEqual(MetricOutbox.objects.get().payload, {'patient_id': 1})
+
+    def test_should_turn_on_sqlite_wal(self):
+        connection = MagicMock(vendor='sqlite')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        with override_settings(SQLITE_WAL=True):
+            enable_sqlite_wal(sender=None, connection=connection)
+        cursor.execute.assert_any_call('PRAGMA journal_mode=WAL')
+        connection.reset_mock()
+        enable_sqlite_wal(sender=None, connection=connection)
+        cursor.execute.assert_not_called()
+
+
+class TestingBatchLoader(TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def load_many(self, keys):
+        self.batches.append(keys)
+        return [ExternalResourceNotFound() if key == 404 else {'id': key} for key in keys]
+
+    def load_together(self, loader, keys):
+        with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+            futures = [executor.submit(loader.load, key, 5) for key in keys]
+        return futures
+
+    def test_should_load_concurrent_keys_in_one_batch(self):
+        loader = BatchLoader(self.load_many, window=0.2, max_size=10)
+        futures = self.load_together(loader, [1, 2, 404])
+        self.assertEqual([futures[0].result(), futures[1].result()], [{'id': 1}, {'id': 2}])
+        self.assertRaises(ExternalResourceNotFound, futures[2].result)
+        self.assertEqual(len(self.batches), 1)
+        self.assertCountEqual(self.batches[0], [1, 2, 404])
+        self.assertEqual((loader.stats['loads'], loader.stats['batches'], loader.stats['keys']), (3, 1, 3))
+
+    def test_should_send_full_batch_without_waiting_window(self):
+        loader = BatchLoader(self.load_many, window=5, max_size=2)
+        start = time.monotonic()
+        futures = self.load_together(loader, [1, 2])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual([future.result() for future in futures], [{'id': 1}, {'id': 2}])
+
+    def test_should_give_batch_error_to_every_key(self):
+        def failing_load_many(keys):
+            raise ExternalApiError
+
+        loader = BatchLoader(failing_load_many, window=0.1)
+        for future in self.load_together(loader, [1, 2]):
+            self.assertRaises(ExternalApiError, future.result)
+        self.assertEqual(loader.stats['failed'], 1)
+
+
+class TestingLoadBatch(TestCase):
+
+    def setUp(self):
+        reset_loaders()
+        self.addCleanup(reset_loaders)
+        self.caller = ContextVar('caller', default=None)
+
+    def services(self, endpoint):
+        config = {
+            'base_url': 'http://physicians.test/v1/',
+            'batch': {'enabled': True, 'window': 0.2, 'max_size': 10, 'endpoint': endpoint},
+        }
+        return {settings.EXTERNAL_PHYSICIAN: config}
+
+    def lookup_together(self, resource_ids):
+        def lookup(resource_id):
+            self.caller.set(resource_id)
+            service = PhysicianExternalService(method='GET', endpoint=f'physicians/{resource_id}/',
+                                               resource_id=resource_id)
+            return service._send()
+
+        with ThreadPoolExecutor(max_workers=len(resource_ids)) as executor:
+            futures = [executor.submit(lookup, resource_id) for resource_id in resource_ids]
+        return futures
+
+    def test_should_lookup_many_ids_in_one_request(self):
+        with override_settings(EXTERNAL_SERVICES=self.services('physicians?ids={ids}')), \
+                patch('prescription.utils.api_request', return_value=[{'id': '1'}, {'id': '2'}]) as mocked:
+            futures = self.lookup_together([1, 2, 3])
+        self.assertEqual([futures[0].result(), futures[1].result()], [{'id': '1'}, {'id': '2'}])
+        self.assertRaises(ExternalResourceNotFound, futures[2].result)
+        mocked.assert_called_once()
+        url = mocked.call_args[1]['request_obj'].full_url
+        self.assertTrue(url.startswith('http://physicians.test/v1/physicians?ids='))
+        self.assertCountEqual(url.split('=')[1].split(','), ['1', '2', '3'])
+
+    def test_should_fall_back_to_single_requests(self):
+        """ Testing that each single request is sent in the context of its own caller """
+        def single_request(request_obj, **kwargs):
+            return {'url': request_obj.full_url, 'caller': self.caller.get()}
+
+        with override_settings(EXTERNAL_SERVICES=self.services(None)), \
+                patch('prescription.utils.api_request', side_effect=single_request) as mocked:
+            futures = self.lookup_together([1, 2])
+        self.assertEqual(
+            [future.result() for future in futures],
+            [
+                {'url': 'http://physicians.test/v1/physicians/1/', 'caller': 1},
+                {'url': 'http://physicians.test/v1/physicians/2/', 'caller': 2},
+            ],
+        )
+        self.assertEqual(mocked.call_count, 2)
+
+
+class TestingConcurrencyLimiter(TestCase):
+
+    def test_should_hand_released_slot_to_queued_call(self):
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=1, queue_timeout=5)
+        limiter.acquire()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(limiter.call, lambda: 'done')
+            time.sleep(0.05)
+            self.assertEqual(limiter.snapshot()['queue_depth'], 1)
+            limiter.release()
+            self.assertEqual(future.result(timeout=5), 'done')
+        snapshot = limiter.snapshot()
+        self.assertEqual((snapshot['admitted'], snapshot['queued'], snapshot['in_flight']), (2, 1, 0))
+
+    def test_should_reject_when_queue_is_full(self):
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=0)
+        limiter.acquire()
+        self.assertRaises(ServiceOverloaded, limiter.call, lambda: 'done')
+        self.assertEqual(limiter.snapshot()['rejected'], 1)
+
+    def test_should_reject_when_queue_wait_runs_out(self):
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=1, queue_timeout=5)
+        limiter.acquire()
+        start = time.monotonic()
+        self.assertRaises(ServiceOverloaded, limiter.acquire, 0.05)
+        self.assertLess(time.monotonic() - start, 1)
+        limiter.release()
+        snapshot = limiter.snapshot()
+        self.assertEqual((snapshot['timed_out'], snapshot['queue_depth'], snapshot['in_flight']), (1, 0, 0))
+
+    def test_should_queue_coroutines_without_blocking_loop(self):
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=2, queue_timeout=5)
+
+        async def request(number):
+            await asyncio.sleep(0.01)
+            return number
+
+        async def run():
+            return await asyncio.gather(*[limiter.acall(partial(request, number)) for number in range(3)])
+
+        self.assertEqual(asyncio.run(run()), [0, 1, 2])
+        self.assertEqual((limiter.stats['queued'], limiter.snapshot()['in_flight']), (2, 0))
+
+    def test_should_not_count_shed_requests_as_breaker_failures(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+
+        def shed():
+            raise ServiceOverloaded
+
+        self.assertRaises(ServiceOverloaded, breaker.call, shed)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class TestingProfilingMiddleware(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.factory = RequestFactory()
+
+    def options(self, **options):
+        return override_settings(PROFILING=dict({
+            'rate': 0,
+            'header': 'X-Profile',
+            'token': 'secret',
+            'paths': ('/prescriptions',),
+            'directory': str(self.directory),
+            'keep': 2,
+        }, **options))
+
+    @staticmethod
+    def view(request):
+        record_upstream('physician')
+        record_upstream('patient')
+        return HttpResponse(status=201)
+
+    def post(self, path='/prescriptions', **headers):
+        return ProfilingMiddleware(self.view)(self.factory.post(path, data={}, **headers))
+
+    def test_should_profile_request_with_privileged_header(self):
+        with self.options():
+            response = self.post(HTTP_X_PROFILE='secret', HTTP_X_REQUEST_ID='req-1')
+        name = response['X-Profile-File']
+        self.assertRegex(name, r'-req-1-\d+ms-patient\+physician\.prof$')
+        self.assertEqual([path.name for path in self.directory.iterdir()], [name])
+        self.assertIn('view', ''.join(function for _, _, function in pstats.Stats(str(self.directory / name)).stats))
+
+    def test_should_not_profile_without_sampling_or_token(self):
+        with self.options():
+            responses = [self.post(), self.post(HTTP_X_PROFILE='wrong')]
+        with self.options(rate=1):
+            responses.append(self.post(path='/status/upstreams'))
+        self.assertFalse(any(response.has_header('X-Profile-File') for response in responses))
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_should_keep_newest_sampled_profiles(self):
+        with self.options(rate=1):
+            names = []
+            for _ in range(3):
+                names.append(self.post()['X-Profile-File'])
+                time.sleep(0.01)
+        self.assertCountEqual([path.name for path in self.directory.iterdir()], names[1:])
+
+    def test_should_profile_coroutine_view(self):
+        async def view(request):
+            record_upstream('clinic')
+            return HttpResponse(status=201)
+
+        with self.options():
+            middleware = ProfilingMiddleware(view)
+            response = asyncio.run(middleware(self.factory.post('/prescriptions', HTTP_X_PROFILE='secret')))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertRegex(response['X-Profile-File'], r'ms-clinic\.prof$')
+
+
+class TestingRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def failing(self, *errors):
+        def function():
+            self.calls += 1
+            if self.calls <= len(errors):
+                raise errors[self.calls - 1]
+            return {'id': '1'}
+        return function
+
+    def test_should_retry_retryable_errors(self):
+        policy = RetryPolicy(attempts=3, backoff=0.001)
+        function = self.failing(ExternalApiError(status=503), ExternalApiError())
+        self.assertEqual(policy.call(function), {'id': '1'})
+        self.assertEqual(self.calls, 3)
+        self.assertEqual((policy.stats['retries'], policy.stats['recovered']), (2, 1))
+
+    def test_should_not_retry_other_errors(self):
+        policy = RetryPolicy(attempts=3, backoff=0.001, retry_on=('5xx',))
+        for error in (ExternalApiError(status=400), ExternalApiError(), ExternalServiceUnavailable(),
+                      ExternalResourceNotFound()):
+            self.calls = 0
+            with self.subTest(error=error):
+                self.assertRaises(type(error), policy.call, self.failing(error))
+                self.assertEqual(self.calls, 1)
+        self.assertEqual(policy.stats['retries'], 0)
+
+    def test_should_stop_after_attempts(self):
+        policy = RetryPolicy(attempts=2, backoff=0.001)
+        self.assertRaises(ExternalApiError, policy.call, self.failing(*[ExternalApiError(status=500)] * 3))
+        self.assertEqual((self.calls, policy.stats['exhausted']), (2, 1))
+
+    def test_should_not_retry_beyond_deadline(self):
+        policy = RetryPolicy(attempts=3, backoff=10, max_backoff=10)
+        with patch('prescription.retry.random.uniform', return_value=5):
+            self.assertRaises(ExternalApiError, policy.call, self.failing(ExternalApiError(status=502)),
+                              deadline=time.monotonic() + 1)
+        self.assertEqual(self.calls, 1)
+
+    def test_should_wait_jittered_exponential_backoff(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3)
+        with patch('prescription.retry.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual([policy.delay(retry) for retry in (1, 2, 3)], [0.1, 0.2, 0.3])
+
+    def test_should_retry_coroutines(self):
+        policy = RetryPolicy(attempts=2, backoff=0.001)
+        function = self.failing(ExternalApiError(status=503))
+
+        async def coroutine_function():
+            return function()
+
+        self.assertEqual(asyncio.run(policy.acall(coroutine_function)), {'id': '1'})
+        self.assertEqual(self.calls, 2)
+
+    @patch('prescription.utils.urlopen')
+    def test_should_give_api_error_response_status(self, mocked_urlopen):
+        mocked_urlopen.side_effect = HTTPError(url='', code=503, msg='', hdrs=None, fp=None)
+        client = ServiceClient('TEST', {'base_url': 'http://api.test/'}, None)
+        request_obj = client.request_obj(method='GET', endpoint='/x')
+        with self.assertRaises(ExternalApiError) as context:
+            api_request(request_obj=request_obj)
+        self.assertEqual(context.exception.status, 503)
+
+    def test_should_retry_metric_post_with_same_idempotency_key(self):
+        reset_retries()
+        self.addCleanup(reset_retries)
+        keys = []
+
+        def flaky_urlopen(request_obj, timeout):
+            keys.append(request_obj.get_header('Idempotency-key'))
+            if len(keys) == 1:
+                raise HTTPError(url=request_obj.full_url, code=503, msg='', hdrs=None, fp=None)
+            response = Mock(status=201)
+            response.read.return_value = b'{"id": "1"}'
+            return response
+
+        retry = {'enabled': True, 'attempts': 2, 'backoff': 0.001, 'max_backoff': 0.001, 'retry_on': ('5xx',)}
+        services = {settings.EXTERNAL_METRIC: {'base_url': 'http://metrics.test/', 'retry': retry}}
+        with override_settings(EXTERNAL_SERVICES=services), \
+                patch('prescription.utils.urlopen', side_effect=flaky_urlopen):
+            response = ExternalServiceContext(
+                service=settings.EXTERNAL_METRIC, method='POST', endpoint='/metrics/', data={'id': 1},
+            ).do_request()
+        self.assertEqual(response, {'id': '1'})
+        self.assertEqual(len(keys), 2)
+        self.assertIsNotNone(keys[0])
+        self.assertEqual(keys[0], keys[1])
+
+    @patch('prescription.utils.urlopen')
+    def test_should_post_metric_with_given_idempotency_key(self, mocked_urlopen):
+        mocked_urlopen.return_value = Mock(status=201, **{'read.return_value': b'{}'})
+        services = {settings.EXTERNAL_METRIC: {'base_url': 'http://metrics.test/'}}
+        with override_settings(EXTERNAL_SERVICES=services):
+            deliver_metrics([{'id': 1}], keys=['outbox-1'])
+        self.assertEqual(mocked_urlopen.call_args.args[0].get_header('Idempotency-key'), 'outbox-1')
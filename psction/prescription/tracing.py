@@ -0,0 +1,219 @@
+""" Module to define request tracing, nested timed spans of a request exported as json lines """
+import atexit
+import json
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+
+from contextvars import ContextVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_span = ContextVar('prescription_span', default=None)
+
+TRACE_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class Span:
+    """ Class defining a timed operation of a trace, nested in its parent span """
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'start', 'started', 'duration', 'error',
+                 'token')
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, **attributes) -> None:
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.token = _span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self.started
+        _span.reset(self.token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        span_exporter().export(self.as_dict())
+        return False
+
+    def as_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration_ms': round(self.duration * 1000, 3),
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class _NoSpan:
+    """ Class standing for a span outside a trace, it records nothing """
+    __slots__ = ()
+    trace_id = None
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def current_trace_id():
+    """ Function to get trace id of the current span, None outside a trace """
+    current = _span.get()
+    return None if current is None else current.trace_id
+
+
+def span(name: str, **attributes):
+    """ Function to get a span of name nested in the current one, outside a trace it records nothing """
+    parent = _span.get()
+    if parent is None:
+        return NO_SPAN
+    return Span(name, trace_id=parent.trace_id, parent_id=parent.span_id, **attributes)
+
+
+def trace(name: str, request=None, **attributes):
+    """ Function to get the root span of a new trace, its id is taken from request trace header when valid.
+    Without tracing enabled it records nothing """
+    if not settings.TRACING['enabled']:
+        return NO_SPAN
+    trace_id = None
+    if request is not None:
+        trace_id = request.headers.get(settings.TRACING['header'], '').lower()
+    if not TRACE_ID_PATTERN.fullmatch(trace_id or ''):
+        trace_id = uuid.uuid4().hex
+    return Span(name, trace_id=trace_id, **attributes)
+
+
+class JsonlExporter:
+    """ Class to append finished spans to a json lines file from a background thread, a batch is written when it
+    has batch_size spans or flush_interval seconds after its first one. Spans are dropped when the queue is full
+    so tracing never blocks requests """
+    STOP = object()
+
+    def __init__(self, path: str, max_queue: int = 10000, batch_size: int = 200, flush_interval: float = 1.0) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'exported': 0,
+            'dropped': 0,
+            'batches': 0,
+            'failed': 0,
+        }
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+                self._thread.start()
+
+    def export(self, span_data: dict) -> None:
+        self.start()
+        try:
+            self._queue.put_nowait(span_data)
+        except queue.Full:
+            self._count('dropped')
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+
+    def _collect(self, first) -> tuple:
+        """ Method to collect a batch starting with first, it returns (batch, stop requested) """
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                span_data = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if span_data is self.STOP:
+                return batch, True
+            batch.append(span_data)
+        return batch, False
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            span_data = self._queue.get()
+            if span_data is self.STOP:
+                break
+            batch, stop = self._collect(span_data)
+            self._write(batch)
+
+    def _write(self, batch: list) -> None:
+        self._count('batches')
+        try:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(''.join(json.dumps(span_data, default=str) + '\n' for span_data in batch))
+        except OSError:
+            self._count('failed', len(batch))
+            logger.exception('Unable to export %s spans', len(batch))
+            return
+        self._count('exported', len(batch))
+
+    def close(self, timeout: float = 5) -> None:
+        """ Method to write queued spans and stop background thread """
+        with self._lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout=timeout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, queued=self._queue.qsize())
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def span_exporter() -> JsonlExporter:
+    """ Function to get the process span exporter, flushed at interpreter exit """
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                options = {key: value for key, value in settings.TRACING.items() if key not in ('enabled', 'header')}
+                _exporter = JsonlExporter(**options)
+                atexit.register(_exporter.close)
+    return _exporter
+
+
+def exporter_stats() -> dict:
+    """ Function to get stats of the span exporter, empty when it was never started """
+    return _exporter.snapshot() if _exporter is not None else {}
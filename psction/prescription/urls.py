@@ -3,7 +3,12 @@
 from django.urls import path
 from django.urls import include
 
+from prescription.views import prometheus_metrics
+from prescription.views import upstream_status
+
 app_name = 'prescription_app'
 urlpatterns = [
     path('', include('prescription.api.urls', namespace='prescription_api')),
+    path('status/upstreams', upstream_status, name='upstream-status'),
+    path('metrics', prometheus_metrics, name='metrics'),
 ]
@@ -1,109 +1,458 @@
 """ Module to define app utils """
+import asyncio
 import json
+import threading
+import uuid
 
-from urllib.parse import urljoin
-
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+from http.client import HTTPException
 from urllib.error import HTTPError
-
-from urllib.request import urlopen
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
 from urllib.request import Request
+from urllib.request import urlopen
 
 from django.conf import settings
+from django.core.signals import setting_changed
 
 from rest_framework import status, serializers
 
+from prescription.batch import batch_executor
+from prescription.batch import service_loader
+from prescription.breaker import service_breaker
+from prescription.cache import service_cache
+from prescription.deadline import current_deadline
+from prescription.deadline import expired
+from prescription.deadline import time_left
+from prescription.exceptions import DeadlineExceeded
 from prescription.exceptions import ExternalApiError
 from prescription.exceptions import ExternalResourceNotFound
-
-
-def prepare_request_obj(config: dict, method: str, endpoint: str, **kwargs) -> Request:  # TODO Test
-    """ Function to preparate and create Request object for service specified """
-    request_data = {
-        'method': method,
-        'url': urljoin(base=config['base_url'], url=endpoint),
-        'headers': {
+from prescription.hedge import service_hedger
+from prescription.instrumentation import EXTERNAL_API_SECONDS
+from prescription.instrumentation import EXTERNAL_SERVICE_SECONDS
+from prescription.instrumentation import timed
+from prescription.limiter import service_limiter
+from prescription.pool import ConnectionPool
+from prescription.pool import get_pool
+from prescription.profiling import record_upstream
+from prescription.retry import service_retry
+from prescription.singleflight import single_flight
+from prescription.tracing import current_trace_id
+from prescription.tracing import span
+
+
+_lookup_executor = None
+_lookup_executor_lock = threading.Lock()
+
+
+def lookup_executor() -> ThreadPoolExecutor:
+    """ Function to get the shared bounded thread pool used to fan-out external lookups """
+    global _lookup_executor
+    if _lookup_executor is None:
+        with _lookup_executor_lock:
+            if _lookup_executor is None:
+                _lookup_executor = ThreadPoolExecutor(
+                    max_workers=settings.EXTERNAL_LOOKUP_WORKERS,
+                    thread_name_prefix='external-lookup',
+                )
+    return _lookup_executor
+
+
+class ServiceClient:
+    """ Class holding what every request of an external service shares, built once from its config: the strategy
+    handling its errors, headers and the url prefixes endpoints are joined to """
+
+    def __init__(self, service: str, config: dict, strategy) -> None:
+        self.service = service
+        self.config = dict(config)
+        self.strategy = strategy
+        self.base_url = config['base_url']
+        self.headers = {
             'Content-Type': 'application/json',
-        },
+        }
+        if config.get('auth_token'):
+            self.headers['Authorization'] = f'{config["auth_token"]}'
+        base = urlsplit(self.base_url)
+        self._origin = f'{base.scheme}://{base.netloc}'
+        self._directory = self._origin + (base.path[:base.path.rfind('/') + 1] or '/')
+
+    def url(self, endpoint: str) -> str:
+        """ Method to get the url of endpoint by concatenation, an endpoint starting with / is appended to the
+        origin of base_url and any other one to its directory. Endpoints with a scheme, a network location, dot
+        segments or no path are joined by urljoin """
+        path = endpoint.partition('?')[0]
+        if not path or ':' in path or '.' in path or path.startswith('//'):
+            return urljoin(base=self.base_url, url=endpoint)
+        return (self._origin if path.startswith('/') else self._directory) + endpoint
+
+    def request_obj(self, method: str, endpoint: str, data=None, **kwargs) -> Request:
+        """ Method to create Request object of endpoint with the client headers, data is sent as json when it is
+        a dict or a list, within a trace the trace id is sent in the trace header """
+        if not data or not isinstance(data, (dict, list)):
+            data = None
+        else:
+            data = bytes(json.dumps(data), encoding='utf-8')
+        headers = self.headers
+        trace_id = current_trace_id()
+        if trace_id is not None:
+            headers = dict(headers, **{settings.TRACING['header']: trace_id})
+        return Request(self.url(endpoint), data=data, headers=headers, method=method)
+
+
+def build_clients() -> dict:
+    """ Function to build the client of every external service configured with a dict """
+    strategies = {
+        settings.EXTERNAL_CLINIC: ClientExternalService,
+        settings.EXTERNAL_METRIC: MetricExternalService,
+        settings.EXTERNAL_PATIENT: PatientExternalService,
+        settings.EXTERNAL_PHYSICIAN: PhysicianExternalService,
+    }
+    return {
+        service: ServiceClient(service, config, strategies.get(service))
+        for service, config in settings.EXTERNAL_SERVICES.items()
+        if isinstance(config, dict)
     }
-    if config.get('auth_token'):
-        request_data['headers']['Authorization'] = f'{config["auth_token"]}'
-    if kwargs.get('data') and isinstance(kwargs['data'], dict):
-        request_data['data'] = bytes(
-            json.dumps(kwargs['data']),
-            encoding='utf-8',
-        )
 
-    return Request(**request_data)
 
+_clients = None
+_clients_lock = threading.Lock()
 
-def api_request(request_obj: Request, timeout=30) -> dict:  # TODO Test
-    """ Method to perform a json api request with error handle """
-    try:
-        response = urlopen(
-            request_obj,
-            timeout=timeout,
-        )
-    except HTTPError:
-        raise ExternalApiError
-    if response.status == status.HTTP_404_NOT_FOUND:
-        raise ExternalResourceNotFound
-    try:
-        return json.loads(response.read())
-    except ValueError:
-        raise ExternalApiError
+CLIENT_SETTINGS = {'EXTERNAL_SERVICES', 'EXTERNAL_CLINIC', 'EXTERNAL_METRIC', 'EXTERNAL_PATIENT', 'EXTERNAL_PHYSICIAN'}
 
 
-class ClientExternalService:
-    """ Strategy for Client External Service to connect and trigger Validation errors """
+def load_clients() -> dict:
+    """ Function to build the clients of external services from settings, done at app startup """
+    global _clients
+    with _clients_lock:
+        _clients = build_clients()
+        return _clients
 
-    def __init__(self, method: str, endpoint: str, **kwargs) -> None:
-        """ Initializing ExternalService to configure request object with service config. """
-        self.service_name = settings.EXTERNAL_CLINIC.lower()
-        self.config = dict(settings.EXTERNAL_SERVICES[settings.EXTERNAL_CLINIC])
-        self.request_obj = prepare_request_obj(
-            config=self.config,
-            method=method,
-            endpoint=endpoint,
-            **kwargs,
-        )
 
-    def _api_request(self):
-        return api_request(
-            request_obj=self.request_obj,
-            timeout=30,
-        )
+def service_client(service: str) -> ServiceClient:
+    """ Function to get the prebuilt client of service, ValueError is raised when service is not configured """
+    clients = _clients
+    if clients is None:
+        clients = load_clients()
+    client = clients.get(service)
+    if client is None:
+        if service not in settings.EXTERNAL_SERVICES.keys():
+            raise ValueError(f'{service} is not a valid external service, please configure it.')
+        raise ValueError(f'{service} config has not a valid value.')
+    return client
 
-    def do_request(self) -> dict:
-        try:
-            return self._api_request()
-        except ExternalApiError:
-            return {}
 
+def reload_clients(setting: str = None, **kwargs) -> None:
+    """ setting_changed receiver dropping clients when external services settings change, they are built again
+    by the next request """
+    global _clients
+    if setting is None or setting in CLIENT_SETTINGS:
+        with _clients_lock:
+            _clients = None
 
-class PatientExternalService:
-    """ Strategy for Patient External Service to connect and trigger Validation errors """
 
-    def __init__(self, method: str, endpoint: str, **kwargs) -> None:
-        """ Initializing ExternalService to configure request object with service config. """
-        self.service_name = settings.EXTERNAL_PATIENT.lower()
-        self.config = dict(settings.EXTERNAL_SERVICES[settings.EXTERNAL_PATIENT])
-        self.request_obj = prepare_request_obj(
-            config=self.config,
+def connect_signals() -> None:
+    setting_changed.connect(reload_clients, dispatch_uid='prescription.reload_clients')
+
+
+def api_request(request_obj: Request, timeout=30, pool: ConnectionPool = None, service: str = '') -> dict:
+    """ Method to perform a json api request with error handle, over pool connections when given """
+    record_upstream(service)
+    with timed(EXTERNAL_API_SECONDS, service=service), \
+            span('api_request', service=service, method=request_obj.get_method(),
+                 endpoint=request_obj.selector) as current:
+        try:
+            if pool is not None:
+                response = pool.urlopen(
+                    request_obj,
+                    timeout=timeout,
+                )
+            else:
+                response = urlopen(
+                    request_obj,
+                    timeout=timeout,
+                )
+        except HTTPError as exc:
+            current.set(status=exc.code)
+            if exc.code == status.HTTP_404_NOT_FOUND:
+                raise ExternalResourceNotFound
+            raise ExternalApiError(status=exc.code)
+        except (OSError, HTTPException):  # URLError, socket timeouts and broken responses
+            raise ExternalApiError
+        current.set(status=response.status)
+        if response.status == status.HTTP_404_NOT_FOUND:
+            raise ExternalResourceNotFound
+        try:
+            body = response.read()
+        except (OSError, HTTPException):
+            raise ExternalApiError(status=response.status)
+        current.set(bytes=len(body))
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise ExternalApiError(status=response.status)
+
+
+async def async_api_request(request_obj: Request, timeout=30, pool: ConnectionPool = None, service: str = '') -> dict:
+    """ Coroutine counterpart of api_request, the request is sent by api_request on a thread of the lookup pool so
+    both have the same connections and error handling """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        lookup_executor(),
+        partial(copy_context().run, api_request, request_obj=request_obj, timeout=timeout, pool=pool, service=service),
+    )
+
+
+def service_pool(config: dict):
+    """ Function to get the keep-alive pool for service config, None when pooling is disabled """
+    pool_config = settings.EXTERNAL_HTTP_POOL
+    if not pool_config.get('enabled'):
+        return None
+    return get_pool(
+        base_url=config['base_url'],
+        maxsize=pool_config['maxsize'],
+        idle_timeout=pool_config['idle_timeout'],
+    )
+
+
+def load_batch(strategies: list) -> list:
+    """ Function to load the resources of GET strategies of the same service, with one request to the service
+    'batch' endpoint when it has one, which formats {ids} as comma separated ids and answers a list of resources,
+    otherwise with a single request of each strategy sent at the same time. It returns the result, or the
+    exception, of each strategy """
+    first = strategies[0]
+    endpoint = first.config['batch'].get('endpoint')
+    if not endpoint or len(strategies) == 1:
+        # each single request runs in the context of the caller of its strategy, not in the one loading the batch
+        futures = [
+            batch_executor().submit(strategy.context.run, strategy._send_one) for strategy in strategies[1:]
+        ]
+        results = []
+        for call in [partial(first.context.run, first._send_one)] + [future.result for future in futures]:
+            try:
+                results.append(call())
+            except (ExternalResourceNotFound, ExternalApiError) as exc:
+                results.append(exc)
+        return results
+
+    # the request serves every strategy, it may take the time left of the one with the latest deadline
+    timeouts = [time_left(strategy.deadline) for strategy in strategies if not expired(strategy.deadline)]
+    if not timeouts:
+        raise DeadlineExceeded
+    ids = ','.join(dict.fromkeys(str(strategy.resource_id) for strategy in strategies))
+    request = partial(
+        api_request,
+        request_obj=first.client.request_obj(method='GET', endpoint=endpoint.format(ids=ids)),
+        timeout=max(timeouts),
+        pool=service_pool(first.config),
+        service=first.service_name,
+    )
+    limiter = service_limiter(first.service_name, first.config)
+    if limiter is not None:
+        request = partial(limiter.call, request, timeout=max(timeouts))
+    retry = service_retry(first.service_name, first.config)
+    if retry is not None:
+        deadlines = [strategy.deadline for strategy in strategies]
+        request = partial(retry.call, request, deadline=None if None in deadlines else max(deadlines))
+    breaker = service_breaker(first.service_name, first.config)
+    data = request() if breaker is None else breaker.call(request)
+    if not isinstance(data, list):
+        raise ExternalApiError
+    resources = {str(item.get('id')): item for item in data if isinstance(item, dict)}
+    return [resources.get(str(strategy.resource_id), ExternalResourceNotFound()) for strategy in strategies]
+
+
+class ExternalService:
+    """ Base Strategy for External Services, subclasses define service and how errors are triggered """
+    service = None
+
+    def __init__(self, method: str, endpoint: str, deadline: float = None, resource_id=None,
+                 client: ServiceClient = None, **kwargs) -> None:
+        """ Initializing ExternalService to configure request object with service client, by default the
+        registered one, deadline is the monotonic time when the request budget runs out, resource_id is the id
+        a GET endpoint looks up, which lets the request be batched with other lookups of the service """
+        if client is None:
+            client = service_client(getattr(settings, self.service))
+        self.client = client
+        self.service_name = client.service.lower()
+        self.deadline = deadline
+        self.resource_id = resource_id
+        self.config = client.config
+        self.request_obj = client.request_obj(
             method=method,
             endpoint=endpoint,
             **kwargs,
         )
 
+    @property
+    def retryable(self) -> bool:
+        """ GET requests can be retried, other ones only when they carry an idempotency key """
+        return self.request_obj.get_method() == 'GET' or self.request_obj.has_header('Idempotency-key')
+
     def _api_request(self):
-        return api_request(
+        if self.request_obj.get_method() != 'GET':
+            return self._send()
+        load = self._send
+        if settings.EXTERNAL_SINGLE_FLIGHT:
+            load = self._shared_send
+        cache = service_cache(self.service_name, self.config)
+        if cache is None:
+            return load()
+        return cache.get_or_load(self.request_obj.full_url, load)
+
+    def _shared_send(self):
+        """ Method to send the request, or to wait at most the time left of the request budget for the same
+        request already in flight """
+        try:
+            return single_flight.do(
+                (self.service_name, 'GET', self.request_obj.full_url), self._send, timeout=time_left(self.deadline),
+            )
+        except ExternalApiError:
+            if expired(self.deadline):
+                raise DeadlineExceeded
+            raise
+
+    def _send(self):
+        loader = None
+        if self.resource_id is not None and self.request_obj.get_method() == 'GET':
+            loader = service_loader(self.service_name, self.config, load_batch)
+        if loader is None:
+            return self._send_one()
+        self.context = copy_context()
+        try:
+            return loader.load(self, timeout=time_left(self.deadline))
+        except ExternalApiError:
+            if expired(self.deadline):
+                raise DeadlineExceeded
+            raise
+
+    def _send_one(self):
+        breaker = service_breaker(self.service_name, self.config)
+        if breaker is None:
+            return self._call_api()
+        return breaker.call(self._call_api)
+
+    def _call_api(self):
+        retry = service_retry(self.service_name, self.config) if self.retryable else None
+        if retry is None:
+            return self._attempt()
+        return retry.call(self._attempt, deadline=self.deadline)
+
+    def _attempt(self):
+        timeout = time_left(self.deadline)
+        request = partial(
+            api_request,
+            request_obj=self.request_obj,
+            timeout=timeout,
+            pool=service_pool(self.config),
+            service=self.service_name,
+        )
+        limiter = service_limiter(self.service_name, self.config)
+        if limiter is not None:
+            request = partial(limiter.call, request, timeout=timeout)
+        hedger = service_hedger(self.service_name, self.config) if self.request_obj.get_method() == 'GET' else None
+        try:
+            if hedger is None:
+                return request()
+            return hedger.call(request, timeout=timeout)
+        except ExternalApiError:
+            if expired(self.deadline):
+                raise DeadlineExceeded
+            raise
+
+    async def _async_api_request(self):
+        if self.request_obj.get_method() != 'GET':
+            return await self._async_send()
+        load = self._async_send
+        if settings.EXTERNAL_SINGLE_FLIGHT:
+            load = self._async_shared_send
+        cache = service_cache(self.service_name, self.config)
+        if cache is None:
+            return await load()
+        return await cache.aget_or_load(self.request_obj.full_url, load)
+
+    async def _async_shared_send(self):
+        """ Coroutine counterpart of _shared_send """
+        try:
+            return await single_flight.ado(
+                (self.service_name, 'GET', self.request_obj.full_url), self._async_send,
+                timeout=time_left(self.deadline),
+            )
+        except ExternalApiError:
+            if expired(self.deadline):
+                raise DeadlineExceeded
+            raise
+
+    async def _async_send(self):
+        breaker = service_breaker(self.service_name, self.config)
+        if breaker is None:
+            return await self._async_call_api()
+        return await breaker.acall(self._async_call_api)
+
+    async def _async_call_api(self):
+        retry = service_retry(self.service_name, self.config) if self.retryable else None
+        if retry is None:
+            return await self._async_attempt()
+        return await retry.acall(self._async_attempt, deadline=self.deadline)
+
+    async def _async_attempt(self):
+        timeout = time_left(self.deadline)
+        request = partial(
+            async_api_request,
             request_obj=self.request_obj,
-            timeout=30,
+            timeout=timeout,
+            pool=service_pool(self.config),
+            service=self.service_name,
         )
+        limiter = service_limiter(self.service_name, self.config)
+        try:
+            if limiter is None:
+                return await request()
+            return await limiter.acall(request, timeout=timeout)
+        except ExternalApiError:
+            if expired(self.deadline):
+                raise DeadlineExceeded
+            raise
+
+    def handle_error(self, exc: Exception) -> dict:
+        """ Method to map request exception to service response, by default exception is raised """
+        raise exc
 
     def do_request(self) -> dict:
         try:
-            return self._api_request()
-        except ExternalResourceNotFound:
+            with timed(EXTERNAL_SERVICE_SECONDS, service=self.service_name):
+                return self._api_request()
+        except (ExternalResourceNotFound, ExternalApiError) as exc:
+            return self.handle_error(exc)
+
+    async def ado_request(self) -> dict:
+        """ Coroutine counterpart of do_request """
+        try:
+            with timed(EXTERNAL_SERVICE_SECONDS, service=self.service_name):
+                return await self._async_api_request()
+        except (ExternalResourceNotFound, ExternalApiError) as exc:
+            return self.handle_error(exc)
+
+
+class ClientExternalService(ExternalService):
+    """ Strategy for Client External Service to connect and trigger Validation errors """
+    service = 'EXTERNAL_CLINIC'
+
+    def handle_error(self, exc: Exception) -> dict:
+        """ Method to map clinic errors, not found or not available, to empty clinic data so the prescription is
+        saved without clinic """
+        if isinstance(exc, (ExternalResourceNotFound, ExternalApiError)):
+            return {}
+        raise exc
+
+
+class PatientExternalService(ExternalService):
+    """ Strategy for Patient External Service to connect and trigger Validation errors """
+    service = 'EXTERNAL_PATIENT'
+
+    def handle_error(self, exc: Exception) -> dict:
+        if isinstance(exc, ExternalResourceNotFound):
             raise serializers.ValidationError(
                 detail={
                     'error': {
@@ -112,41 +461,22 @@ class PatientExternalService:
                     }
                 },
             )
-        except ExternalApiError:
-            raise serializers.ValidationError(
-                detail={
-                    'error': {
-                        'message': f'{self.service_name}s service not available',
-                        'code': '06',
-                    }
-                },
-            )
+        raise serializers.ValidationError(
+            detail={
+                'error': {
+                    'message': f'{self.service_name}s service not available',
+                    'code': '06',
+                }
+            },
+        )
 
 
-class PhysicianExternalService:
+class PhysicianExternalService(ExternalService):
     """ Strategy for Physician External Service to connect and trigger Validation errors """
+    service = 'EXTERNAL_PHYSICIAN'
 
-    def __init__(self, method: str, endpoint: str, **kwargs) -> None:
-        """ Initializing ExternalService to configure request object with service config. """
-        self.service_name = settings.EXTERNAL_PHYSICIAN.lower()
-        self.config = dict(settings.EXTERNAL_SERVICES[settings.EXTERNAL_PHYSICIAN])
-        self.request_obj = prepare_request_obj(
-            config=self.config,
-            method=method,
-            endpoint=endpoint,
-            **kwargs,
-        )
-
-    def _api_request(self):
-        return api_request(
-            request_obj=self.request_obj,
-            timeout=30,
-        )
-
-    def do_request(self) -> dict:
-        try:
-            return self._api_request()
-        except ExternalResourceNotFound:
+    def handle_error(self, exc: Exception) -> dict:
+        if isinstance(exc, ExternalResourceNotFound):
             raise serializers.ValidationError(
                 detail={
                     'error': {
@@ -155,41 +485,29 @@ class PhysicianExternalService:
                     }
                 },
             )
-        except ExternalApiError:
-            raise serializers.ValidationError(
-                detail={
-                    'error': {
-                        'message': f'{self.service_name}s service not available',
-                        'code': '05',
-                    }
-                },
-            )
+        raise serializers.ValidationError(
+            detail={
+                'error': {
+                    'message': f'{self.service_name}s service not available',
+                    'code': '05',
+                }
+            },
+        )
 
 
-class MetricExternalService:
+class MetricExternalService(ExternalService):
     """ Strategy for Metric External Service to connect and trigger Validation errors """
+    service = 'EXTERNAL_METRIC'
 
-    def __init__(self, method: str, endpoint: str, **kwargs) -> None:
-        """ Initializing ExternalService to configure request object with service config. """
-        self.service_name = settings.EXTERNAL_METRIC.lower()
-        self.config = dict(settings.EXTERNAL_SERVICES[settings.EXTERNAL_METRIC])
-        self.request_obj = prepare_request_obj(
-            config=self.config,
-            method=method,
-            endpoint=endpoint,
-            **kwargs,
-        )
-
-    def _api_request(self):
-        return api_request(
-            request_obj=self.request_obj,
-            timeout=30,
-        )
+    def __init__(self, *args, idempotency_key: str = None, **kwargs) -> None:
+        """ Initializing the metric request with an idempotency key, by default a new one. Retries of the request
+        send the same one, and so do later deliveries of the same metric given its stable key, so metrics service
+        counts the metric once """
+        super().__init__(*args, **kwargs)
+        self.request_obj.add_header('Idempotency-Key', idempotency_key or uuid.uuid4().hex)
 
-    def do_request(self) -> dict:
-        try:
-            return self._api_request()
-        except ExternalApiError:
+    def handle_error(self, exc: Exception) -> dict:
+        if isinstance(exc, ExternalApiError):
             raise serializers.ValidationError(
                 detail={
                     'error': {
@@ -198,31 +516,39 @@ class MetricExternalService:
                     },
                 },
             )
+        raise exc
 
 
 class ExternalServiceContext:
     """ Class to manage context of external service request """
 
-    def __init__(self, service: str, method: str, endpoint: str, **kwargs) -> None:
-        """ Initializing ExternalService Connector to configure request object with service config. """
-        strategies = {
-            settings.EXTERNAL_CLINIC: ClientExternalService,
-            settings.EXTERNAL_METRIC: MetricExternalService,
-            settings.EXTERNAL_PATIENT: PatientExternalService,
-            settings.EXTERNAL_PHYSICIAN: PhysicianExternalService,
-        }
-        if service not in settings.EXTERNAL_SERVICES.keys():
-            raise ValueError(f'{service} is not a valid external service, please configure it.')
-
-        if not isinstance(settings.EXTERNAL_SERVICES[service], dict):
-            raise ValueError(f'{service} config has not a valid value.')
-
-        self.strategy = strategies[service](
+    def __init__(self, service: str, method: str, endpoint: str, deadline: float = None, **kwargs) -> None:
+        """ Initializing ExternalService Connector to configure request object with service config,
+        requests get the time left of deadline, by default the budget of the current request """
+        client = service_client(service)
+        self.strategy = client.strategy(
             method=method,
             endpoint=endpoint,
+            deadline=current_deadline() if deadline is None else deadline,
+            client=client,
             **kwargs,
         )
 
+    def span(self):
+        request_obj = self.strategy.request_obj
+        return span(
+            'ExternalServiceContext.do_request',
+            service=self.strategy.service_name,
+            method=request_obj.get_method(),
+            endpoint=request_obj.selector,
+        )
+
     def do_request(self) -> dict:
         """ Method to perform configured request to server """
-        return self.strategy.do_request()
+        with self.span():
+            return self.strategy.do_request()
+
+    async def ado_request(self) -> dict:
+        """ Coroutine to perform configured request to server without blocking the event loop """
+        with self.span():
+            return await self.strategy.ado_request()
@@ -1,3 +1,88 @@
-from django.shortcuts import render
+""" Module to define app views """
+from django.http import HttpResponse
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from prescription.batch import batch_stats
+from prescription.breaker import breaker_states
+from prescription.cache import cache_stats
+from prescription.hedge import hedge_stats
+from prescription.instrumentation import render_histograms
+from prescription.limiter import limiter_stats
+from prescription.metrics import dispatcher_stats
+from prescription.pool import pool_stats
+from prescription.retry import retry_stats
+from prescription.singleflight import single_flight
+from prescription.tracing import exporter_stats
+from prescription.writer import writer_stats
+
+
+@require_GET
+def upstream_status(request):
+    """ View to export state of external services circuit breakers, caches, hedging, batching, concurrency limits,
+    retries, connection pools and coalescing """
+    return JsonResponse({
+        'batches': batch_stats(),
+        'breakers': breaker_states(),
+        'caches': cache_stats(),
+        'hedges': hedge_stats(),
+        'limiters': limiter_stats(),
+        'pools': pool_stats(),
+        'retries': retry_stats(),
+        'single_flight': single_flight.snapshot(),
+    })
+
+
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+def render_gauges(name: str, documentation: str, label_name: str, stats: dict) -> list:
+    """ Function to get a gauge per numeric counter of each labelled stats dict in Prometheus text format """
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} gauge']
+    for label, values in sorted(stats.items()):
+        for key, value in sorted(values.items()):
+            if key == 'state':
+                value = BREAKER_STATE_VALUES.get(value, -1)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'{name}{{{label_name}="{label}",stat="{key}"}} {value}')
+    return lines
+
+
+@require_GET
+def prometheus_metrics(request):
+    """ View to export latency histograms and upstream stats in Prometheus text format """
+    lines = render_histograms()
+    lines.extend(render_gauges(
+        'psction_breaker', 'Circuit breaker stats, state is 0 closed, 1 half open and 2 open', 'service',
+        breaker_states(),
+    ))
+    lines.extend(render_gauges(
+        'psction_batch', 'Micro-batched lookups stats, loads, batches sent and keys they carried', 'service',
+        batch_stats(),
+    ))
+    lines.extend(render_gauges('psction_cache', 'External resources cache stats', 'service', cache_stats()))
+    lines.extend(render_gauges(
+        'psction_hedge', 'Hedged requests stats, sent hedges and hedges answering first', 'service', hedge_stats(),
+    ))
+    lines.extend(render_gauges(
+        'psction_limiter', 'Concurrency limiter stats, queue depth and rejected or timed out requests', 'service',
+        limiter_stats(),
+    ))
+    lines.extend(render_gauges('psction_pool', 'Keep-alive connection pool stats', 'base_url', pool_stats()))
+    lines.extend(render_gauges(
+        'psction_retry', 'External requests retries stats, retries sent, calls recovered or failing every attempt',
+        'service', retry_stats(),
+    ))
+    lines.extend(render_gauges(
+        'psction_single_flight', 'Coalesced external requests stats', 'scope', {'process': single_flight.snapshot()},
+    ))
+    lines.extend(render_gauges(
+        'psction_group_commit', 'Group commit writer stats', 'scope', {'process': writer_stats()},
+    ))
+    lines.extend(render_gauges(
+        'psction_span_exporter', 'Trace spans exporter stats', 'scope', {'process': exporter_stats()},
+    ))
+    lines.extend(render_gauges(
+        'psction_metric_dispatcher', 'Background metric delivery stats', 'scope', {'process': dispatcher_stats()},
+    ))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
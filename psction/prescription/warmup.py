@@ -0,0 +1,48 @@
+""" Module to define the warm-up of a serving process, done before it accepts traffic """
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+
+from prescription.utils import lookup_executor
+from prescription.utils import service_pool
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(prime_connections: int = None) -> dict:
+    """ Function to pay ahead the lazy work of first requests: url resolver, database backends, lookup threads
+    and, when pooling is enabled, prime_connections idle connections to each external base_url. Database
+    connections are per thread, so a connection is only opened to check the database and load its backend, then
+    closed, request threads open their own """
+    start = time.perf_counter()
+    resolver = get_resolver()
+    resolver.resolve('/prescriptions')
+    patterns = len(resolver.reverse_dict)
+
+    for alias in connections:
+        connections[alias].ensure_connection()
+        connections[alias].close()
+
+    if settings.EXTERNAL_PARALLEL_LOOKUPS:
+        lookup_executor()
+
+    primed = {}
+    if prime_connections is None:
+        prime_connections = settings.WARMUP_CONNECTIONS
+    if prime_connections > 0:
+        for config in settings.EXTERNAL_SERVICES.values():
+            pool = service_pool(config)
+            if pool is not None and pool.base_url not in primed:
+                primed[pool.base_url] = pool.prime(prime_connections)
+
+    summary = {
+        'url_patterns': patterns,
+        'databases': len(connections.all()),
+        'primed_connections': primed,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    logger.info('Warm-up done %s', summary)
+    return summary
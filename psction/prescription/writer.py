@@ -0,0 +1,194 @@
+""" Module to define group commit of prescription inserts, concurrent requests share one transaction """
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db.backends.signals import connection_created
+
+from prescription.models import MetricOutbox
+from prescription.models import Prescription
+
+logger = logging.getLogger(__name__)
+
+
+def write_prescriptions(items: list) -> list:
+    """ Function to insert (prescription, outbox payload or None) items in one transaction, it returns the
+    prescriptions with their ids in the same order """
+    with transaction.atomic():
+        payloads = [MetricOutbox(payload=payload) for _prescription, payload in items if payload is not None]
+        if payloads:
+            MetricOutbox.objects.bulk_create(payloads)
+        return Prescription.objects.bulk_insert([prescription for prescription, _payload in items])
+
+
+class WriterUnavailable(Exception):
+    """ Exception raised when a prescription is not queued or its commit doesn't start in time, it is not saved """
+
+
+class GroupCommitWriter:
+    """ Class to insert items of concurrent callers from a background thread, items queued while a transaction
+    commits are written together in the next one, which has at most max_batch items and waits at most max_wait
+    seconds for more of them after its first one """
+    STOP = object()
+
+    def __init__(self, write=write_prescriptions, max_batch: int = 64, max_wait: float = 0.002,
+                 max_queue: int = 10000, timeout: float = 5) -> None:
+        self.write = write
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {
+            'items': 0,
+            'transactions': 0,
+            'fallbacks': 0,
+            'failed': 0,
+            'rejected': 0,
+            'timed_out': 0,
+        }
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+                self._thread.start()
+
+    def insert(self, prescription: Prescription, outbox_payload: dict = None) -> Prescription:
+        """ Method to insert prescription, and its outbox payload in the same transaction, waiting the commit.
+        Write errors are raised to the caller, WriterUnavailable when it can't be queued in timeout seconds or its
+        commit doesn't start within timeout seconds, then it is cancelled so it is never saved. A commit already
+        started is waited until its end, so a saved prescription is never reported as failed """
+        self.start()
+        future = Future()
+        try:
+            self._queue.put(((prescription, outbox_payload), future), timeout=self.timeout)
+        except queue.Full:
+            self._count('rejected')
+            raise WriterUnavailable
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if not future.cancel():
+                return future.result()
+            self._count('timed_out')
+            raise WriterUnavailable
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+
+    def _collect(self, first) -> tuple:
+        """ Method to collect a batch starting with first, it returns (batch, stop requested) """
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if entry is self.STOP:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self) -> None:
+        stop = False
+        try:
+            while not stop:
+                entry = self._queue.get()
+                if entry is self.STOP:
+                    break
+                batch, stop = self._collect(entry)
+                batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._commit(batch)
+        finally:
+            connection.close()
+
+    def _commit(self, batch: list) -> None:
+        """ Method to write batch in one transaction, when it fails items are written one by one so only
+        the failing ones get the error """
+        items = [item for item, _future in batch]
+        try:
+            results = self.write(items)
+        except Exception as exc:
+            connection.close_if_unusable_or_obsolete()
+            if len(batch) == 1:
+                self._count('failed')
+                batch[0][1].set_exception(exc)
+                return
+            self._count('fallbacks')
+            logger.warning('Group commit of %s prescriptions failed, writing them one by one', len(batch))
+            for entry in batch:
+                self._commit([entry])
+            return
+        self._count('transactions')
+        self._count('items', len(batch))
+        for (_item, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self, timeout: float = 5) -> None:
+        """ Method to write queued items and stop background thread """
+        with self._lock:
+            thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(self.STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout=timeout)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, queued=self._queue.qsize())
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def prescription_writer() -> GroupCommitWriter:
+    """ Function to get the process group commit writer, flushed at interpreter exit """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                options = {key: value for key, value in settings.GROUP_COMMIT.items() if key != 'enabled'}
+                _writer = GroupCommitWriter(**options)
+                atexit.register(_writer.close)
+    return _writer
+
+
+def writer_stats() -> dict:
+    """ Function to get stats of the group commit writer, empty when it was never started """
+    return _writer.snapshot() if _writer is not None else {}
+
+
+def enable_sqlite_wal(sender, connection, **kwargs) -> None:
+    """ connection_created receiver turning on write-ahead log on SQLite connections, so readers don't block
+    the writer, and fsync only on checkpoints """
+    if connection.vendor == 'sqlite' and settings.SQLITE_WAL:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+
+
+def connect_signals() -> None:
+    connection_created.connect(enable_sqlite_wal, dispatch_uid='prescription.enable_sqlite_wal')
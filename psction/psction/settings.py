@@ -40,6 +40,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'prescription.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,10 +73,23 @@ WSGI_APPLICATION = 'psction.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# Prescription inserts of concurrent requests are written together by a background writer, in transactions of
+# at most `max_batch` prescriptions waiting at most `max_wait` seconds for more of them. It turns on SQLite
+# write-ahead log and persistent connections unless PSC_SQLITE_WAL / PSC_DB_CONN_MAX_AGE say otherwise
+GROUP_COMMIT = {
+    'enabled': os.getenv('PSC_GROUP_COMMIT') == '1',
+    'max_batch': int(os.getenv('PSC_GROUP_COMMIT_MAX_BATCH', '64')),
+    'max_wait': float(os.getenv('PSC_GROUP_COMMIT_MAX_WAIT', '0.002')),
+    'max_queue': int(os.getenv('PSC_GROUP_COMMIT_QUEUE_SIZE', '10000')),
+    'timeout': float(os.getenv('PSC_GROUP_COMMIT_TIMEOUT', '5')),
+}
+SQLITE_WAL = os.getenv('PSC_SQLITE_WAL', '1' if GROUP_COMMIT['enabled'] else '0') == '1'
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / os.getenv('PSC_DB_NAME'),
+        'CONN_MAX_AGE': int(os.getenv('PSC_DB_CONN_MAX_AGE', '600' if GROUP_COMMIT['enabled'] else '0')),
     }
 }
 
@@ -130,22 +144,200 @@ EXTERNAL_METRIC = 'METRIC'
 EXTERNAL_PATIENT = 'PATIENT'
 EXTERNAL_PHYSICIAN = 'PHYSICIAN'
 
+# Circuit breaker of each external service, after `failure_threshold` consecutive errors requests fail fast
+# during `recovery_timeout` seconds
+EXTERNAL_BREAKER = {
+    'failure_threshold': int(os.getenv('PSC_BREAKER_FAILURES', '5')),
+    'recovery_timeout': float(os.getenv('PSC_BREAKER_RECOVERY_TIMEOUT', '30')),
+    'half_open_max_calls': int(os.getenv('PSC_BREAKER_HALF_OPEN_CALLS', '1')),
+}
+
+# Hedged GET requests of each lookup service, a request still running after `percentile` of the last `window`
+# latencies is sent again and the first response is used, hedges are at most `budget` of the requests
+EXTERNAL_HEDGE = {
+    'enabled': os.getenv('PSC_HEDGE') == '1',
+    'percentile': float(os.getenv('PSC_HEDGE_PERCENTILE', '95')),
+    'budget': float(os.getenv('PSC_HEDGE_BUDGET', '0.05')),
+    'window': int(os.getenv('PSC_HEDGE_WINDOW', '200')),
+    'min_samples': 20,
+}
+# Threads running hedged requests and their hedges, size it for the hedged lookups running at the same time in the
+# worker, e.g. threads x 3 lookups, lookups finding every thread busy are sent unhedged from the request thread
+EXTERNAL_HEDGE_WORKERS = int(os.getenv('PSC_HEDGE_WORKERS', '32'))
+
+# Micro-batched GET lookups of each lookup service, lookups of concurrent requests during `window` seconds, at most
+# `max_size` of them, are sent in one request to the service `endpoint` taking comma separated {ids}, or as single
+# requests at the same time when the service has no such endpoint
+EXTERNAL_BATCH = {
+    'enabled': os.getenv('PSC_BATCH') == '1',
+    'window': float(os.getenv('PSC_BATCH_WINDOW', '0.002')),
+    'max_size': int(os.getenv('PSC_BATCH_MAX_SIZE', '32')),
+}
+EXTERNAL_BATCH_WORKERS = int(os.getenv('PSC_BATCH_WORKERS', '32'))
+
+# Concurrency limit of each external service, requests beyond `max_concurrency` wait in a queue of `max_queue`
+# requests during `queue_timeout` seconds, a request finding the queue full or waiting too long fails at once
+# with the service not available error
+EXTERNAL_LIMIT = {
+    'enabled': os.getenv('PSC_LIMIT') == '1',
+    'max_concurrency': int(os.getenv('PSC_LIMIT_CONCURRENCY', '10')),
+    'max_queue': int(os.getenv('PSC_LIMIT_QUEUE', '20')),
+    'queue_timeout': float(os.getenv('PSC_LIMIT_QUEUE_TIMEOUT', '0.5')),
+}
+
+# Retries of failed external requests, at most `attempts` requests, each retry waits a random time up to `backoff`
+# seconds doubled on every retry and capped by `max_backoff`, it is not done when the wait reaches the request
+# deadline. `retry_on` holds retryable status classes (5xx), statuses (429) and connection errors (connection).
+# GET requests are retried, other requests only with an Idempotency-Key header like metric posts
+EXTERNAL_RETRY = {
+    'enabled': os.getenv('PSC_RETRY') == '1',
+    'attempts': int(os.getenv('PSC_RETRY_ATTEMPTS', '2')),
+    'backoff': float(os.getenv('PSC_RETRY_BACKOFF', '0.05')),
+    'max_backoff': float(os.getenv('PSC_RETRY_MAX_BACKOFF', '0.5')),
+    'retry_on': tuple(os.getenv('PSC_RETRY_ON', 'connection,5xx,429').split(',')),
+}
 
 EXTERNAL_SERVICES = {
     EXTERNAL_CLINIC: {
         'base_url': 'https://5f71da6964a3720016e60ff8.mockapi.io/v1',
         'auth_token': os.getenv('CLINIC_TOKEN'),
+        'breaker': EXTERNAL_BREAKER,
+        'limit': EXTERNAL_LIMIT,
+        'retry': EXTERNAL_RETRY,
+        'hedge': EXTERNAL_HEDGE,
+        'batch': dict(EXTERNAL_BATCH, endpoint=os.getenv('CLINIC_BATCH_ENDPOINT')),
+        'cache': {
+            'ttl': float(os.getenv('CLINIC_CACHE_TTL', '300')),
+            'negative_ttl': float(os.getenv('PSC_NEGATIVE_CACHE_TTL', '10')),
+            'maxsize': int(os.getenv('PSC_CACHE_SIZE', '1024')),
+        },
     },
     EXTERNAL_PATIENT: {
         'base_url': 'https://5f71da6964a3720016e60ff8.mockapi.io/v1',
         'auth_token': os.getenv('PATIENT_TOKEN'),
+        'breaker': EXTERNAL_BREAKER,
+        'limit': EXTERNAL_LIMIT,
+        'retry': EXTERNAL_RETRY,
+        'hedge': EXTERNAL_HEDGE,
+        'batch': dict(EXTERNAL_BATCH, endpoint=os.getenv('PATIENT_BATCH_ENDPOINT')),
+        'cache': {
+            'ttl': float(os.getenv('PATIENT_CACHE_TTL', '60')),
+            'negative_ttl': float(os.getenv('PSC_NEGATIVE_CACHE_TTL', '10')),
+            'maxsize': int(os.getenv('PSC_CACHE_SIZE', '1024')),
+        },
     },
     EXTERNAL_PHYSICIAN: {
         'base_url': 'https://5f71da6964a3720016e60ff8.mockapi.io/v1',
         'auth_token': os.getenv('PHYSICIAN_TOKEN'),
+        'breaker': EXTERNAL_BREAKER,
+        'limit': EXTERNAL_LIMIT,
+        'retry': EXTERNAL_RETRY,
+        'hedge': EXTERNAL_HEDGE,
+        'batch': dict(EXTERNAL_BATCH, endpoint=os.getenv('PHYSICIAN_BATCH_ENDPOINT')),
+        'cache': {
+            'ttl': float(os.getenv('PHYSICIAN_CACHE_TTL', '300')),
+            'negative_ttl': float(os.getenv('PSC_NEGATIVE_CACHE_TTL', '10')),
+            'maxsize': int(os.getenv('PSC_CACHE_SIZE', '1024')),
+        },
     },
     EXTERNAL_METRIC: {
         'base_url': 'https://5f71da6964a3720016e60ff8.mockapi.io/v1',
         'auth_token': os.getenv('METRIC_TOKEN'),
+        'breaker': EXTERNAL_BREAKER,
+        'limit': EXTERNAL_LIMIT,
+        'retry': EXTERNAL_RETRY,
+        # endpoint accepting a list of metrics, when set queued metrics are posted in one request
+        'batch_endpoint': os.getenv('METRIC_BATCH_ENDPOINT'),
     },
 }
+
+# Perform clinic, physician and patient lookups of a prescription at the same time
+EXTERNAL_PARALLEL_LOOKUPS = os.getenv('PSC_PARALLEL_LOOKUPS') == '1'
+EXTERNAL_LOOKUP_WORKERS = int(os.getenv('PSC_LOOKUP_WORKERS', '12'))
+
+# Concurrent GET requests to the same external url share one in-flight request
+EXTERNAL_SINGLE_FLIGHT = os.getenv('PSC_SINGLE_FLIGHT', '0') == '1'
+
+# Keep-alive connection pool shared by external services with the same base_url
+EXTERNAL_HTTP_POOL = {
+    'enabled': os.getenv('PSC_HTTP_POOL') == '1',
+    'maxsize': int(os.getenv('PSC_HTTP_POOL_SIZE', '10')),
+    'idle_timeout': float(os.getenv('PSC_HTTP_POOL_IDLE_TIMEOUT', '60')),
+}
+
+# Metric delivery, 'async' queues the metric to be posted in batches from a background thread, 'sync' is the strict
+# mode posting it before saving a prescription and failing the request with code 04 when metric service is not
+# available, 'outbox' saves it with the prescription to be posted by `manage.py drain_metric_outbox`
+METRIC_DELIVERY = os.getenv('PSC_METRIC_DELIVERY', 'async')
+METRIC_DISPATCHER = {
+    'max_queue': int(os.getenv('PSC_METRIC_QUEUE_SIZE', '1000')),
+    'batch_size': int(os.getenv('PSC_METRIC_BATCH_SIZE', '50')),
+    'flush_interval': float(os.getenv('PSC_METRIC_FLUSH_INTERVAL', '1')),
+    'put_timeout': float(os.getenv('PSC_METRIC_PUT_TIMEOUT', '0.05')),
+}
+METRIC_OUTBOX = {
+    'batch_size': int(os.getenv('PSC_OUTBOX_BATCH_SIZE', '100')),
+    'lease': float(os.getenv('PSC_OUTBOX_LEASE', '60')),
+    'backoff': float(os.getenv('PSC_OUTBOX_BACKOFF', '1')),
+    'max_backoff': float(os.getenv('PSC_OUTBOX_MAX_BACKOFF', '300')),
+    'max_attempts': int(os.getenv('PSC_OUTBOX_MAX_ATTEMPTS', '20')),
+}
+
+# Page size of [GET] /prescriptions, clients can ask up to PRESCRIPTION_MAX_PAGE_SIZE with page_size param
+PRESCRIPTION_PAGE_SIZE = int(os.getenv('PSC_PAGE_SIZE', '50'))
+PRESCRIPTION_MAX_PAGE_SIZE = int(os.getenv('PSC_MAX_PAGE_SIZE', '500'))
+
+# Rows fetched from database by each step of a prescriptions export
+PRESCRIPTION_EXPORT_CHUNK_SIZE = int(os.getenv('PSC_EXPORT_CHUNK_SIZE', '2000'))
+
+# Max prescriptions accepted by [POST] /prescriptions/bulk
+PRESCRIPTION_BULK_MAX_ITEMS = int(os.getenv('PSC_BULK_MAX_ITEMS', '1000'))
+
+# Latency histograms of external requests and prescription stages, served on /metrics
+INSTRUMENTATION_ENABLED = os.getenv('PSC_INSTRUMENTATION', '1') == '1'
+
+# Time budget of a request shared by all of its external requests, clients can ask a shorter or longer one
+# (up to `max` seconds) with the `header` header, each external request takes at most EXTERNAL_TIMEOUT seconds
+EXTERNAL_TIMEOUT = float(os.getenv('PSC_EXTERNAL_TIMEOUT', '30'))
+REQUEST_DEADLINE = {
+    'default': float(os.getenv('PSC_REQUEST_DEADLINE', '30')),
+    'max': float(os.getenv('PSC_REQUEST_DEADLINE_MAX', '60')),
+    'header': 'X-Request-Timeout',
+}
+
+# Responses of [POST] /prescriptions sent with the `header` header are kept `ttl` seconds to answer retries,
+# a retry arriving while the first request is running waits for it, a request holding a key more than
+# `lock_timeout` seconds is considered dead and its key can be taken by a retry
+IDEMPOTENCY = {
+    'header': 'Idempotency-Key',
+    'ttl': float(os.getenv('PSC_IDEMPOTENCY_TTL', '86400')),
+    'lock_timeout': float(os.getenv('PSC_IDEMPOTENCY_LOCK_TIMEOUT', '90')),
+    'poll_interval': 0.05,
+}
+
+# Idle connections opened to each external base_url by the warm-up of a serving process when pooling is enabled
+WARMUP_CONNECTIONS = int(os.getenv('PSC_WARMUP_CONNECTIONS', '2'))
+
+# Validate and render plainly valid prescriptions without DRF field machinery, other data goes through DRF fields
+PRESCRIPTION_FAST_PATH = os.getenv('PSC_FAST_PATH', '1') == '1'
+
+# Profile with cProfile `rate` of POST requests to `paths`, or a request whose `header` holds `token`, stats files
+# named <time>-<request id>-<wall ms>-<services called>.prof are saved to `directory`, keeping the newest `keep`
+PROFILING = {
+    'rate': float(os.getenv('PSC_PROFILE_RATE', '0')),
+    'header': 'X-Profile',
+    'token': os.getenv('PSC_PROFILE_TOKEN'),
+    'paths': ('/prescriptions',),
+    'directory': os.getenv('PSC_PROFILE_DIR', str(BASE_DIR / 'profiles')),
+    'keep': int(os.getenv('PSC_PROFILE_KEEP', '50')),
+}
+
+# Trace requests, their spans (view, lookups, external requests, metric and insert) are appended as json lines to
+# `path` from a background thread, the trace id is taken from and answered in `header` and sent to external services
+TRACING = {
+    'enabled': os.getenv('PSC_TRACING') == '1',
+    'header': 'X-Trace-Id',
+    'path': os.getenv('PSC_TRACE_FILE', str(BASE_DIR / 'traces.jsonl')),
+    'batch_size': int(os.getenv('PSC_TRACE_BATCH_SIZE', '200')),
+    'flush_interval': float(os.getenv('PSC_TRACE_FLUSH_INTERVAL', '1')),
+}